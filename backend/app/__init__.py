@@ -1,7 +1,15 @@
-from flask import Flask, send_from_directory, send_file
+from .logs import configure_logging
+
+# Before the app modules are imported, so their loggers go through the
+# structured, sampled pipeline from the first record
+configure_logging()
+
+from flask import Flask, Response, abort, request
 from flask_cors import CORS
 from .routes import chat_bp
-from .database import init_db
+from .warmup import warmup
+from .static_files import StaticAssets
+from .metrics import registry
 import os
 
 def create_app():
@@ -16,19 +24,37 @@ def create_app():
         }
     })
     
-    # Initialize database
-    init_db()
+    # Connect to MongoDB and the LLM API in the background; /api/ready
+    # reports when that is done. A preloading gunicorn master must not open
+    # connections its workers would inherit, so there the post_fork hook
+    # starts the warmup in each worker instead.
+    if os.getenv('TORKO_PRELOAD', 'false').lower() != 'true':
+        warmup.start()
     
     # Register blueprints
     app.register_blueprint(chat_bp, url_prefix='/api')
     
-    # Serve React static files
+    # Periodically publish this worker's metrics for /api/metrics
+    registry.start()
+    
+    # Serve React static files from an in-memory index built once here,
+    # with precompressed variants, ETags and long-lived caching
+    app.static_assets = StaticAssets(
+        app.static_folder,
+        max_file_bytes=int(os.getenv('STATIC_MAX_FILE_BYTES', 8 * 1024 * 1024))
+    )
+
     @app.route('/', defaults={'path': ''})
     @app.route('/<path:path>')
     def serve_react_app(path):
-        if path != "" and os.path.exists(os.path.join(app.static_folder, path)):
-            return send_from_directory(app.static_folder, path)
-        else:
-            return send_from_directory(app.static_folder, 'index.html')
+        result = app.static_assets.respond(
+            path,
+            accept_encoding=request.headers.get('Accept-Encoding'),
+            if_none_match=request.headers.get('If-None-Match')
+        )
+        if result is None:
+            abort(404)
+        status, headers, body = result
+        return Response(body, status=status, headers=headers)
     
     return app 
\ No newline at end of file
@@ -0,0 +1,263 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from dotenv import load_dotenv
+from .metrics import registry, observe_stage, ADMISSION_REJECTED
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class AdmissionRejected(Exception):
+    """A chat turn turned away without being queued; carries the HTTP status and Retry-After seconds"""
+
+    def __init__(self, message, status, retry_after, reason):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+BUSY_RESPONSE = "I'm handling a lot of conversations right now. Please try again in a few seconds."
+
+def rejection_body(error, session_id):
+    """JSON body for a rejected turn, shaped like the chat endpoints' error responses"""
+    return {
+        'error': 'The server is busy. Please retry after the Retry-After delay.'
+                 if error.status == 503 else 'A previous message in this session is still being answered.',
+        'response': BUSY_RESPONSE,
+        'session_id': session_id,
+        'retry_after': error.retry_after
+    }
+
+class _Ticket:
+    __slots__ = ('session_id', 'granted', 'wakeup', 'enqueued_at', 'admitted_at')
+
+    def __init__(self, session_id, wakeup=None):
+        self.session_id = session_id
+        self.granted = False
+        self.wakeup = wakeup
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+
+class AdmissionController:
+    """Bounded concurrency for chat turns with per-session fair queueing.
+
+    At most `max_concurrent` turns run at once and each session has at most
+    one turn running; a session's next turn waits behind it (up to
+    `max_session_queue` of them) and only then joins the shared queue, so
+    sessions are served round-robin and a chatty one cannot crowd out the
+    rest. Rather than letting requests pile up until they time out, a turn
+    is rejected straight away with 503 when the queue is full or the
+    estimated wait (from the queue length and the recent average turn time)
+    exceeds `max_wait`, and with 429 when its session already has
+    `max_session_queue` turns waiting. Threads and coroutines share the same
+    slots.
+    """
+
+    def __init__(self, max_concurrent=64, max_queue=256, max_wait=10.0, max_session_queue=1,
+                 initial_service_time=2.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_session_queue = max_session_queue
+        self.service_time = initial_service_time  # Moving average of turn durations
+        self._lock = threading.Lock()
+        self._active = 0
+        self._running = set()  # Sessions with a turn in progress
+        self._sessions = {}    # session_id -> deque of waiting tickets
+        self._ready = deque()  # Tickets at the head of an idle session, in arrival order
+        self._waiting = 0
+
+    def _reject(self, reason, status, retry_after, message):
+        ADMISSION_REJECTED.inc(reason=reason)
+        logger.warning("Rejected chat turn (%s): %s", reason, message)
+        return AdmissionRejected(message, status, max(1, math.ceil(retry_after)), reason)
+
+    def estimated_wait(self, position=None):
+        """Seconds a turn joining the queue at `position` (default: the back) would wait for a slot"""
+        if position is None:
+            position = len(self._ready)
+        if self._active < self.max_concurrent and position == 0:
+            return 0.0
+        # Slots free up about every service_time / max_concurrent seconds
+        return (position + 1) / self.max_concurrent * self.service_time
+
+    def _enter(self, session_id, wakeup_factory):
+        """Admit or queue a turn; returns a ticket (granted if admitted) or raises AdmissionRejected"""
+        with self._lock:
+            waiting = len(self._sessions.get(session_id, ()))
+            if (waiting or session_id in self._running) and waiting >= self.max_session_queue:
+                raise self._reject('session_busy', 429, self.service_time,
+                                   f"session {session_id} already has {waiting + (session_id in self._running)} turn(s) pending")
+            if session_id not in self._running and not self._ready and self._active < self.max_concurrent:
+                ticket = _Ticket(session_id)
+                self._grant(ticket)
+                return ticket
+            if self._waiting >= self.max_queue:
+                raise self._reject('queue_full', 503, self.estimated_wait(),
+                                   f"{self._waiting} turns already waiting")
+            estimate = self.estimated_wait()
+            if session_id in self._running:
+                estimate += self.service_time
+            if estimate > self.max_wait:
+                raise self._reject('overloaded', 503, estimate,
+                                   f"estimated wait {estimate:.1f}s exceeds {self.max_wait:.1f}s")
+
+            ticket = _Ticket(session_id, wakeup_factory())
+            self._sessions.setdefault(session_id, deque()).append(ticket)
+            self._waiting += 1
+            if session_id not in self._running and len(self._sessions[session_id]) == 1:
+                self._ready.append(ticket)
+            return ticket
+
+    def _grant(self, ticket):
+        ticket.granted = True
+        ticket.admitted_at = time.monotonic()
+        self._active += 1
+        self._running.add(ticket.session_id)
+
+    def _dispatch(self):
+        """Hand free slots to the oldest ready tickets; returns the tickets to wake"""
+        woken = []
+        while self._ready and self._active < self.max_concurrent:
+            ticket = self._ready.popleft()
+            self._dequeue(ticket)
+            self._grant(ticket)
+            woken.append(ticket)
+        return woken
+
+    def _dequeue(self, ticket):
+        queue = self._sessions[ticket.session_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._sessions[ticket.session_id]
+        self._waiting -= 1
+
+    def _abandon(self, ticket):
+        """Take back a ticket whose caller stopped waiting; True if it had been granted meanwhile"""
+        with self._lock:
+            if ticket.granted:
+                return True
+            was_ready = ticket in self._ready
+            if was_ready:
+                self._ready.remove(ticket)
+            self._dequeue(ticket)
+            queue = self._sessions.get(ticket.session_id)
+            if was_ready and queue:
+                # The session's next turn takes this one's place
+                self._ready.append(queue[0])
+            woken = self._dispatch()
+        self._wake(woken)
+        return False
+
+    def release(self, ticket):
+        """Free the slot of an admitted ticket and start the next turns"""
+        with self._lock:
+            self._active -= 1
+            self._running.discard(ticket.session_id)
+            duration = time.monotonic() - ticket.admitted_at
+            self.service_time = 0.8 * self.service_time + 0.2 * duration
+            queue = self._sessions.get(ticket.session_id)
+            if queue:
+                # Back of the line, behind sessions that have been waiting
+                self._ready.append(queue[0])
+            woken = self._dispatch()
+        self._wake(woken)
+
+    def _wake(self, tickets):
+        for ticket in tickets:
+            ticket.wakeup()
+
+    def _timed_out(self, ticket):
+        return self._reject('timeout', 503, self.service_time,
+                            f"no slot for session {ticket.session_id} within {self.max_wait:.1f}s")
+
+    def acquire(self, session_id):
+        """Wait for a slot for one turn of `session_id`; returns the ticket to pass to `release`"""
+        events = []
+
+        def wakeup_factory():
+            event = threading.Event()
+            events.append(event)
+            return event.set
+
+        ticket = self._enter(session_id, wakeup_factory)
+        if not ticket.granted:
+            events[0].wait(self.max_wait)
+            if not self._abandon(ticket):
+                raise self._timed_out(ticket)
+        observe_stage('admission_wait', ticket.admitted_at - ticket.enqueued_at)
+        return ticket
+
+    async def acquire_async(self, session_id):
+        """Coroutine version of `acquire`"""
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        def wakeup_factory():
+            future = loop.create_future()
+            futures.append(future)
+            return lambda: loop.call_soon_threadsafe(_resolve, future)
+
+        ticket = self._enter(session_id, wakeup_factory)
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(futures[0], self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # Cancelled (e.g. the client went away): give the slot back
+                if self._abandon(ticket):
+                    self.release(ticket)
+                raise
+            if not self._abandon(ticket):
+                raise self._timed_out(ticket)
+        observe_stage('admission_wait', ticket.admitted_at - ticket.enqueued_at)
+        return ticket
+
+    @contextmanager
+    def admit(self, session_id):
+        ticket = self.acquire(session_id)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def admit_async(self, session_id):
+        ticket = await self.acquire_async(session_id)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self._active,
+                'queued': self._waiting,
+                'estimated_wait': round(self.estimated_wait(), 3),
+                'service_time': round(self.service_time, 3)
+            }
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+admission_controller = AdmissionController(
+    max_concurrent=int(os.getenv('ADMISSION_MAX_CONCURRENT', 64)),
+    max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', 256)),
+    max_wait=float(os.getenv('ADMISSION_MAX_WAIT', 10)),
+    max_session_queue=int(os.getenv('ADMISSION_SESSION_QUEUE', 1))
+) if os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true' else None
+
+if admission_controller is not None:
+    registry.gauge_callback('torko_admission_active', 'Chat turns currently admitted',
+                            lambda: admission_controller.stats()['active'])
+    registry.gauge_callback('torko_admission_queued', 'Chat turns waiting for admission',
+                            lambda: admission_controller.stats()['queued'])
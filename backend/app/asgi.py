@@ -0,0 +1,368 @@
+import json
+import asyncio
+import logging
+from contextlib import nullcontext
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from . import create_app
+from . import metrics
+from .async_services import async_chat_service
+from .admission import admission_controller, AdmissionRejected, rejection_body
+from .warmup import warmup
+from .export import HistoryExport, export_authorized
+from .fast_json import dumps as fast_dumps
+
+logger = logging.getLogger(__name__)
+
+ERROR_RESPONSE = 'I apologize, but I encountered an error while processing your request. Please try again in a moment.'
+
+class ASGIApp:
+    """ASGI entry point that serves the chat API as coroutines.
+
+    `POST /api/chat`, `POST /api/chat/stream`, `POST /api/chat/batch`,
+    `GET /api/history`, `GET /api/history/export` and `POST /api/session`
+    are handled here with non-blocking I/O, so waiting on Gemini (or on a
+    long export) does not hold a worker thread. The React build is sent from the
+    Flask app's in-memory `static_assets`. Every other request (CORS
+    preflights, health, metrics) is passed to the Flask app, which remains
+    the complete sync implementation.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.fallback = WsgiToAsgi(flask_app)
+        self.routes = {
+            ('POST', '/api/chat'): self.chat,
+            ('POST', '/api/chat/stream'): self.chat_stream,
+            ('POST', '/api/chat/batch'): self.chat_batch,
+            ('GET', '/api/history'): self.history,
+            ('GET', '/api/history/export'): self.export_history,
+            ('POST', '/api/session'): self.create_session,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            handler = self.routes.get((scope['method'], scope['path'].rstrip('/') or '/'))
+            if handler is not None:
+                await handler(scope, receive, send)
+                return
+            if scope['method'] in ('GET', 'HEAD') and not scope['path'].startswith('/api/'):
+                await self.static(scope, send)
+                return
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        warm_task = None
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Startup completes at once; readiness is reported by /api/ready
+                warmup.start()
+                warm_task = asyncio.create_task(warmup.warm_async_llm())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if warm_task is not None:
+                    warm_task.cancel()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def static(self, scope, send):
+        """Same responses as the Flask `serve_react_app` route, without the WSGI thread hop"""
+        request_headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                           for name, value in scope['headers']}
+        result = self.flask_app.static_assets.respond(
+            scope['path'],
+            accept_encoding=request_headers.get('accept-encoding'),
+            if_none_match=request_headers.get('if-none-match')
+        )
+        if result is None:
+            status, headers, body = 404, {'Content-Type': 'text/plain; charset=utf-8'}, b'Not Found'
+            headers['Content-Length'] = str(len(body))
+        else:
+            status, headers, body = result
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode(), value.encode('latin-1')) for name, value in headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+
+    def _dumps(self, data):
+        # Flask's encoder, so dates and the like come out exactly as in the sync routes
+        return self.flask_app.json.dumps(data, separators=(',', ':'))
+
+    async def _read_json(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        try:
+            return json.loads(body) if body else None
+        except ValueError:
+            return None
+
+    async def _send_json(self, send, data, status=200, headers=None):
+        await self._send_body(send, self._dumps(data).encode('utf-8'), status, headers)
+
+    async def _send_body(self, send, body, status=200, headers=None):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': self._headers('application/json', headers) + [(b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _headers(self, content_type, extra=None):
+        headers = [
+            (b'content-type', content_type.encode()),
+            (b'access-control-allow-origin', b'*'),
+        ]
+        for name, value in (extra or {}).items():
+            headers.append((name.lower().encode(), str(value).encode('latin-1')))
+        return headers
+
+    def _admitted(self, session_id):
+        return admission_controller.admit_async(session_id) if admission_controller is not None else nullcontext()
+
+    def _timing_headers(self, headers=None):
+        """`headers` plus Server-Timing for the turn's stages so far; ends the trace"""
+        headers = dict(headers or {})
+        timing = metrics.server_timing()
+        if timing:
+            headers['Server-Timing'] = timing
+        return headers
+
+    async def _send_rejected(self, send, error, session_id):
+        await self._send_json(send, rejection_body(error, session_id), error.status,
+                              headers=self._timing_headers({'Retry-After': error.retry_after}))
+
+    async def _validate(self, receive, send):
+        """Read {message, session_id} from the request; sends a 400 and returns None if invalid"""
+        data = await self._read_json(receive) or {}
+        if not data.get('message'):
+            logger.warning("No message provided in request")
+            await self._send_json(send, {'error': 'Message is required'}, 400)
+            return None
+        if not data.get('session_id'):
+            logger.warning("No session_id provided in request")
+            await self._send_json(send, {'error': 'Session ID is required'}, 400)
+            return None
+        return data
+
+    async def chat(self, scope, receive, send):
+        data = await self._validate(receive, send)
+        if data is None:
+            return
+        try:
+            metrics.start_trace()
+            with metrics.stage_timer('total'):
+                async with self._admitted(data['session_id']):
+                    response = await async_chat_service.process_message(data['message'], data['session_id'])
+        except AdmissionRejected as e:
+            await self._send_rejected(send, e, data['session_id'])
+            return
+        except Exception as e:
+            logger.error("Error in chat endpoint: %s", e)
+            await self._send_json(send, {
+                'error': 'An unexpected error occurred. Please try again.',
+                'response': ERROR_RESPONSE,
+                'session_id': data['session_id']
+            }, 500, headers=self._timing_headers())
+            return
+        await self._send_json(send, response, headers=self._timing_headers())
+
+    async def chat_stream(self, scope, receive, send):
+        """Same SSE protocol as the Flask `/api/chat/stream` route"""
+        data = await self._validate(receive, send)
+        if data is None:
+            return
+        session_id = data['session_id']
+
+        metrics.start_trace()
+        try:
+            ticket = await admission_controller.acquire_async(session_id) if admission_controller is not None else None
+        except AdmissionRejected as e:
+            await self._send_rejected(send, e, session_id)
+            return
+        try:
+            await self._stream_turn(receive, send, data['message'], session_id)
+        finally:
+            # The turn holds its slot until the stream is finished or abandoned
+            if ticket is not None:
+                admission_controller.release(ticket)
+
+    async def _stream_turn(self, receive, send, message, session_id):
+        chunks = async_chat_service.stream_message(message, session_id)
+        try:
+            with metrics.stage_timer('first_chunk'):
+                first_chunk = await anext(chunks, '')
+        except Exception as e:
+            logger.error("Error in chat stream endpoint: %s", e)
+            await chunks.aclose()
+            await self._send_json(send, {
+                'error': 'An unexpected error occurred. Please try again.',
+                'response': ERROR_RESPONSE,
+                'session_id': session_id
+            }, 500, headers=self._timing_headers())
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': self._headers('text/event-stream', self._timing_headers({
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }))
+        })
+
+        # Stop relaying (and let the service save what was streamed) as
+        # soon as the client goes away
+        disconnected = asyncio.create_task(self._wait_for_disconnect(receive))
+        try:
+            await self._send_event(send, {'delta': first_chunk})
+            async for chunk in chunks:
+                if disconnected.done():
+                    logger.debug("Client disconnected from stream for session %s", session_id)
+                    return
+                await self._send_event(send, {'delta': chunk})
+            await self._send_event(send, {'session_id': session_id}, event='done')
+        except Exception as e:
+            logger.error("Error while streaming chat response: %s", e)
+            await self._send_event(send, {'error': 'The response stream was interrupted.'}, event='error')
+        finally:
+            disconnected.cancel()
+            await chunks.aclose()
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def chat_batch(self, scope, receive, send):
+        """Same NDJSON protocol as the Flask `/api/chat/batch` route"""
+        data = await self._read_json(receive) or {}
+        results = async_chat_service.process_batch(data.get('items'), data.get('max_workers'))
+        try:
+            first_result = await anext(results)
+        except ValueError as e:
+            await self._send_json(send, {'error': str(e)}, 400)
+            return
+        except Exception as e:
+            logger.error("Error in chat batch endpoint: %s", e)
+            await self._send_json(send, {'error': 'An unexpected error occurred. Please try again.'}, 500)
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': self._headers('application/x-ndjson', {
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+        })
+        disconnected = asyncio.create_task(self._wait_for_disconnect(receive))
+        try:
+            await self._send_line(send, first_result)
+            async for result in results:
+                if disconnected.done():
+                    logger.debug("Client disconnected from batch results")
+                    return
+                await self._send_line(send, result)
+        finally:
+            disconnected.cancel()
+            await results.aclose()
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def _send_line(self, send, data):
+        await send({
+            'type': 'http.response.body',
+            'body': (json.dumps(data) + '\n').encode('utf-8'),
+            'more_body': True
+        })
+
+    async def _wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _send_event(self, send, data, event=None):
+        prefix = f"event: {event}\n" if event else ""
+        await send({
+            'type': 'http.response.body',
+            'body': f"{prefix}data: {json.dumps(data)}\n\n".encode('utf-8'),
+            'more_body': True
+        })
+
+    async def history(self, scope, receive, send):
+        args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        try:
+            history = await async_chat_service.get_chat_history(
+                args.get('session_id'),
+                before=args.get('before'),
+                after=args.get('after'),
+                since=args.get('since'),
+                limit=args.get('limit')
+            )
+            await self._send_body(send, fast_dumps(history))
+        except ValueError as e:
+            await self._send_json(send, {'error': str(e)}, 400)
+        except Exception as e:
+            await self._send_json(send, {'error': str(e)}, 500)
+
+    async def export_history(self, scope, receive, send):
+        """Same export as the Flask `/api/history/export` route, read with the async driver"""
+        authorization = next((value.decode('latin-1') for name, value in scope['headers']
+                              if name == b'authorization'), None)
+        if not export_authorized(authorization):
+            await self._send_json(send, {'error': 'Not authorized'}, 403)
+            return
+        args = parse_qs(scope['query_string'].decode('latin-1'))
+        try:
+            export = HistoryExport.from_args(
+                args.get('session_id'),
+                start=args.get('start', [None])[0],
+                end=args.get('end', [None])[0],
+                compress=args.get('gzip', ['true'])[0].lower() != 'false'
+            )
+        except ValueError as e:
+            await self._send_json(send, {'error': str(e)}, 400)
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': self._headers(export.content_type, {
+                'Content-Disposition': f'attachment; filename="{export.filename}"',
+                'Cache-Control': 'no-store',
+                'X-Accel-Buffering': 'no'
+            })
+        })
+        # Stop reading the database as soon as the client goes away
+        disconnected = asyncio.create_task(self._wait_for_disconnect(receive))
+        chunks = export.chunks_async()
+        try:
+            async for chunk in chunks:
+                if disconnected.done():
+                    logger.info("Client disconnected from history export")
+                    return
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        except Exception as e:
+            # Too late for an error status; the truncated gzip stream fails to decompress
+            logger.error("Error while streaming history export: %s", e)
+        finally:
+            disconnected.cancel()
+            await chunks.aclose()
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def create_session(self, scope, receive, send):
+        try:
+            session_id = async_chat_service.create_session()
+            await self._send_json(send, {'session_id': session_id})
+        except Exception as e:
+            logger.error("Error creating session: %s", e)
+            await self._send_json(send, {'error': str(e)}, 500)
+
+def create_asgi_app():
+    return ASGIApp(create_app())
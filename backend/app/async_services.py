@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import httpx
+from .models import Message, SessionSummary
+from .context_builder import context_builder
+from .response_cache import response_cache
+from .metrics import stage_timer, UPSTREAM_RESPONSES, RETRIES, HEDGES
+from .llm_client import async_llm_client
+from .rate_limiter import PRIORITY_NORMAL
+from .llm_router import FakeUpstreamError
+from .services import ChatService
+from .context_cache import context_cache, payload_tokens
+from . import flows
+
+logger = logging.getLogger(__name__)
+
+_batch_tasks = set()
+
+class AsyncChatService(ChatService):
+    """ChatService for the ASGI path: the same flows, with coroutines for I/O.
+
+    `process_message` and `get_chat_history` return coroutines, and
+    `stream_message` and `process_batch` async generators. The turn logic
+    (retries, failover, deadlines, fallbacks, batches) is ChatService's;
+    only the I/O steps are overridden here: upstream calls go through
+    `async_llm_client`, MongoDB through motor, and backoff and quota waits
+    use asyncio sleeps, so a waiting request costs a coroutine instead of a
+    worker thread.
+    """
+
+    client = async_llm_client
+    stream_errors = httpx.HTTPError
+
+    def _run(self, flow):
+        return flows.run_async(flow, self)
+
+    def _stream(self, flow):
+        return flows.stream_async(flow, self)
+
+    async def process_batch(self, items, max_workers=None):
+        """Async generator version of ChatService.process_batch; sessions run as tasks"""
+        sessions, workers = self._plan_batch(items, max_workers)
+        results = asyncio.Queue()
+        slots = asyncio.Semaphore(workers)
+        abandoned = False
+
+        async def run(session_id, turns):
+            async with slots:
+                if abandoned:
+                    return
+                await self._run(self._run_batch_session(session_id, turns, results.put_nowait))
+
+        for session_id, turns in sessions.items():
+            # Referenced until done, so sessions outlive a client that disconnects
+            task = asyncio.create_task(run(session_id, turns))
+            _batch_tasks.add(task)
+            task.add_done_callback(_batch_tasks.discard)
+        counts = {'items': 0, 'errors': 0}
+        remaining = len(sessions)
+        try:
+            while remaining:
+                result = await results.get()
+                if result is None:  # A session finished
+                    remaining -= 1
+                    continue
+                yield self._count_batch_result(counts, result)
+            yield {'done': True, **counts}
+        finally:
+            # Sessions not started yet are dropped; running ones finish and save
+            abandoned = True
+
+    async def _build_context(self, session_id):
+        return await context_builder.build_async(session_id)
+
+    async def _save(self, message):
+        await Message.save_async(message)
+
+    async def _save_batch(self, session_id, documents, summary, folded_until):
+        await Message.save_many_async(documents)
+        if folded_until is not None:
+            await SessionSummary.save_async(session_id, summary, folded_until)
+
+    async def _get_messages(self, session_id):
+        return await Message.get_by_session_async(session_id)
+
+    async def _get_page(self, session_id, before, after, limit):
+        return await Message.get_page_async(session_id, before, after, limit)
+
+    async def _acquire_quota(self, payload, priority=PRIORITY_NORMAL, deadline=None, exclude=()):
+        tokens = payload_tokens(payload)
+        with stage_timer('rate_limit_wait'):
+            return await self.router.acquire_async(tokens, priority=priority,
+                                                   timeout=self._quota_timeout(deadline), exclude=exclude)
+
+    async def _prepare_context_cache(self, session_id, payload, deadline):
+        async def create(url, body):
+            response = await self._post_upstream(url, **self._cache_request(body, deadline))
+            return response.json()
+
+        return await context_cache.prepare_async(session_id, self.model, payload, create)
+
+    async def _post_upstream(self, url, **kwargs):
+        try:
+            with stage_timer('upstream'):
+                response = await self.client.post(url, **kwargs)
+        except httpx.HTTPError:
+            UPSTREAM_RESPONSES.inc(status='error')
+            raise
+        UPSTREAM_RESPONSES.inc(status=response.status_code)
+        if response.is_error:
+            await response.aclose()
+        response.raise_for_status()
+        return response
+
+    async def _backoff(self, delay):
+        RETRIES.inc()
+        with stage_timer('backoff'):
+            await asyncio.sleep(delay)
+
+    async def _cached_response(self, cache_key, request):
+        return await response_cache.get_or_compute_async(cache_key, lambda: self._run(request))
+
+    async def _call(self, provider, payload, deadline):
+        if provider.kind == 'fake':
+            with stage_timer('upstream'):
+                return await self._fake_reply(provider, payload, deadline.timeout(self.client.total_timeout))
+        url, kwargs = self._upstream_request(provider, payload, deadline)
+        response = await self._post_upstream(url, **kwargs)
+        return provider.parse(response.json())
+
+    async def _fake_reply(self, provider, payload, timeout):
+        delay = provider.delay()
+        await asyncio.sleep(min(delay, timeout))
+        if delay > timeout:
+            raise FakeUpstreamError(None, f"Fake upstream {provider.name} timed out")
+        return provider.reply(payload)
+
+    async def _fake_stream(self, provider, payload, timeout):
+        for chunk in provider.chunks(await self._fake_reply(provider, payload, timeout)):
+            yield chunk
+
+    async def _hedged_attempt(self, provider, payload, deadline, hedge_delay):
+        """See ChatService._hedged_attempt; here the slower request is cancelled"""
+        primary = asyncio.ensure_future(self._run(self._attempt(provider, payload, deadline)))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        if await provider.rate_limiter.try_acquire_async(payload_tokens(payload)) > 0:
+            HEDGES.inc(outcome='skipped')
+            return await primary
+
+        HEDGES.inc(outcome='sent')
+        logger.info("AI request slower than %.2fs, sending a hedged request", hedge_delay)
+        hedge = asyncio.ensure_future(self._run(self._attempt(provider, payload, deadline)))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            HEDGES.inc(outcome='won')
+                        return task.result()
+            # Both failed; the primary's error decides whether to retry
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _open_stream(self, provider, payload, deadline):
+        if provider.kind == 'fake':
+            return self._fake_stream(provider, payload, deadline.timeout(self.client.read_timeout)), None
+        url, kwargs = self._upstream_request(provider, payload, deadline, stream=True)
+        response = await self._post_upstream(url, **kwargs)
+        return self._iter_stream_text(provider, response), response
+
+    async def _next_chunk(self, chunks):
+        return await anext(chunks, None)
+
+    async def _close_stream(self, chunks, response):
+        if chunks is not None:
+            await chunks.aclose()
+        if response is not None:
+            await response.aclose()
+
+    async def _cache_get(self, cache_key):
+        return await response_cache.get_async(cache_key)
+
+    async def _cache_set(self, cache_key, response):
+        await response_cache.set_async(cache_key, response)
+
+    async def _iter_stream_text(self, provider, response):
+        async for line in self.client.iter_lines(response):
+            chunks = self._stream_text(provider, line)
+            if chunks is None:
+                break
+            for chunk in chunks:
+                yield chunk
+
+async_chat_service = AsyncChatService()
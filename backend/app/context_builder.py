@@ -0,0 +1,138 @@
+import os
+import re
+import logging
+from dotenv import load_dotenv
+from .models import Message, SessionSummary
+from .rate_limiter import estimate_tokens
+from .context_cache import context_cache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class ContextBuilder:
+    """Builds token-budgeted conversation context for a session.
+
+    The most recent messages are kept verbatim. When they no longer fit the
+    budget, the oldest ones are folded into a rolling per-session summary
+    (stored in `session_summaries`) and only messages newer than the summary
+    are read on later turns, so the work per turn stays bounded instead of
+    growing with the length of the conversation.
+
+    With `fold_tokens`, a fold frees that many tokens below the budget
+    rather than just enough for this turn, so the summary and the oldest
+    recent messages stay unchanged for the next few turns. The Gemini
+    context cache relies on that: it can only reuse a prefix that does not
+    change from one turn to the next.
+    """
+
+    def __init__(self, token_budget=3000, summary_budget=500, min_recent_messages=4,
+                 summary_line_chars=200, fold_tokens=0):
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.min_recent_messages = min_recent_messages
+        self.summary_line_chars = summary_line_chars
+        self.fold_tokens = fold_tokens
+
+    def build(self, session_id):
+        """Return (summary, recent_messages) for the session"""
+        summary_doc = SessionSummary.get(session_id)
+        if summary_doc:
+            recent = Message.get_since(
+                session_id,
+                summary_doc['summarized_until'],
+                summary_doc.get('summarized_until_id')
+            )
+        else:
+            recent = Message.get_since(session_id)
+
+        summary, recent, folded = self._fold(session_id, summary_doc, recent)
+        if folded:
+            SessionSummary.save(session_id, summary, folded[-1])
+        return summary, recent
+
+    async def build_async(self, session_id):
+        """Coroutine version of `build` for the ASGI path"""
+        summary_doc = await SessionSummary.get_async(session_id)
+        if summary_doc:
+            recent = await Message.get_since_async(
+                session_id,
+                summary_doc['summarized_until'],
+                summary_doc.get('summarized_until_id')
+            )
+        else:
+            recent = await Message.get_since_async(session_id)
+
+        summary, recent, folded = self._fold(session_id, summary_doc, recent)
+        if folded:
+            await SessionSummary.save_async(session_id, summary, folded[-1])
+        return summary, recent
+
+    def extend(self, session_id, summary, recent, messages):
+        """Context for the next turn once `messages` follow (summary, recent), without a database read.
+
+        Returns (summary, recent_messages, folded_messages); the caller saves
+        the summary if anything was folded."""
+        return self._fold(session_id, {'summary': summary} if summary else None, recent + messages)
+
+    def _fold(self, session_id, summary_doc, recent):
+        """Fold the oldest messages into the summary until the rest fits.
+
+        Returns (summary, recent_messages, folded_messages)."""
+        summary = summary_doc['summary'] if summary_doc else ''
+        recent_budget = self.token_budget - self.summary_budget
+        recent_tokens = [estimate_tokens(msg['content']) for msg in recent]
+        total = sum(recent_tokens)
+        target = max(recent_budget - self.fold_tokens, 0) if total > recent_budget else recent_budget
+        fold_count = 0
+        while total > target and len(recent) - fold_count > self.min_recent_messages:
+            total -= recent_tokens[fold_count]
+            fold_count += 1
+
+        folded = recent[:fold_count]
+        if fold_count:
+            recent = recent[fold_count:]
+            summary = self._extend_summary(summary, folded)
+            logger.debug("Folded %d messages into summary", fold_count, extra={'session_id': session_id})
+
+        return summary, recent, folded
+
+    def _extend_summary(self, summary, messages):
+        """Append condensed lines for `messages`, dropping the oldest lines over budget"""
+        lines = summary.split('\n') if summary else []
+        for msg in messages:
+            speaker = 'User' if msg['sender'] == 'user' else 'Torko'
+            lines.append(f"{speaker}: {self._condense(msg['content'])}")
+
+        tokens = [estimate_tokens(line) for line in lines]
+        total = sum(tokens)
+        start = 0
+        while total > self.summary_budget and start < len(lines) - 1:
+            total -= tokens[start]
+            start += 1
+        return '\n'.join(lines[start:])
+
+    def _condense(self, text):
+        """First sentence of a message, capped to a fixed length"""
+        text = ' '.join(text.split())
+        first_sentence = re.split(r'(?<=[.!?])\s', text, maxsplit=1)[0]
+        if len(first_sentence) > self.summary_line_chars:
+            first_sentence = first_sentence[:self.summary_line_chars].rstrip() + '...'
+        return first_sentence
+
+_token_budget = int(os.getenv('CONTEXT_TOKEN_BUDGET', 3000))
+_summary_budget = int(os.getenv('CONTEXT_SUMMARY_BUDGET', 500))
+
+context_builder = ContextBuilder(
+    token_budget=_token_budget,
+    summary_budget=_summary_budget,
+    min_recent_messages=int(os.getenv('CONTEXT_MIN_RECENT_MESSAGES', 4)),
+    # With the context cache on, fold half the recent budget at a time so cached prefixes last a few turns
+    fold_tokens=int(os.getenv('CONTEXT_FOLD_TOKENS',
+                              (_token_budget - _summary_budget) // 2 if context_cache is not None else 0))
+)
+
+if context_cache is not None and _token_budget < context_cache.min_tokens:
+    logger.warning("CONTEXT_TOKEN_BUDGET (%d) is below GEMINI_CONTEXT_CACHE_MIN_TOKENS (%d); "
+                   "prompts rarely grow long enough for the context cache to be used",
+                   _token_budget, context_cache.min_tokens)
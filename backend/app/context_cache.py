@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from .rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+def payload_tokens(payload):
+    """Approximate prompt tokens of a generateContent payload, including the system instruction"""
+    texts = [part.get('text', '') for part in (payload.get('systemInstruction') or {}).get('parts', [])]
+    for content in payload.get('contents', []):
+        texts.extend(part.get('text', '') for part in content['parts'])
+    return sum(estimate_tokens(text) for text in texts)
+
+class ContextCache:
+    """Per-session handles to Gemini explicit context caches (`cachedContents`).
+
+    Once the stable part of a session's prompt (system instruction plus all
+    earlier turns) reaches `min_tokens`, it is uploaded once as a cached
+    content and later turns send only the reference and the turns added
+    since. The handle is dropped when it expires, when the prefix changes
+    (e.g. older turns were folded into the summary) or when Gemini rejects
+    it, and a new cache is created once the uncached tail has grown by
+    another `min_tokens`. A cache is only created when the previous turn's
+    prefix is still the start of this one: a session whose summary changes
+    every turn would otherwise upload a cache per turn and never reuse one.
+    Handles are kept in worker memory, like the conversation cache; caches
+    this worker loses track of expire on their own after `ttl` seconds.
+    """
+
+    def __init__(self, api_base, min_tokens=4096, ttl=600, max_sessions=10000, clock=time.time):
+        self.url = f"{api_base}/cachedContents"
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._entries = OrderedDict()  # session_id -> {name, length, digest, expires_at}
+        self._prefixes = OrderedDict()  # session_id -> (length, digest) of the last turn's prefix
+        self._lock = threading.Lock()
+        self.created = 0
+        self.used = 0
+        self.failed = 0
+
+    def _digest(self, contents):
+        serialized = json.dumps(contents, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _lookup(self, session_id, contents):
+        """The live entry whose cached prefix is still the start of `contents`, or None"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            # Leave a margin so the cache does not expire between here and Gemini
+            if entry['expires_at'] - 30 <= self.clock():
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+        if len(contents) <= entry['length'] or self._digest(contents[:entry['length']]) != entry['digest']:
+            return None
+        return entry
+
+    def _extends_last_prefix(self, session_id, prefix):
+        """Remember this turn's prefix; True if the previous turn's is still the start of it"""
+        digest = self._digest(prefix)
+        with self._lock:
+            last = self._prefixes.get(session_id)
+            self._prefixes[session_id] = (len(prefix), digest)
+            self._prefixes.move_to_end(session_id)
+            while len(self._prefixes) > self.max_sessions:
+                self._prefixes.popitem(last=False)
+        if last is None or len(prefix) < last[0]:
+            return False
+        return (digest if len(prefix) == last[0] else self._digest(prefix[:last[0]])) == last[1]
+
+    def _plan(self, session_id, model, payload):
+        """Body of a cachedContents request worth making for this payload, or None"""
+        prefix = payload['contents'][:-1]
+        if not self._extends_last_prefix(session_id, prefix):
+            return None
+        if not prefix or payload_tokens(dict(payload, contents=prefix)) < self.min_tokens:
+            return None
+        entry = self._lookup(session_id, payload['contents'])
+        if entry is not None:
+            uncached = {'contents': payload['contents'][entry['length']:-1]}
+            if payload_tokens(uncached) < self.min_tokens:
+                return None
+        body = {
+            'model': f"models/{model}",
+            'contents': prefix,
+            'ttl': f"{self.ttl}s"
+        }
+        if payload.get('systemInstruction'):
+            body['systemInstruction'] = payload['systemInstruction']
+        return body
+
+    def _record(self, session_id, body, result):
+        with self._lock:
+            self._entries[session_id] = {
+                'name': result['name'],
+                'length': len(body['contents']),
+                'digest': self._digest(body['contents']),
+                'expires_at': self.clock() + self.ttl
+            }
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+            self.created += 1
+        logger.debug("Created context cache %s for session %s (%d contents)",
+                     result['name'], session_id, len(body['contents']))
+
+    def _apply(self, session_id, payload):
+        """Rewrite `payload` to reference the session's cache, if one covers its prefix"""
+        entry = self._lookup(session_id, payload['contents'])
+        if entry is None:
+            return payload
+        with self._lock:
+            self.used += 1
+        cached = {key: value for key, value in payload.items() if key not in ('systemInstruction', 'contents')}
+        cached['cachedContent'] = entry['name']
+        cached['contents'] = payload['contents'][entry['length']:]
+        return cached
+
+    def _failed(self, session_id, error):
+        with self._lock:
+            self.failed += 1
+        logger.error("Error creating context cache for session %s: %s", session_id, error)
+
+    def prepare(self, session_id, model, payload, create):
+        """Payload to send for this turn; `create(url, body)` uploads a new cache and returns its JSON"""
+        body = self._plan(session_id, model, payload)
+        if body is not None:
+            try:
+                self._record(session_id, body, create(self.url, body))
+            except Exception as e:
+                self._failed(session_id, e)
+        return self._apply(session_id, payload)
+
+    async def prepare_async(self, session_id, model, payload, create):
+        """Coroutine version of `prepare`; `create` is a coroutine function"""
+        body = self._plan(session_id, model, payload)
+        if body is not None:
+            try:
+                self._record(session_id, body, await create(self.url, body))
+            except Exception as e:
+                self._failed(session_id, e)
+        return self._apply(session_id, payload)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._entries),
+                'created': self.created,
+                'used': self.used,
+                'failed': self.failed
+            }
+
+context_cache = ContextCache(
+    os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta').rstrip('/'),
+    min_tokens=int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', 4096)),
+    ttl=int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', 600)),
+    max_sessions=int(os.getenv('GEMINI_CONTEXT_CACHE_MAX_SESSIONS', 10000))
+) if os.getenv('GEMINI_CONTEXT_CACHE', 'false').lower() == 'true' else None
@@ -0,0 +1,151 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+def message_cursor(message):
+    """Sort key of a stored message: (timestamp, _id)"""
+    return (message['timestamp'], message.get('_id'))
+
+def is_after(cursor, after):
+    """Whether message cursor `cursor` comes after `after`; a None `_id` in either
+    compares on the timestamp alone"""
+    if cursor[0] != after[0]:
+        return cursor[0] > after[0]
+    if cursor[1] is None or after[1] is None:
+        return False
+    return cursor[1] > after[1]
+
+class ConversationCache:
+    """In-process, write-through cache of recent conversation messages.
+
+    Each entry holds the messages of one session from some starting point
+    onwards (`start` is None when the whole session is cached). `Message.save`
+    appends to existing entries, so a worker serving a session keeps reading
+    its own writes without going back to MongoDB. Memory is bounded by a
+    total message count with LRU eviction, and idle sessions expire after
+    `ttl` seconds.
+
+    A worker only sees its own writes, so entries are only correct while
+    one worker serves a session. Workers sharing a socket (gunicorn with
+    more than one worker) get no such guarantee, which is why the cache is
+    off unless CONVERSATION_CACHE_ENABLED=true: set it only for a single
+    worker or behind sticky sessions.
+    """
+
+    def __init__(self, max_messages=20000, ttl=1800, enabled=True, clock=time.monotonic):
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.enabled = enabled
+        self.clock = clock
+        self._entries = OrderedDict()  # session_id -> entry, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, session_id, after=None):
+        """Cached messages newer than cursor `after`, or None on a miss"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and self.clock() - entry['last_access'] > self.ttl:
+                self._remove(session_id)
+                self.expirations += 1
+                entry = None
+            if entry is None or not self._covers(entry['start'], after):
+                self.misses += 1
+                return None
+
+            entry['last_access'] = self.clock()
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            messages = entry['messages']
+            if after is None:
+                return list(messages)
+            return [msg for msg in messages if is_after(message_cursor(msg), after)]
+
+    def put(self, session_id, messages, start=None):
+        """Store messages read from the database, complete from cursor `start` onwards"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+            self._entries[session_id] = {
+                'start': start,
+                'messages': list(messages),
+                'last_access': self.clock()
+            }
+            self._size += len(messages)
+            self._evict()
+
+    def append(self, session_id, message):
+        """Write-through for a newly saved message; only extends sessions already cached"""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            entry['messages'].append(message)
+            entry['last_access'] = self.clock()
+            self._entries.move_to_end(session_id)
+            self._size += 1
+            self._evict()
+
+    def invalidate(self, session_id):
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'sessions': len(self._entries),
+                'messages': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _covers(self, start, after):
+        # An entry starting at `start` can answer "messages after `after`"
+        # if nothing between the two cursors is missing from it
+        if start is None:
+            return True
+        return after is not None and not is_after(start, after)
+
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id)
+        self._size -= len(entry['messages'])
+
+    def _evict(self):
+        now = self.clock()
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if now - entry['last_access'] > self.ttl:
+                self.expirations += 1
+            elif self._size > self.max_messages and len(self._entries) > 1:
+                self.evictions += 1
+            else:
+                break
+            self._remove(session_id)
+
+conversation_cache = ConversationCache(
+    max_messages=int(os.getenv('CONVERSATION_CACHE_MAX_MESSAGES', 20000)),
+    ttl=float(os.getenv('CONVERSATION_CACHE_TTL', 1800)),
+    enabled=os.getenv('CONVERSATION_CACHE_ENABLED', 'false').lower() == 'true'
+)
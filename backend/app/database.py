@@ -1,33 +1,155 @@
 from pymongo import MongoClient
-from datetime import datetime
 import os
 import logging
+import threading
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 client = None
 db = None
+db_pid = None
+async_db = None
+async_db_pid = None
+_lock = threading.Lock()
+
+# URI prefix -> (client factory, async database factory) for stand-ins that
+# are not MongoDB servers
+_client_factories = {}
+
+def register_client(prefix, create_client, create_async_db):
+    """Serve URIs starting with `prefix` without pymongo/motor.
+
+    `create_client(uri)` returns a MongoClient look-alike and
+    `create_async_db(db)` wraps the database from `get_db()` for coroutines.
+    Used by the benchmarks and tests to install an in-process store.
+    """
+    _client_factories[prefix] = (create_client, create_async_db)
+
+def _registered_factories(mongodb_uri):
+    for prefix, factories in _client_factories.items():
+        if mongodb_uri.startswith(prefix):
+            return factories
+    return None
+
+def _database_name(mongodb_uri):
+    # Parse the URI to get the database name
+    parsed_uri = urlparse(mongodb_uri)
+    return parsed_uri.path[1:] if parsed_uri.path else 'chatbot'
+
+def _hosts(mongodb_uri):
+    """The scheme, hosts and database of a URI, for logs (never the credentials or options)"""
+    parsed_uri = urlparse(mongodb_uri)
+    return f"{parsed_uri.scheme}://{parsed_uri.netloc.rpartition('@')[2]}{parsed_uri.path}"
+
+def _create_client(mongodb_uri):
+    """MongoClient for the URI; returns immediately, pymongo connects in the background"""
+    min_pool_size = int(os.getenv('MONGODB_MIN_POOL_SIZE', 2))
+    factories = _registered_factories(mongodb_uri)
+    if factories is not None:
+        return factories[0](mongodb_uri)
+    if mongodb_uri.startswith('mongodb+srv://'):
+        # Cloud MongoDB settings
+        return MongoClient(
+            mongodb_uri,
+            tls=True,
+            tlsAllowInvalidCertificates=True,
+            retryWrites=True,
+            w='majority',
+            serverSelectionTimeoutMS=30000,
+            connectTimeoutMS=30000,
+            socketTimeoutMS=30000,
+            minPoolSize=min_pool_size
+        )
+    # Local MongoDB settings
+    return MongoClient(
+        mongodb_uri,
+        serverSelectionTimeoutMS=5000,
+        connectTimeoutMS=5000,
+        socketTimeoutMS=5000,
+        minPoolSize=min_pool_size
+    )
 
 def init_db():
-    global client, db
+    """Connect in this process and wait until MongoDB answers (blocking; see `get_db`)"""
     try:
-        mongodb_uri = os.getenv('MONGODB_URI')
-        logger.debug(f"Connecting to MongoDB at: {mongodb_uri}")
-        
-        # Parse the URI to get the database name
-        parsed_uri = urlparse(mongodb_uri)
-        db_name = parsed_uri.path[1:] if parsed_uri.path else 'chatbot'
-        
-        # Configure connection settings
+        ping()
+        ensure_indexes(get_db())
+    except Exception as e:
+        logger.error("Error connecting to MongoDB: %s", e)
+        raise
+
+def ping():
+    """Round trip to the server; raises if it cannot be reached within the selection timeout"""
+    get_db()
+    client.server_info()
+
+def ensure_indexes(database):
+    """Create the indexes the app's queries rely on (a no-op when they exist)"""
+    try:
+        # Imported here: the message store itself uses get_db()
+        from .message_store import message_store
+        message_store.ensure_indexes(database)
+        database.session_summaries.create_index('session_id', unique=True, name='session_id_unique')
+        logger.debug("MongoDB indexes ensured")
+    except Exception as e:
+        # The app still works without them, only slower
+        logger.error("Error creating MongoDB indexes: %s", e)
+
+def get_db():
+    """Database handle for the current process, created on first use.
+
+    Creating it does not wait for the server, so importing and starting the
+    app stays fast even when MongoDB is slow or down; the first query (or
+    `ping()` from the warmup) waits instead. After a fork the child creates
+    its own client, as pymongo requires.
+    """
+    global client, db, db_pid
+    if db is not None and db_pid == os.getpid():
+        return db
+    with _lock:
+        if db is None or db_pid != os.getpid():
+            mongodb_uri = os.getenv('MONGODB_URI')
+            logger.debug("Creating MongoDB client for %s (pid %d)", _hosts(mongodb_uri), os.getpid())
+            client = _create_client(mongodb_uri)
+            db = client[_database_name(mongodb_uri)]
+            db_pid = os.getpid()
+    return db
+
+def reset_after_fork():
+    """Forget the parent's clients in a forked child (without closing their sockets)"""
+    global client, db, db_pid, async_db, async_db_pid, _lock
+    client = db = db_pid = None
+    async_db = async_db_pid = None
+    _lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def get_async_db():
+    """Database handle for coroutines (motor), created on first use in each process.
+
+    For a URI served by `register_client` this wraps the database from
+    `get_db()`, so the sync and async paths of a worker see the same data.
+    """
+    global async_db, async_db_pid
+    if async_db is not None and async_db_pid == os.getpid():
+        return async_db
+
+    mongodb_uri = os.getenv('MONGODB_URI')
+    db_name = _database_name(mongodb_uri)
+    min_pool_size = int(os.getenv('MONGODB_MIN_POOL_SIZE', 2))
+
+    factories = _registered_factories(mongodb_uri)
+    if factories is not None:
+        async_db = factories[1](get_db())
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
         if mongodb_uri.startswith('mongodb+srv://'):
-            # Cloud MongoDB settings
-            client = MongoClient(
+            async_client = AsyncIOMotorClient(
                 mongodb_uri,
                 tls=True,
                 tlsAllowInvalidCertificates=True,
@@ -35,29 +157,21 @@ def init_db():
                 w='majority',
                 serverSelectionTimeoutMS=30000,
                 connectTimeoutMS=30000,
-                socketTimeoutMS=30000
+                socketTimeoutMS=30000,
+                minPoolSize=min_pool_size
             )
         else:
-            # Local MongoDB settings
-            client = MongoClient(
+            async_client = AsyncIOMotorClient(
                 mongodb_uri,
                 serverSelectionTimeoutMS=5000,
                 connectTimeoutMS=5000,
-                socketTimeoutMS=5000
+                socketTimeoutMS=5000,
+                minPoolSize=min_pool_size
             )
-        
-        # Test the connection
-        client.server_info()
-        db = client[db_name]
-        logger.debug(f"Successfully connected to MongoDB database: {db_name}")
-    except Exception as e:
-        logger.error(f"Error connecting to MongoDB: {str(e)}")
-        raise
-
-def get_db():
-    if db is None:
-        init_db()
-    return db
+        async_db = async_client[db_name]
+        logger.debug("Created async MongoDB client for database: %s", db_name)
+    async_db_pid = os.getpid()
+    return async_db
 
 def close_db():
     if client is not None:
@@ -65,5 +179,5 @@ def close_db():
             client.close()
             logger.debug("MongoDB connection closed")
         except Exception as e:
-            logger.error(f"Error closing MongoDB connection: {str(e)}")
+            logger.error("Error closing MongoDB connection: %s", e)
             raise 
\ No newline at end of file
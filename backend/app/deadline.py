@@ -0,0 +1,75 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class Deadline:
+    """Time budget for one chat turn, shared by every upstream attempt.
+
+    Attempt timeouts, rate-limit queue waits and backoff sleeps are all cut
+    to what is left, and an attempt is not started at all with less than
+    `min_attempt` seconds remaining, so the fallback response goes out
+    before the client or proxy gives up on the request.
+    """
+
+    def __init__(self, budget, min_attempt=2.0, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + budget
+        self.min_attempt = min_attempt
+
+    @classmethod
+    def start(cls, budget=None):
+        """A deadline with the configured per-turn budget (or `budget` seconds), starting now"""
+        return cls(
+            float(os.getenv('CHAT_DEADLINE_SECONDS', 25)) if budget is None else budget,
+            min_attempt=float(os.getenv('LLM_MIN_ATTEMPT_SECONDS', 2))
+        )
+
+    def remaining(self):
+        return max(0.0, self.expires_at - self.clock())
+
+    def timeout(self, limit):
+        """`limit` seconds, cut down to the remaining budget"""
+        return min(limit, self.remaining())
+
+    def allows_attempt(self, delay=0.0):
+        """Whether an attempt started after `delay` seconds would still have a useful timeout"""
+        return self.remaining() - delay >= self.min_attempt
+
+class LatencyTracker:
+    """Rolling window of successful upstream latencies, for choosing the hedge delay"""
+
+    def __init__(self, window=200, quantile=0.95, min_samples=20, min_delay=1.0):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def hedge_delay(self):
+        """Seconds after which a second attempt should be sent, or None without enough data"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(self.quantile * len(samples)))
+        return max(samples[index], self.min_delay)
+
+upstream_latency = LatencyTracker(
+    window=int(os.getenv('LLM_HEDGE_WINDOW', 200)),
+    quantile=float(os.getenv('LLM_HEDGE_QUANTILE', 0.95)),
+    min_samples=int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20)),
+    min_delay=float(os.getenv('LLM_HEDGE_MIN_DELAY', 1.0))
+)
+
+hedging_enabled = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
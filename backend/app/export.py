@@ -0,0 +1,140 @@
+import os
+import hmac
+import time
+import zlib
+import logging
+from dotenv import load_dotenv
+from .models import parse_timestamp
+from .message_store import message_store
+from .fast_json import dumps_line
+from .metrics import EXPORTED_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Messages fetched per database round trip
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+def export_record(message):
+    """One NDJSON line of an export"""
+    return {
+        'session_id': message['session_id'],
+        'id': str(message['_id']),
+        'sender': message['sender'],
+        'content': message['content'],
+        'timestamp': message['timestamp']
+    }
+
+class NDJSONWriter:
+    """Encodes messages as NDJSON, optionally gzip-compressed, in chunks of about `chunk_bytes`.
+
+    Lines are collected until a chunk is full and then passed through a
+    streaming compressor, so only one chunk and the compressor's window are
+    in memory however long the export runs.
+    """
+
+    def __init__(self, compress=True, chunk_bytes=64 * 1024, level=6):
+        self.chunk_bytes = chunk_bytes
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if compress else None
+        self.buffer = bytearray()
+        self.count = 0
+
+    def write(self, message):
+        """Bytes ready to send after adding `message` (often empty)"""
+        self.buffer += dumps_line(export_record(message))
+        self.count += 1
+        return self._flush() if len(self.buffer) >= self.chunk_bytes else b''
+
+    def _flush(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return self.compressor.compress(data) if self.compressor else data
+
+    def finish(self):
+        """The remaining bytes, including the gzip trailer"""
+        data = self._flush()
+        return data + self.compressor.flush() if self.compressor else data
+
+class HistoryExport:
+    """A bulk export of stored messages as NDJSON, streamed from the database cursor.
+
+    One line per message, `{session_id, id, sender, content, timestamp}`,
+    ordered by session and then chronologically, for the sessions in
+    `session_ids` (all of them when empty) with `start <= timestamp < end`.
+    Messages still waiting in the write-behind queue are not included.
+    """
+
+    def __init__(self, session_ids=None, start=None, end=None, compress=True,
+                 batch_size=EXPORT_BATCH_SIZE, chunk_bytes=64 * 1024, store=message_store):
+        self.session_ids = session_ids or None
+        self.start = start
+        self.end = end
+        self.compress = compress
+        self.batch_size = batch_size
+        self.chunk_bytes = chunk_bytes
+        self.store = store
+
+    @classmethod
+    def from_args(cls, session_ids=None, start=None, end=None, compress=True, **kwargs):
+        """An export from request or command line values; raises ValueError if they are invalid.
+
+        `session_ids` may contain comma-separated lists, and `start`/`end`
+        are ISO 8601 timestamps or epoch milliseconds."""
+        sessions = []
+        for value in session_ids or []:
+            sessions.extend(session_id.strip() for session_id in value.split(',') if session_id.strip())
+        start = parse_timestamp(start, 'start') if start else None
+        end = parse_timestamp(end, 'end') if end else None
+        if start is not None and end is not None and end <= start:
+            raise ValueError("'end' must be after 'start'")
+        return cls(sessions, start, end, compress, **kwargs)
+
+    @property
+    def content_type(self):
+        return 'application/gzip' if self.compress else 'application/x-ndjson'
+
+    @property
+    def filename(self):
+        return 'torko-history.ndjson.gz' if self.compress else 'torko-history.ndjson'
+
+    def _writer(self):
+        return NDJSONWriter(self.compress, self.chunk_bytes)
+
+    def _finished(self, writer, started):
+        EXPORTED_MESSAGES.inc(writer.count)
+        logger.info("History export finished", extra={
+            'messages': writer.count,
+            'sessions': len(self.session_ids) if self.session_ids else 'all',
+            'duration_ms': round((time.perf_counter() - started) * 1000)
+        })
+
+    def chunks(self):
+        """The export's bytes, a chunk at a time"""
+        started = time.perf_counter()
+        writer = self._writer()
+        for message in self.store.export(self.session_ids, self.start, self.end, self.batch_size):
+            data = writer.write(message)
+            if data:
+                yield data
+        yield writer.finish()
+        self._finished(writer, started)
+
+    async def chunks_async(self):
+        started = time.perf_counter()
+        writer = self._writer()
+        async for message in self.store.export_async(self.session_ids, self.start, self.end, self.batch_size):
+            data = writer.write(message)
+            if data:
+                yield data
+        yield writer.finish()
+        self._finished(writer, started)
+
+def export_authorized(authorization):
+    """Whether an Authorization header carries EXPORT_TOKEN; exports are disabled when it is unset"""
+    token = os.getenv('EXPORT_TOKEN')
+    if not token or not authorization:
+        return False
+    scheme, _, value = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
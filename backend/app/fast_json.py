@@ -0,0 +1,32 @@
+import json
+from datetime import datetime, timezone
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library encoder gives the same output, more slowly
+    orjson = None
+
+# Stored timestamps are naive UTC; both encoders write them as 2024-01-01T12:00:00.123000Z
+_ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z if orjson is not None else 0
+
+def _default(value):
+    """Types JSON has no notion of: datetimes as ISO 8601, everything else (ObjectId, ...) as str"""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return value.isoformat() + 'Z'
+        if value.utcoffset() == timezone.utc.utcoffset(None):
+            return value.replace(tzinfo=None).isoformat() + 'Z'
+        return value.isoformat()
+    return str(value)
+
+def dumps(data):
+    """`data` as compact UTF-8 JSON bytes, with datetimes as ISO 8601 UTC"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def dumps_line(data):
+    """`dumps(data)` followed by a newline, for NDJSON"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=_ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+    return dumps(data) + b'\n'
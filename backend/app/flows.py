@@ -0,0 +1,131 @@
+"""Chat turn logic shared by the sync and async services.
+
+A flow is a generator holding the logic of a turn (retries, deadlines,
+failover, fallbacks, ...). For every I/O call it needs it yields a `Step`
+and receives the result, or has the exception raised at the `yield`.
+`run` and `stream` perform the steps by calling the sync service's
+methods, `run_async` and `stream_async` by awaiting the async service's,
+so the logic is written once and only the I/O methods exist twice.
+Streaming flows also yield their output text as `str`.
+"""
+
+class Step:
+    """A call of the service method `name` with `args`"""
+
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+class Abandoned(BaseException):
+    """Raised in a streaming flow whose consumer went away.
+
+    Unlike GeneratorExit it lets the flow's cleanup still yield steps (such
+    as saving what was streamed), and unlike Exception it is not caught by
+    retry handlers."""
+
+def _advance(flow, value, error):
+    return flow.throw(error) if error is not None else flow.send(value)
+
+def run(flow, service):
+    """The return value of `flow`, performing its steps with `service`'s blocking methods"""
+    value = error = None
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            value = getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
+
+def stream(flow, service):
+    """Generator of the text of a streaming flow, performing its steps with `service`'s blocking methods"""
+    value = error = None
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except StopIteration:
+            return
+        value = error = None
+        if isinstance(step, str):
+            try:
+                yield step
+            except GeneratorExit:
+                _abandon(flow, service)
+                raise
+            continue
+        try:
+            value = getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
+
+def _abandon(flow, service):
+    value, error = None, Abandoned()
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except (Abandoned, StopIteration):
+            return
+        value = error = None
+        if isinstance(step, str):
+            error = Abandoned()
+            continue
+        try:
+            value = getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
+
+async def run_async(flow, service):
+    """Coroutine version of `run`, awaiting `service`'s coroutine methods"""
+    value = error = None
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            value = await getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
+
+async def stream_async(flow, service):
+    """Async generator version of `stream`"""
+    value = error = None
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except StopIteration:
+            return
+        value = error = None
+        if isinstance(step, str):
+            try:
+                yield step
+            except GeneratorExit:
+                await _abandon_async(flow, service)
+                raise
+            continue
+        try:
+            value = await getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
+
+async def _abandon_async(flow, service):
+    value, error = None, Abandoned()
+    while True:
+        try:
+            step = _advance(flow, value, error)
+        except (Abandoned, StopIteration):
+            return
+        value = error = None
+        if isinstance(step, str):
+            error = Abandoned()
+            continue
+        try:
+            value = await getattr(service, step.name)(*step.args)
+        except BaseException as e:
+            error = e
@@ -0,0 +1,236 @@
+import os
+import time
+import asyncio
+import weakref
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class LLMClient:
+    """Pooled, keep-alive HTTP client for upstream LLM APIs.
+
+    A single `requests.Session` is shared by all threads of a worker process.
+    Its urllib3 connection pools are thread-safe and keep connections alive
+    per host, so repeated calls to the same API reuse the TCP+TLS connection.
+    The session is rebuilt lazily in a child process after fork, since
+    sockets inherited from the parent must not be shared.
+    """
+
+    def __init__(self):
+        self.pool_connections = int(os.getenv('LLM_POOL_CONNECTIONS', 4))  # Number of hosts to keep pools for
+        self.pool_maxsize = int(os.getenv('LLM_POOL_MAXSIZE', 16))  # Connections kept alive per host
+        self.pool_block = os.getenv('LLM_POOL_BLOCK', 'false').lower() == 'true'
+        self.connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(os.getenv('LLM_READ_TIMEOUT', 30))
+        self.total_timeout = float(os.getenv('LLM_TOTAL_TIMEOUT', 60))
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    @property
+    def session(self):
+        """Return the session for the current process, creating it if needed"""
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=0  # Retries are handled by the caller
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        logger.debug("Created LLM HTTP session (pid %d, pool size %d)", os.getpid(), self.pool_maxsize)
+        return session
+
+    def _reset_after_fork(self):
+        # Drop the parent's session without closing it - its sockets belong
+        # to the parent process. A new lock guards against a lock that was
+        # held by another thread at fork time.
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, headers=None, params=None, stream=False,
+             connect_timeout=None, read_timeout=None, total_timeout=None, data=None):
+        """POST to the upstream API using pooled connections.
+
+        `connect_timeout` and `read_timeout` are passed to the socket layer;
+        `total_timeout` bounds the whole exchange including reading the body.
+        For streamed responses use `iter_lines` to get the same total bound.
+        `data` is an already-encoded request body, sent instead of `json`.
+        """
+        total_timeout = self.total_timeout if total_timeout is None else total_timeout
+        deadline = time.monotonic() + total_timeout
+        timeout = (
+            self.connect_timeout if connect_timeout is None else connect_timeout,
+            min(self.read_timeout if read_timeout is None else read_timeout, total_timeout)
+        )
+
+        response = self.session.post(
+            url,
+            json=json,
+            data=data,
+            headers=headers,
+            params=params,
+            timeout=timeout,
+            stream=True
+        )
+        response.deadline = deadline
+
+        if not stream:
+            try:
+                response._content = b''.join(self._iter_content(response))
+            finally:
+                response.close()
+        return response
+
+    def iter_lines(self, response):
+        """Iterate over decoded lines of a streamed response, enforcing its total timeout"""
+        pending = ''
+        for chunk in self._iter_content(response, decode_unicode=True):
+            pending += chunk
+            lines = pending.splitlines(keepends=True)
+            pending = ''
+            for line in lines:
+                if line.endswith(('\n', '\r')):
+                    yield line.rstrip('\r\n')
+                else:
+                    pending = line
+        if pending:
+            yield pending
+
+    def _iter_content(self, response, decode_unicode=False):
+        if decode_unicode and response.encoding is None:
+            response.encoding = 'utf-8'
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=decode_unicode):
+            if time.monotonic() > response.deadline:
+                response.close()
+                raise requests.exceptions.Timeout(
+                    f"Upstream response exceeded total timeout for {response.url}"
+                )
+            yield chunk
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
+
+class AsyncLLMClient:
+    """Non-blocking counterpart of `LLMClient` for the ASGI serving path.
+
+    Uses one `httpx.AsyncClient` per event loop with the same pool sizes and
+    timeouts, so a worker can keep hundreds of upstream calls in flight
+    without a thread for each. `httpx` is only imported when first used.
+    """
+
+    def __init__(self):
+        self.pool_maxsize = int(os.getenv('LLM_POOL_MAXSIZE', 16))
+        self.max_connections = int(os.getenv('LLM_ASYNC_MAX_CONNECTIONS', 512))
+        self.connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(os.getenv('LLM_READ_TIMEOUT', 30))
+        self.total_timeout = float(os.getenv('LLM_TOTAL_TIMEOUT', 60))
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+    @property
+    def client(self):
+        """Return the client for the running event loop, creating it if needed"""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.pool_maxsize
+                ),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+            )
+            self._clients[loop] = client
+            logger.debug("Created async LLM HTTP client (pid %d, max connections %d)",
+                         os.getpid(), self.max_connections)
+        return client
+
+    async def post(self, url, json=None, headers=None, params=None, stream=False,
+                   connect_timeout=None, read_timeout=None, total_timeout=None, data=None):
+        """POST to the upstream API; same timeout semantics as `LLMClient.post`.
+
+        Streamed responses must be read with `iter_lines` and closed with
+        `await response.aclose()`.
+        """
+        import httpx
+
+        total_timeout = self.total_timeout if total_timeout is None else total_timeout
+        deadline = time.monotonic() + total_timeout
+        read_timeout = min(self.read_timeout if read_timeout is None else read_timeout, total_timeout)
+        timeout = httpx.Timeout(
+            read_timeout,
+            connect=self.connect_timeout if connect_timeout is None else connect_timeout
+        )
+
+        request = self.client.build_request('POST', url, json=json, content=data, headers=headers,
+                                            params=params, timeout=timeout)
+        try:
+            response = await asyncio.wait_for(self.client.send(request, stream=True), total_timeout)
+        except asyncio.TimeoutError:
+            raise httpx.TimeoutException(f"Upstream request exceeded total timeout for {url}",
+                                         request=request)
+        response.deadline = deadline
+
+        if not stream:
+            try:
+                await asyncio.wait_for(response.aread(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise httpx.TimeoutException(
+                    f"Upstream response exceeded total timeout for {url}", request=request
+                )
+            finally:
+                await response.aclose()
+        return response
+
+    async def iter_lines(self, response):
+        """Iterate over decoded lines of a streamed response, enforcing its total timeout"""
+        import httpx
+
+        lines = response.aiter_lines()
+        while True:
+            remaining = response.deadline - time.monotonic()
+            try:
+                line = await asyncio.wait_for(lines.__anext__(), max(0, remaining))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                await response.aclose()
+                raise httpx.TimeoutException(
+                    f"Upstream response exceeded total timeout for {response.url}",
+                    request=response.request
+                )
+            yield line
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+llm_client = LLMClient()
+async_llm_client = AsyncLLMClient()
@@ -0,0 +1,472 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from types import SimpleNamespace
+from dotenv import load_dotenv
+from .rate_limiter import RateLimiter, RateLimitTimeout, gemini_rate_limiter, PRIORITY_NORMAL
+from .metrics import LLM_CALLS, LLM_CIRCUIT_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Statuses that say something about the backend's health (as opposed to the request)
+UNHEALTHY_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open after `cooldown` seconds.
+
+    Opens after `failure_threshold` consecutive failures, or when at least
+    `error_rate_threshold` of the last `min_samples`+ calls failed. While open
+    the backend gets no traffic; once the cooldown has passed a single probe
+    is let through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold=5, error_rate_threshold=0.5, min_samples=10, cooldown=30.0,
+                 clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            logger.warning("LLM backend %s: circuit %s -> %s", self.name, self.state, state)
+            LLM_CIRCUIT_TRANSITIONS.inc(provider=self.name, state=state)
+            self.state = state
+
+    def available(self):
+        """Whether a call may be sent now (does not claim the half-open probe)"""
+        if self.state == 'closed':
+            return True
+        now = self.clock()
+        if self.state == 'open':
+            return now - self.opened_at >= self.cooldown
+        # Half-open: a probe is in flight; give up on it if it never reported back
+        return now - self.probe_started >= self.cooldown
+
+    def begin(self):
+        """Claim a call; False if it must not be sent because another caller holds the probe.
+
+        The first call after the cooldown becomes the probe. The check and
+        the switch to half-open happen under one lock, so of several callers
+        that all saw the circuit available only one gets the probe.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if not self.available():
+                return False
+            self._transition('half_open')
+            self.probe_started = self.clock()
+            return True
+
+    def record(self, ok, error_rate, samples):
+        with self._lock:
+            if ok:
+                self.consecutive_failures = 0
+                self._transition('closed')
+                return
+            self.consecutive_failures += 1
+            tripped = (self.consecutive_failures >= self.failure_threshold
+                       or (samples >= self.min_samples and error_rate >= self.error_rate_threshold))
+            if self.state == 'half_open' or (self.state == 'closed' and tripped):
+                self.opened_at = self.clock()
+                self._transition('open')
+
+class Provider:
+    """One upstream backend: a model at an endpoint with one API key.
+
+    Holds its own quota (rate limiter), circuit breaker and a rolling window
+    of call outcomes. Payloads are always built in Gemini's format
+    (`systemInstruction` + role-tagged `contents`); each kind translates
+    them for its API.
+    """
+
+    kind = None
+
+    def __init__(self, name, model, rate_limiter, breaker, api_key=None, api_base=None, window=50,
+                 initial_latency=2.0):
+        self.name = name
+        self.model = model
+        self.api_key = api_key
+        self.api_base = (api_base or '').rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.initial_latency = initial_latency
+        self._outcomes = deque(maxlen=window)  # (ok, seconds)
+        self._lock = threading.Lock()
+
+    def record_success(self, seconds):
+        LLM_CALLS.inc(provider=self.name, outcome='ok')
+        with self._lock:
+            self._outcomes.append((True, seconds))
+            self.breaker.record(True, *self._error_rate())
+
+    def record_failure(self, status):
+        """Count a failed call against the backend, unless it was the request's own fault"""
+        if status is not None and status not in UNHEALTHY_STATUSES:
+            LLM_CALLS.inc(provider=self.name, outcome='rejected')
+            return
+        LLM_CALLS.inc(provider=self.name, outcome='error')
+        with self._lock:
+            self._outcomes.append((False, None))
+            self.breaker.record(False, *self._error_rate())
+
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0, 0
+        failures = sum(1 for ok, _ in self._outcomes if not ok)
+        return failures / len(self._outcomes), len(self._outcomes)
+
+    def latency(self):
+        """Mean latency of the recent successful calls (the prior before there are any)"""
+        with self._lock:
+            samples = [seconds for ok, seconds in self._outcomes if ok and seconds is not None]
+        return sum(samples) / len(samples) if samples else self.initial_latency
+
+    def score(self):
+        """Expected seconds to get an answer: latency inflated by the recent error rate"""
+        with self._lock:
+            error_rate, _ = self._error_rate()
+        return self.latency() / max(0.05, 1.0 - error_rate)
+
+    def stats(self):
+        with self._lock:
+            error_rate, samples = self._error_rate()
+        return {
+            'kind': self.kind,
+            'model': self.model,
+            'circuit': self.breaker.state,
+            'latency': round(self.latency(), 3),
+            'error_rate': round(error_rate, 3),
+            'samples': samples,
+            'queued': self.rate_limiter.queued()
+        }
+
+    def warmup_request(self):
+        """(url, params, headers) of a cheap GET that opens a pooled connection, or None"""
+        return None
+
+class GeminiProvider(Provider):
+    kind = 'gemini'
+
+    def __init__(self, name, model, rate_limiter, breaker, api_key=None, api_base=None, **kwargs):
+        super().__init__(name, model, rate_limiter, breaker, api_key,
+                         api_base or 'https://generativelanguage.googleapis.com/v1beta', **kwargs)
+        self.api_url = f"{self.api_base}/models/{self.model}:generateContent"
+        self.stream_url = f"{self.api_base}/models/{self.model}:streamGenerateContent"
+
+    def headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': self.api_key
+        }
+
+    def endpoint(self, stream=False):
+        """(url, query params) to POST a turn to"""
+        if stream:
+            return self.stream_url, {'alt': 'sse'}
+        return self.api_url, None
+
+    def body(self, payload, stream=False):
+        """Request body (before JSON encoding) for a Gemini-format payload"""
+        return payload
+
+    def parse(self, data):
+        if not data.get('candidates'):
+            raise ValueError("No candidates in API response")
+        return data['candidates'][0]['content']['parts'][0]['text']
+
+    def parse_event(self, data):
+        for candidate in data.get('candidates', [])[:1]:
+            for part in candidate.get('content', {}).get('parts', []):
+                if part.get('text'):
+                    yield part['text']
+
+    def warmup_request(self):
+        return f"{self.api_base}/models/{self.model}", None, {'X-goog-api-key': self.api_key or ''}
+
+class OpenAIProvider(Provider):
+    """Any OpenAI-compatible `/chat/completions` endpoint (OpenAI, Azure, vLLM, Ollama, ...)"""
+
+    kind = 'openai'
+
+    def __init__(self, name, model, rate_limiter, breaker, api_key=None, api_base=None, **kwargs):
+        super().__init__(name, model, rate_limiter, breaker, api_key, api_base or 'https://api.openai.com/v1',
+                         **kwargs)
+        self.api_url = f"{self.api_base}/chat/completions"
+
+    def headers(self):
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+        return headers
+
+    def endpoint(self, stream=False):
+        return self.api_url, None
+
+    def body(self, payload, stream=False):
+        """Chat-completions body for a Gemini-format payload"""
+        messages = []
+        system = payload.get('systemInstruction')
+        if system:
+            messages.append({'role': 'system', 'content': '\n\n'.join(part['text'] for part in system['parts'])})
+        for content in payload['contents']:
+            messages.append({
+                'role': 'assistant' if content['role'] == 'model' else 'user',
+                'content': '\n\n'.join(part.get('text', '') for part in content['parts'])
+            })
+        body = {'model': self.model, 'messages': messages}
+        if stream:
+            body['stream'] = True
+        return body
+
+    def parse(self, data):
+        if not data.get('choices'):
+            raise ValueError("No choices in API response")
+        return data['choices'][0]['message']['content']
+
+    def parse_event(self, data):
+        for choice in data.get('choices', [])[:1]:
+            text = choice.get('delta', {}).get('content')
+            if text:
+                yield text
+
+    def warmup_request(self):
+        return f"{self.api_base}/models", None, self.headers()
+
+class FakeUpstreamError(Exception):
+    """Injected failure of a fake provider, shaped like an HTTP error (`error.response.status_code`)"""
+
+    def __init__(self, status, message=None):
+        super().__init__(message or f"Fake upstream error {status}")
+        self.response = SimpleNamespace(status_code=status)
+
+class FakeProvider(Provider):
+    """In-process backend for local runs and load tests: no network, no API key.
+
+    Answers after `latency` seconds (plus up to `jitter`), fails with
+    `error_status` at `error_rate`, and replies with `response` or an echo
+    of the last user message. Streams are split into words.
+    """
+
+    kind = 'fake'
+
+    def __init__(self, name, model, rate_limiter, breaker, latency=0.2, jitter=0.1, error_rate=0.0,
+                 error_status=503, response=None, **kwargs):
+        kwargs.pop('api_key', None)
+        kwargs.pop('api_base', None)
+        super().__init__(name, model or 'fake', rate_limiter, breaker, **kwargs)
+        self.base_latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.response = response
+
+    def delay(self):
+        return self.base_latency + random.uniform(0, self.jitter)
+
+    def reply(self, payload):
+        """The response text, or raises FakeUpstreamError"""
+        if random.random() < self.error_rate:
+            raise FakeUpstreamError(self.error_status)
+        if self.response is not None:
+            return self.response
+        last = payload['contents'][-1]['parts'][-1].get('text', '') if payload.get('contents') else ''
+        return f"[{self.name}] You said: {last}"
+
+    def chunks(self, text):
+        words = text.split(' ')
+        return [word + (' ' if index < len(words) - 1 else '') for index, word in enumerate(words)]
+
+PROVIDER_KINDS = {provider.kind: provider for provider in (GeminiProvider, OpenAIProvider, FakeProvider)}
+
+class LLMRouter:
+    """Chooses the upstream backend for each attempt.
+
+    Backends whose circuit is open are skipped; the rest are ranked by
+    expected time to an answer (recent mean latency divided by the recent
+    success rate), with the configured order breaking ties. A small
+    `explore` fraction of calls goes to a random healthy backend so the
+    statistics of the others stay current. When the best backend is out of
+    quota, a worse one with quota is used if it is still expected to answer
+    before the best one's quota frees up; otherwise the caller queues on the
+    best one.
+    """
+
+    def __init__(self, providers, explore=0.05):
+        if not providers:
+            raise ValueError("At least one LLM backend is required")
+        self.providers = providers
+        self.primary = providers[0]
+        self.explore = explore
+
+    @property
+    def queue_timeout(self):
+        return self.primary.rate_limiter.queue_timeout
+
+    def ranked(self, exclude=()):
+        """Available backends, best first"""
+        candidates = [provider for provider in self.providers
+                      if provider not in exclude and provider.breaker.available()]
+        order = {provider: index for index, provider in enumerate(self.providers)}
+        candidates.sort(key=lambda provider: (provider.score(), order[provider]))
+        if len(candidates) > 1 and random.random() < self.explore:
+            chosen = random.choice(candidates[1:])
+            candidates.remove(chosen)
+            candidates.insert(0, chosen)
+        return candidates
+
+    def has_alternative(self, exclude):
+        """Whether a backend outside `exclude` could take a call now"""
+        return any(provider not in exclude and provider.breaker.available() for provider in self.providers)
+
+    def _candidates(self, exclude):
+        candidates = self.ranked(exclude)
+        if not candidates and exclude:
+            # Every untried backend is unavailable; the tried ones may be retried
+            candidates = self.ranked()
+        return candidates
+
+    def _take_available(self, candidates, tokens):
+        """Take quota without queueing from the best backend, or from one that is
+        expected to answer sooner than the best backend's quota frees up"""
+        if len(candidates) == 1:
+            return None
+        best = candidates[0]
+        # Only take quota directly where nobody is queued, so priorities still hold
+        wait = best.rate_limiter.queue_timeout if best.rate_limiter.queued() else best.rate_limiter.try_acquire(tokens)
+        if wait <= 0:
+            return best
+        limit = best.score() + wait
+        for provider in candidates[1:]:
+            if (provider.score() <= limit and not provider.rate_limiter.queued()
+                    and provider.rate_limiter.try_acquire(tokens) <= 0):
+                return provider
+        return None
+
+    def acquire(self, tokens, priority=PRIORITY_NORMAL, timeout=None, exclude=()):
+        """Take quota for one call; returns the backend to send it to, or None.
+
+        Backends in `exclude` (already tried for this turn) are only used
+        when no other is available. Returns None if every circuit is open or
+        the quota wait timed out.
+        """
+        while True:
+            candidates = self._candidates(exclude)
+            if not candidates:
+                logger.warning("No LLM backend available (all circuits open)")
+                return None
+            provider = self._take_available(candidates, tokens)
+            if provider is None:
+                try:
+                    candidates[0].rate_limiter.acquire(tokens, priority=priority, timeout=timeout)
+                except RateLimitTimeout as e:
+                    logger.warning("Rate limiting on %s: %s", candidates[0].name, e)
+                    return None
+                provider = candidates[0]
+            if provider.breaker.begin():
+                return provider
+            # Another call took the half-open probe meanwhile; choose again
+
+    async def acquire_async(self, tokens, priority=PRIORITY_NORMAL, timeout=None, exclude=()):
+        """Coroutine version of `acquire`"""
+        while True:
+            candidates = self._candidates(exclude)
+            if not candidates:
+                logger.warning("No LLM backend available (all circuits open)")
+                return None
+            if len(candidates) > 1 and any(candidate.rate_limiter.store.blocking for candidate in candidates):
+                # File and Redis stores do blocking I/O; keep it off the event loop
+                provider = await asyncio.to_thread(self._take_available, candidates, tokens)
+            else:
+                provider = self._take_available(candidates, tokens)
+            if provider is None:
+                try:
+                    await candidates[0].rate_limiter.acquire_async(tokens, priority=priority, timeout=timeout)
+                except RateLimitTimeout as e:
+                    logger.warning("Rate limiting on %s: %s", candidates[0].name, e)
+                    return None
+                provider = candidates[0]
+            if provider.breaker.begin():
+                return provider
+            # Another call took the half-open probe meanwhile; choose again
+
+    def stats(self):
+        return {provider.name: provider.stats() for provider in self.providers}
+
+def _breaker(name):
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv('LLM_CIRCUIT_FAILURES', 5)),
+        error_rate_threshold=float(os.getenv('LLM_CIRCUIT_ERROR_RATE', 0.5)),
+        min_samples=int(os.getenv('LLM_CIRCUIT_MIN_SAMPLES', 10)),
+        cooldown=float(os.getenv('LLM_CIRCUIT_COOLDOWN', 30))
+    )
+
+def _rate_limiter(name, config, store):
+    return RateLimiter(
+        f"llm:{name}",
+        requests_per_minute=float(config.get('rpm', os.getenv('GEMINI_RPM', 60))),
+        tokens_per_minute=float(config.get('tpm', os.getenv('GEMINI_TPM', 1000000))),
+        request_burst=float(config.get('rpm_burst', os.getenv('GEMINI_RPM_BURST', 5))),
+        queue_timeout=float(os.getenv('RATE_LIMIT_QUEUE_TIMEOUT', 10)),
+        store=store
+    )
+
+def create_router():
+    """Router over the backends in LLM_PROVIDERS (a JSON list), or the single Gemini backend.
+
+    Each entry has `kind` (gemini, openai or fake), `name`, `model`, and
+    optionally `api_base`, `api_key_env` (the variable holding the key) or
+    `api_key`, and `rpm`/`tpm`/`rpm_burst` quotas. Fake backends also take
+    `latency`, `jitter`, `error_rate`, `error_status` and `response`.
+    """
+    window = int(os.getenv('LLM_ROUTER_WINDOW', 50))
+    explore = float(os.getenv('LLM_ROUTER_EXPLORE', 0.05))
+    configs = os.getenv('LLM_PROVIDERS')
+    if not configs:
+        primary = GeminiProvider(
+            'gemini',
+            'gemini-2.0-flash',
+            gemini_rate_limiter,
+            _breaker('gemini'),
+            api_key=os.getenv('GEMINI_API_KEY'),
+            api_base=os.getenv('GEMINI_API_BASE'),
+            window=window
+        )
+        return LLMRouter([primary], explore=explore)
+
+    store = gemini_rate_limiter.store
+    providers = []
+    for index, config in enumerate(json.loads(configs)):
+        config = dict(config)
+        kind = config.pop('kind', 'gemini')
+        name = config.pop('name', f"{kind}-{index}")
+        model = config.pop('model', 'gemini-2.0-flash' if kind == 'gemini' else None)
+        api_key_env = config.pop('api_key_env', None)
+        api_key = os.getenv(api_key_env) if api_key_env else config.pop('api_key', None)
+        limiter = _rate_limiter(name, config, store)
+        options = {key: config[key] for key in ('latency', 'jitter', 'error_rate', 'error_status', 'response')
+                   if key in config}
+        providers.append(PROVIDER_KINDS[kind](
+            name, model, limiter, _breaker(name),
+            api_key=api_key, api_base=config.get('api_base'), window=window, **options
+        ))
+    logger.info("LLM backends: %s", ', '.join(f"{p.name} ({p.kind} {p.model})" for p in providers))
+    return LLMRouter(providers, explore=explore)
+
+llm_router = create_router()
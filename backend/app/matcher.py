@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import string
+import logging
+from functools import lru_cache
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+DEFAULT_PATTERN_SETS = {
+    # User is asking about Torko itself
+    'torko_query': [
+        'torko', 'what is torko', 'about torko', 'tell me about torko',
+        'who are you', 'what are you', 'describe yourself', 'what do you do',
+        'your name', 'introduce yourself', 'about yourself'
+    ],
+    # Statement patterns that could benefit from debate
+    'debate_trigger': [
+        'i think', 'i believe', 'in my opinion', 'i feel that',
+        'everyone knows', 'it\'s obvious', 'clearly', 'definitely',
+        'always', 'never', 'all', 'none', 'every', 'no one',
+        'should', 'must', 'have to', 'need to'
+    ],
+    'controversial_topic': [
+        'politics', 'religion', 'economics', 'philosophy', 'ethics',
+        'climate', 'technology', 'society', 'education', 'healthcare',
+        'artificial intelligence', 'future', 'progress', 'tradition'
+    ],
+    # Model output that signals a service problem rather than an answer
+    'service_error': [
+        'experiencing difficulties',
+        'cannot respond to your request at this time',
+        'i apologize for the inconvenience',
+        'service unavailable',
+        'temporarily unavailable',
+        'technical difficulties'
+    ],
+    # Fallback response categories
+    'greeting': ['hello', 'hi', 'hey', 'greetings'],
+    'question': ['what', 'explain', 'define', 'how', 'why', 'when', 'where'],
+    'help': ['help', 'support', 'assist']
+}
+
+_WORD = re.compile(r'\w+')
+
+# ASCII punctuation to spaces, so str.split() yields the same words as \w+
+_PUNCTUATION_TO_SPACE = str.maketrans({c: ' ' for c in string.punctuation if c != '_'})
+
+def _words(text):
+    """Split lowercase text into words the way `\\w+` would"""
+    if text.isascii():
+        # translate + split stay in C and are much faster than the regex
+        return text.translate(_PUNCTUATION_TO_SPACE).split()
+    return _WORD.findall(text)
+
+class KeywordMatcher:
+    """Classifies text into keyword categories in a single pass.
+
+    The text is split into words once. Single-word phrases are then found
+    with one set intersection; multi-word phrases are only checked (with a
+    precompiled regex) when every one of their words occurs in the text.
+    Phrases match whole words ('hi' does not match 'this'), ignoring case
+    and runs of whitespace between words. Results for short texts are
+    memoised; texts longer than `cache_max_chars` (such as model responses,
+    which are rarely classified twice) are not, so the cache holds small
+    keys only.
+    """
+
+    def __init__(self, pattern_sets, cache_size=1024, cache_max_chars=256):
+        self.cache_max_chars = cache_max_chars
+        self.pattern_sets = {
+            category: [' '.join(p.lower().split()) for p in phrases if p.strip()]
+            for category, phrases in pattern_sets.items()
+        }
+
+        self._single = {}  # word -> categories
+        multi = {}  # phrase -> categories
+        for category, phrases in self.pattern_sets.items():
+            for phrase in phrases:
+                if _words(phrase) == [phrase]:
+                    self._single.setdefault(phrase, set()).add(category)
+                else:
+                    multi.setdefault(phrase, set()).add(category)
+
+        self._multi = [
+            (
+                frozenset(_words(phrase)),
+                re.compile(r'\b' + r'\s+'.join(re.escape(word) for word in phrase.split(' ')) + r'\b'),
+                frozenset(categories)
+            )
+            for phrase, categories in multi.items()
+        ]
+        self._classify_cached = lru_cache(maxsize=cache_size)(self._classify)
+
+    def classify(self, text):
+        """Return the frozenset of categories with at least one phrase in `text`"""
+        if text and len(text) > self.cache_max_chars:
+            return self._classify(text)
+        return self._classify_cached(text)
+
+    def _classify(self, text):
+        if not text:
+            return frozenset()
+        text = text.lower()
+        words = set(_words(text))
+
+        found = set()
+        for word in words.intersection(self._single):
+            found |= self._single[word]
+        for required_words, regex, categories in self._multi:
+            if not categories <= found and required_words <= words and regex.search(text):
+                found |= categories
+        return frozenset(found)
+
+    def matches(self, text, category):
+        return category in self.classify(text)
+
+def load_pattern_sets():
+    """Default pattern sets, overridden per category by MATCHER_PATTERNS_FILE (JSON)"""
+    pattern_sets = dict(DEFAULT_PATTERN_SETS)
+    path = os.getenv('MATCHER_PATTERNS_FILE')
+    if path:
+        try:
+            with open(path) as f:
+                pattern_sets.update(json.load(f))
+        except Exception as e:
+            logger.error("Error loading matcher patterns from %s: %s", path, e)
+    return pattern_sets
+
+keyword_matcher = KeywordMatcher(load_pattern_sets())
@@ -0,0 +1,319 @@
+import os
+import logging
+from bson import ObjectId
+from dotenv import load_dotenv
+from .database import get_db, get_async_db
+from .conversation_cache import message_cursor, is_after
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+def _cursor_condition(operator, cursor):
+    timestamp, object_id = cursor
+    if object_id is None:
+        return {'timestamp': {operator: timestamp}}
+    return {'$or': [
+        {'timestamp': {operator: timestamp}},
+        {'timestamp': timestamp, '_id': {operator: object_id}}
+    ]}
+
+def _export_query(time_field_start, time_field_end, session_ids, start, end):
+    """Filter for an export: optional session list, `start` inclusive and `end` exclusive"""
+    query = {}
+    if session_ids:
+        query['session_id'] = {'$in': list(session_ids)}
+    if start is not None:
+        query[time_field_end] = {'$gte': start}
+    if end is not None:
+        query.setdefault(time_field_start, {})['$lt'] = end
+    return query
+
+def _in_window(message, after, before):
+    cursor = message_cursor(message)
+    return (after is None or is_after(cursor, after)) and (before is None or is_after(before, cursor))
+
+class DocumentMessageStore:
+    """One document per message in the `messages` collection (the default layout)"""
+
+    name = 'documents'
+
+    def ensure_indexes(self, database):
+        # Equality on session_id, then keyset order on (timestamp, _id)
+        database.messages.create_index(
+            [('session_id', 1), ('timestamp', 1), ('_id', 1)],
+            name='session_id_timestamp'
+        )
+
+    def insert(self, document):
+        get_db().messages.insert_one(document)
+
+    async def insert_async(self, document):
+        await get_async_db().messages.insert_one(document)
+
+    def insert_many(self, documents):
+        """Write a batch; raises BulkWriteError like `insert_many(ordered=False)`"""
+        get_db().messages.insert_many(documents, ordered=False)
+
+    async def insert_many_async(self, documents):
+        await get_async_db().messages.insert_many(documents, ordered=False)
+
+    def _query(self, session_id, after, before):
+        conditions = []
+        if after is not None:
+            conditions.append(_cursor_condition('$gt', after))
+        if before is not None:
+            conditions.append(_cursor_condition('$lt', before))
+        query = {'session_id': session_id}
+        if len(conditions) == 1:
+            query.update(conditions[0])
+        elif conditions:
+            query['$and'] = conditions
+        return query
+
+    def _cursor(self, db, session_id, after, before, limit, newest, projection):
+        direction = -1 if newest else 1
+        cursor = db.messages.find(self._query(session_id, after, before), projection)
+        cursor = cursor.sort([('timestamp', direction), ('_id', direction)])
+        return cursor.limit(limit) if limit else cursor
+
+    def find(self, session_id, after=None, before=None, limit=None, newest=False, projection=None):
+        """Messages of a session between the `after` and `before` (timestamp, _id) cursors.
+
+        Returned in chronological order. With `limit`, only the oldest
+        `limit` messages of the window, or the newest ones if `newest`."""
+        messages = list(self._cursor(get_db(), session_id, after, before, limit, newest, projection))
+        messages.sort(key=message_cursor)
+        return messages
+
+    async def find_async(self, session_id, after=None, before=None, limit=None, newest=False, projection=None):
+        cursor = self._cursor(get_async_db(), session_id, after, before, limit, newest, projection)
+        messages = await cursor.to_list(None)
+        messages.sort(key=message_cursor)
+        return messages
+
+    def _export_cursor(self, db, session_ids, start, end, batch_size):
+        cursor = db.messages.find(_export_query('timestamp', 'timestamp', session_ids, start, end))
+        # The session_id_timestamp index gives this order without an in-memory sort
+        cursor = cursor.sort([('session_id', 1), ('timestamp', 1), ('_id', 1)])
+        return cursor.batch_size(batch_size)
+
+    def export(self, session_ids=None, start=None, end=None, batch_size=1000):
+        """Messages of `session_ids` (all sessions if empty) with `start <= timestamp < end`.
+
+        Yielded one at a time by session, then chronologically, while the
+        cursor fetches `batch_size` documents at a time, so memory use does not
+        grow with the size of the export."""
+        cursor = self._export_cursor(get_db(), session_ids, start, end, batch_size)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    async def export_async(self, session_ids=None, start=None, end=None, batch_size=1000):
+        async for message in self._export_cursor(get_async_db(), session_ids, start, end, batch_size):
+            yield message
+
+class BucketMessageStore:
+    """Conversations stored as bucket documents in `message_buckets`.
+
+    Each bucket holds up to `bucket_size` consecutive messages of one
+    session, `{session_id, start, end, count, open, messages: [...]}`, and
+    new messages are appended with `$push` to the session's open bucket,
+    its newest. Once that is full it is closed and an upsert starts the
+    next one, so the buckets' time ranges never overlap. Reading a whole
+    conversation takes one document per `bucket_size` messages, and a page of
+    recent history usually one or two.
+
+    A batch whose write is retried after a partial failure may be appended
+    twice, so reads drop repeated `_id`s.
+    """
+
+    name = 'buckets'
+
+    def __init__(self, bucket_size=100):
+        self.bucket_size = bucket_size
+
+    def ensure_indexes(self, database):
+        database.message_buckets.create_index(
+            [('session_id', 1), ('start', 1), ('_id', 1)],
+            name='session_id_start'
+        )
+
+    def _chunks(self, documents):
+        """(session_id, messages) appends for a batch, none larger than a bucket"""
+        by_session = {}
+        for document in documents:
+            by_session.setdefault(document['session_id'], []).append(document)
+        for session_id, messages in by_session.items():
+            for index in range(0, len(messages), self.bucket_size):
+                yield session_id, messages[index:index + self.bucket_size]
+
+    def build_buckets(self, session_id, messages):
+        """Full bucket documents for a session's messages in chronological order (for backfills)"""
+        buckets = []
+        for index in range(0, len(messages), self.bucket_size):
+            chunk = messages[index:index + self.bucket_size]
+            buckets.append({
+                'session_id': session_id,
+                'start': chunk[0]['timestamp'],
+                'end': chunk[-1]['timestamp'],
+                'count': len(chunk),
+                'open': index + self.bucket_size >= len(messages),
+                'messages': [{key: value for key, value in message.items() if key != 'session_id'}
+                             for message in chunk]
+            })
+        return buckets
+
+    def _append(self, session_id, messages):
+        """(filter, update) that appends `messages` to the session's open bucket, creating it if needed"""
+        for message in messages:
+            # Assigned here, as insert_one would, so cursors work for bucketed messages
+            message.setdefault('_id', ObjectId())
+        entries = [{key: value for key, value in message.items() if key != 'session_id'} for message in messages]
+        timestamps = [message['timestamp'] for message in messages]
+        return (
+            # Only the open bucket, and only if it has room for the whole chunk
+            {'session_id': session_id, 'open': True, 'count': {'$lte': self.bucket_size - len(messages)}},
+            {
+                '$push': {'messages': {'$each': entries}},
+                '$inc': {'count': len(entries)},
+                '$min': {'start': min(timestamps)},
+                '$max': {'end': max(timestamps)}
+            }
+        )
+
+    def _append_to(self, collection, session_id, messages):
+        """Append to the open bucket; if it is full, close it and start a new one"""
+        query, update = self._append(session_id, messages)
+        if collection.update_one(query, update).matched_count:
+            return
+        collection.update_one({'session_id': session_id, 'open': True}, {'$set': {'open': False}})
+        collection.update_one(query, update, upsert=True)
+
+    async def _append_to_async(self, collection, session_id, messages):
+        query, update = self._append(session_id, messages)
+        if (await collection.update_one(query, update)).matched_count:
+            return
+        await collection.update_one({'session_id': session_id, 'open': True}, {'$set': {'open': False}})
+        await collection.update_one(query, update, upsert=True)
+
+    def insert(self, document):
+        self._append_to(get_db().message_buckets, document['session_id'], [document])
+
+    async def insert_async(self, document):
+        await self._append_to_async(get_async_db().message_buckets, document['session_id'], [document])
+
+    def insert_many(self, documents):
+        """Append a batch with one update per session (per bucket-sized chunk)"""
+        collection = get_db().message_buckets
+        for session_id, messages in self._chunks(documents):
+            self._append_to(collection, session_id, messages)
+
+    async def insert_many_async(self, documents):
+        collection = get_async_db().message_buckets
+        for session_id, messages in self._chunks(documents):
+            await self._append_to_async(collection, session_id, messages)
+
+    def _bucket_query(self, session_id, after, before):
+        query = {'session_id': session_id}
+        if after is not None:
+            query['end'] = {'$gte': after[0]}
+        if before is not None:
+            query['start'] = {'$lte': before[0]}
+        return query
+
+    def _cursor(self, db, session_id, after, before, limit, newest):
+        cursor = db.message_buckets.find(self._bucket_query(session_id, after, before))
+        # Buckets created in the same millisecond are ordered by their _id
+        direction = -1 if newest else 1
+        cursor = cursor.sort([('start', direction), ('_id', direction)])
+        # Buckets are large: fetch them a couple at a time and stop early
+        return cursor.batch_size(2) if limit else cursor
+
+    def _unpack(self, bucket, session_id, after, before, projection, seen, messages):
+        for entry in bucket.get('messages', []):
+            if entry['_id'] in seen or not _in_window(entry, after, before):
+                continue
+            seen.add(entry['_id'])
+            if projection:
+                message = {key: value for key, value in entry.items() if key == '_id' or projection.get(key)}
+            else:
+                message = dict(entry, session_id=session_id)
+            messages.append(message)
+
+    def _finish(self, messages, limit, newest):
+        messages.sort(key=message_cursor)
+        if limit:
+            return messages[-limit:] if newest else messages[:limit]
+        return messages
+
+    def find(self, session_id, after=None, before=None, limit=None, newest=False, projection=None):
+        """Same contract as `DocumentMessageStore.find`"""
+        cursor = self._cursor(get_db(), session_id, after, before, limit, newest)
+        seen, messages = set(), []
+        try:
+            for bucket in cursor:
+                self._unpack(bucket, session_id, after, before, projection, seen, messages)
+                if limit and len(messages) >= limit:
+                    break
+        finally:
+            cursor.close()
+        return self._finish(messages, limit, newest)
+
+    async def find_async(self, session_id, after=None, before=None, limit=None, newest=False, projection=None):
+        cursor = self._cursor(get_async_db(), session_id, after, before, limit, newest)
+        seen, messages = set(), []
+        async for bucket in cursor:
+            self._unpack(bucket, session_id, after, before, projection, seen, messages)
+            if limit and len(messages) >= limit:
+                break
+        return self._finish(messages, limit, newest)
+
+    def _export_cursor(self, db, session_ids, start, end, batch_size):
+        cursor = db.message_buckets.find(_export_query('start', 'end', session_ids, start, end))
+        cursor = cursor.sort([('session_id', 1), ('start', 1), ('_id', 1)])
+        # Each bucket holds up to bucket_size messages
+        return cursor.batch_size(max(1, batch_size // self.bucket_size))
+
+    def _export_bucket(self, bucket, start, end, seen):
+        """The bucket's messages in the time range, in order, skipping `_id`s already exported"""
+        messages = []
+        for entry in bucket.get('messages', []):
+            if entry['_id'] in seen:
+                continue
+            if (start is not None and entry['timestamp'] < start) or (end is not None and entry['timestamp'] >= end):
+                continue
+            seen.add(entry['_id'])
+            messages.append(dict(entry, session_id=bucket['session_id']))
+        messages.sort(key=message_cursor)
+        return messages
+
+    def export(self, session_ids=None, start=None, end=None, batch_size=1000):
+        """Same contract as `DocumentMessageStore.export`; only one bucket's messages are held at a time"""
+        cursor = self._export_cursor(get_db(), session_ids, start, end, batch_size)
+        session_id, seen = None, set()
+        try:
+            for bucket in cursor:
+                if bucket['session_id'] != session_id:
+                    session_id, seen = bucket['session_id'], set()
+                yield from self._export_bucket(bucket, start, end, seen)
+        finally:
+            cursor.close()
+
+    async def export_async(self, session_ids=None, start=None, end=None, batch_size=1000):
+        session_id, seen = None, set()
+        async for bucket in self._export_cursor(get_async_db(), session_ids, start, end, batch_size):
+            if bucket['session_id'] != session_id:
+                session_id, seen = bucket['session_id'], set()
+            for message in self._export_bucket(bucket, start, end, seen):
+                yield message
+
+def create_store():
+    """The message store selected by MESSAGE_STORAGE"""
+    storage = os.getenv('MESSAGE_STORAGE', 'documents').lower()
+    if storage == 'buckets':
+        return BucketMessageStore(int(os.getenv('MESSAGE_BUCKET_SIZE', 100)))
+    return DocumentMessageStore()
+
+message_store = create_store()
@@ -0,0 +1,315 @@
+import os
+import json
+import glob
+import time
+import bisect
+import atexit
+import logging
+import tempfile
+import threading
+import contextvars
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        return {'|'.join(key): value for key, value in self.values.items()}
+
+class Histogram:
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        return {'|'.join(key): list(counts) for key, counts in self.values.items()}
+
+class Registry:
+    """Prometheus-style counters and histograms aggregated across worker processes.
+
+    Each process keeps its own values in memory (an increment is a dict
+    update under a lock) and periodically writes them to
+    `<directory>/<pid>.json` from a background thread. A scrape writes the
+    current process's file and sums every file in the directory, so the
+    result covers all gunicorn workers, including ones that have exited.
+    """
+
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.gauges = {}  # name -> (documentation, callback)
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self, name, documentation, labelnames)
+        self.metrics[name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(self, name, documentation, labelnames, buckets)
+        self.metrics[name] = metric
+        return metric
+
+    def gauge_callback(self, name, documentation, callback):
+        """A gauge read from `callback()` at flush time and summed across workers"""
+        self.gauges[name] = (documentation, callback)
+
+    def start(self):
+        """Start the background flusher for this process (idempotent, fork-aware)"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        # The parent's flusher thread does not exist in the child, and the
+        # child must not report the parent's values under its own pid
+        self.lock = threading.Lock()
+        started = self._thread is not None
+        self._thread = None
+        for metric in self.metrics.values():
+            metric.values = {}
+        if started:
+            self.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            data = {name: metric.snapshot() for name, metric in self.metrics.items()}
+        for name, (_, callback) in self.gauges.items():
+            try:
+                data[name] = {'': float(callback())}
+            except Exception as e:
+                logger.error("Error reading gauge %s: %s", name, e)
+        return data
+
+    def flush(self):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.json")
+            temporary = f"{path}.tmp"
+            with open(temporary, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temporary, path)
+        except Exception as e:
+            logger.error("Error writing metrics snapshot: %s", e)
+
+    def _collect(self):
+        """Snapshots of all processes as (is_alive, snapshot) pairs"""
+        if not self.directory:
+            return [(True, self.snapshot())]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # Being replaced or from a crashed writer
+            snapshots.append((_is_alive(int(os.path.basename(path)[:-len('.json')])), snapshot))
+        return snapshots
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        totals = {}
+        for alive, snapshot in self._collect():
+            for name, series in snapshot.items():
+                # Counters keep the totals of exited workers; gauges do not
+                if name in self.gauges and not alive:
+                    continue
+                merged = totals.setdefault(name, {})
+                for key, value in series.items():
+                    if isinstance(value, list):
+                        current = merged.get(key)
+                        merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+
+        lines = []
+        for name, metric in self.metrics.items():
+            kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for joined, value in sorted(totals.get(name, {}).items()):
+                key = tuple(joined.split('|')) if metric.labelnames else ()
+                if kind == 'counter':
+                    lines.append(f"{name}{_format_labels(metric.labelnames, key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    labels = _format_labels(metric.labelnames, key, [('le', str(bound))])
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                lines.append(f"{name}_count{_format_labels(metric.labelnames, key)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric.labelnames, key)} {value[-1]}")
+        for name, (documentation, _) in self.gauges.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {totals.get(name, {}).get('', 0)}")
+        return '\n'.join(lines) + '\n'
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+# A context variable rather than a thread-local, so that concurrent requests
+# served as coroutines on one event loop keep separate traces
+_trace = contextvars.ContextVar('torko_trace', default=None)
+
+def start_trace():
+    """Start collecting stage timings for the current request (for Server-Timing)"""
+    _trace.set([])
+
+def server_timing():
+    """Server-Timing header value for the stages recorded since start_trace(); ends the trace"""
+    stages = _trace.get() or []
+    _trace.set(None)
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)
+
+class stage_timer:
+    """Context manager timing one stage of a chat turn"""
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    stages = _trace.get()
+    if stages is not None:
+        stages.append((stage, seconds))
+
+registry = Registry(
+    os.getenv('METRICS_DIR') or os.path.join(tempfile.gettempdir(), f"torko-metrics-{os.getppid()}"),
+    flush_interval=float(os.getenv('METRICS_FLUSH_INTERVAL', 1))
+)
+
+STAGE_SECONDS = registry.histogram(
+    'torko_chat_stage_seconds',
+    'Time spent in each stage of a chat turn',
+    ['stage']
+)
+UPSTREAM_RESPONSES = registry.counter(
+    'torko_upstream_responses_total',
+    'Upstream AI API responses by HTTP status (or "error" for connection failures)',
+    ['status']
+)
+RETRIES = registry.counter('torko_upstream_retries_total', 'Upstream AI API attempts that were retried')
+FALLBACKS = registry.counter('torko_fallback_responses_total', 'Turns answered with the canned fallback response')
+HEDGES = registry.counter(
+    'torko_upstream_hedges_total',
+    'Hedged (duplicate) upstream attempts by outcome: sent, won (answered first) or skipped (no quota)',
+    ['outcome']
+)
+DEADLINE_EXHAUSTED = registry.counter(
+    'torko_deadline_exhausted_total',
+    'Turns that stopped retrying because the remaining deadline was too short'
+)
+ADMISSION_REJECTED = registry.counter(
+    'torko_admission_rejected_total',
+    'Chat turns turned away by admission control, by reason (overloaded, queue_full, session_busy, timeout)',
+    ['reason']
+)
+BATCH_ITEMS = registry.counter(
+    'torko_batch_items_total',
+    'Batch API items by outcome (ok or error)',
+    ['outcome']
+)
+LLM_CALLS = registry.counter(
+    'torko_llm_calls_total',
+    'Upstream LLM calls by backend and outcome (ok, error, or rejected for request errors such as 400)',
+    ['provider', 'outcome']
+)
+LLM_CIRCUIT_TRANSITIONS = registry.counter(
+    'torko_llm_circuit_transitions_total',
+    'Circuit breaker state changes by backend and new state (open, half_open, closed)',
+    ['provider', 'state']
+)
+WRITE_BEHIND_DROPPED = registry.counter(
+    'torko_write_behind_dropped_total',
+    'Chat messages discarded because write-behind flushes kept failing'
+)
+LOG_RECORDS_DROPPED = registry.counter(
+    'torko_log_records_dropped_total',
+    'Log records discarded because the log queue was full'
+)
+EXPORTED_MESSAGES = registry.counter(
+    'torko_exported_messages_total',
+    'Messages written by history exports'
+)
+TORKO_SHORTCIRCUITS = registry.counter('torko_self_description_total', 'Turns answered by the built-in Torko description')
+PROMPT_CHARS = registry.histogram(
+    'torko_prompt_chars',
+    'Size of the prompt sent upstream, in characters',
+    buckets=SIZE_BUCKETS
+)
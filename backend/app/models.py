@@ -1,12 +1,49 @@
-from datetime import datetime
-from .database import get_db
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from .database import get_db, get_async_db
+from .conversation_cache import conversation_cache, message_cursor, is_after
+from .write_behind import write_behind
+from .message_store import message_store
+
+EPOCH = datetime(1970, 1, 1)
+
+# Fields returned by the history API
+HISTORY_PROJECTION = {'content': 1, 'sender': 1, 'timestamp': 1}
+
+def encode_cursor(message):
+    """Opaque pagination cursor for a stored message: `<epoch ms>-<_id>`"""
+    milliseconds = (message['timestamp'] - EPOCH) // timedelta(milliseconds=1)
+    return f"{milliseconds}-{message['_id']}"
+
+def decode_cursor(cursor):
+    """(timestamp, _id) for a cursor from `encode_cursor`; raises ValueError if malformed"""
+    milliseconds, _, object_id = cursor.partition('-')
+    try:
+        return EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(object_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+def parse_timestamp(value, name='since'):
+    """Naive UTC datetime for an ISO 8601 timestamp or epoch milliseconds; raises ValueError"""
+    if value.isdigit():
+        return EPOCH + timedelta(milliseconds=int(value))
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Invalid '{name}' timestamp: {value}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
 class Message:
     def __init__(self, content, sender, session_id):
         self.content = content
         self.sender = sender
         self.session_id = session_id
-        self.timestamp = datetime.utcnow()
+        # MongoDB keeps millisecond precision; match it so cached and stored
+        # copies of a message compare the same
+        now = datetime.utcnow()
+        self.timestamp = now.replace(microsecond=now.microsecond // 1000 * 1000)
 
     def to_dict(self):
         return {
@@ -18,11 +55,164 @@ class Message:
 
     @staticmethod
     def save(message):
-        db = get_db()
-        db.messages.insert_one(message.to_dict())
+        document = message.to_dict()
+        if write_behind is not None:
+            write_behind.enqueue(document)
+        else:
+            message_store.insert(document)
+        conversation_cache.append(message.session_id, document)
+
+    @staticmethod
+    async def save_async(message):
+        document = message.to_dict()
+        if write_behind is None or not write_behind.enqueue(document, block=False):
+            await message_store.insert_async(document)
+        conversation_cache.append(message.session_id, document)
+
+    @staticmethod
+    def save_many(documents):
+        """Save message documents (from `to_dict`) with one bulk write"""
+        if write_behind is not None:
+            for document in documents:
+                write_behind.enqueue(document)
+        else:
+            message_store.insert_many(documents)
+        for document in documents:
+            conversation_cache.append(document['session_id'], document)
+
+    @staticmethod
+    async def save_many_async(documents):
+        remaining = documents
+        if write_behind is not None:
+            remaining = [document for document in documents if not write_behind.enqueue(document, block=False)]
+        if remaining:
+            await message_store.insert_many_async(remaining)
+        for document in documents:
+            conversation_cache.append(document['session_id'], document)
+
+    @staticmethod
+    def _with_pending(session_id, messages, after=None):
+        """Merge in messages still waiting in the write-behind queue (read-your-writes)"""
+        if write_behind is None:
+            return messages
+        pending = write_behind.pending(session_id)
+        if not pending:
+            return messages
+        stored_ids = {msg['_id'] for msg in messages}
+        for doc in pending:
+            if doc['_id'] not in stored_ids and (after is None or is_after(message_cursor(doc), after)):
+                messages.append(doc)
+        messages.sort(key=message_cursor)
+        return messages
 
     @staticmethod
     def get_by_session(session_id):
+        return Message.get_since(session_id)
+
+    @staticmethod
+    async def get_by_session_async(session_id):
+        return await Message.get_since_async(session_id)
+
+    @staticmethod
+    def get_since(session_id, after=None, after_id=None):
+        """Messages of a session newer than the message at (`after`, `after_id`).
+
+        MongoDB stores timestamps with millisecond precision, so `_id` breaks
+        ties between messages saved in the same millisecond."""
+        cursor = (after, after_id) if after is not None else None
+        cached = conversation_cache.get(session_id, cursor)
+        if cached is not None:
+            return cached
+
+        messages = Message._with_pending(session_id, message_store.find(session_id, after=cursor), cursor)
+        conversation_cache.put(session_id, messages, cursor)
+        return messages
+
+    @staticmethod
+    async def get_since_async(session_id, after=None, after_id=None):
+        cursor = (after, after_id) if after is not None else None
+        cached = conversation_cache.get(session_id, cursor)
+        if cached is not None:
+            return cached
+
+        messages = Message._with_pending(session_id, await message_store.find_async(session_id, after=cursor), cursor)
+        conversation_cache.put(session_id, messages, cursor)
+        return messages
+
+    @staticmethod
+    def _finish_page(session_id, messages, before, after, limit, forward, from_cache=False):
+        if not from_cache:
+            messages = Message._with_pending(session_id, messages, after)
+        if before is not None:
+            messages = [msg for msg in messages if is_after(before, message_cursor(msg))]
+        if forward:
+            return messages[:limit], len(messages) > limit
+        return messages[-limit:] if limit else [], len(messages) > limit
+
+    @staticmethod
+    def get_page(session_id, before=None, after=None, limit=50):
+        """Up to `limit` messages of a session in chronological order, and whether there are more.
+
+        With `after` (a (timestamp, _id) cursor) this is the oldest messages
+        newer than it, and "more" means newer ones; otherwise it is the newest
+        messages (older than `before` if given), and "more" means older ones.
+        Reads fetch at most `limit + 1` messages through the store's index."""
+        forward = after is not None
+        cached = conversation_cache.get(session_id, after)
+        if cached is not None:
+            return Message._finish_page(session_id, cached, before, after, limit, forward, from_cache=True)
+
+        messages = message_store.find(session_id, after=after, before=before, limit=limit + 1,
+                                      newest=not forward, projection=HISTORY_PROJECTION)
+        return Message._finish_page(session_id, messages, before, after, limit, forward)
+
+    @staticmethod
+    async def get_page_async(session_id, before=None, after=None, limit=50):
+        forward = after is not None
+        cached = conversation_cache.get(session_id, after)
+        if cached is not None:
+            return Message._finish_page(session_id, cached, before, after, limit, forward, from_cache=True)
+
+        messages = await message_store.find_async(session_id, after=after, before=before, limit=limit + 1,
+                                                  newest=not forward, projection=HISTORY_PROJECTION)
+        return Message._finish_page(session_id, messages, before, after, limit, forward)
+
+class SessionSummary:
+    """Rolling summary of the part of a conversation that no longer fits the prompt"""
+
+    @staticmethod
+    def get(session_id):
         db = get_db()
-        messages = db.messages.find({'session_id': session_id}).sort('timestamp', 1)
-        return [msg for msg in messages] 
\ No newline at end of file
+        return db.session_summaries.find_one({'session_id': session_id})
+
+    @staticmethod
+    async def get_async(session_id):
+        db = get_async_db()
+        return await db.session_summaries.find_one({'session_id': session_id})
+
+    @staticmethod
+    def _update(summary, last_message):
+        return {'$set': {
+            'summary': summary,
+            'summarized_until': last_message['timestamp'],
+            'summarized_until_id': last_message.get('_id'),
+            'updated_at': datetime.utcnow()
+        }}
+
+    @staticmethod
+    def save(session_id, summary, last_message):
+        db = get_db()
+        db.session_summaries.update_one(
+            {'session_id': session_id},
+            SessionSummary._update(summary, last_message),
+            upsert=True
+        )
+
+    @staticmethod
+    async def save_async(session_id, summary, last_message):
+        db = get_async_db()
+        await db.session_summaries.update_one(
+            {'session_id': session_id},
+            SessionSummary._update(summary, last_message),
+            upsert=True
+        )
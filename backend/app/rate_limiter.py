@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import weakref
+import itertools
+import logging
+import tempfile
+import threading
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Lower values are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class RateLimitTimeout(Exception):
+    """Raised when quota could not be acquired within the queue-wait timeout"""
+
+class Bucket:
+    """A token bucket definition. State lives in a bucket store."""
+
+    def __init__(self, name, capacity, refill_per_second):
+        self.name = name
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+
+    def clamp(self, amount):
+        # A single request larger than the bucket could never be served
+        return min(float(amount), self.capacity)
+
+def _take(state, demands, now):
+    """Atomically take `amount` from every bucket in `demands` or from none.
+
+    `state` maps bucket name to [tokens, updated_at]. Returns 0 when the
+    tokens were taken, otherwise the seconds until all buckets could serve
+    the demand.
+    """
+    levels = []
+    wait = 0.0
+    for bucket, amount in demands:
+        tokens, updated_at = state.get(bucket.name, (bucket.capacity, now))
+        tokens = min(bucket.capacity, tokens + max(0.0, now - updated_at) * bucket.refill_per_second)
+        levels.append(tokens)
+        if tokens < amount:
+            wait = max(wait, (amount - tokens) / bucket.refill_per_second)
+
+    if wait > 0:
+        return wait
+
+    for (bucket, amount), tokens in zip(demands, levels):
+        state[bucket.name] = [tokens - amount, now]
+    return 0.0
+
+class MemoryBucketStore:
+    """In-process bucket state. Used for single-process setups and tests."""
+
+    # Cheap enough to call on an event loop
+    blocking = False
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def take(self, demands):
+        with self._lock:
+            return _take(self._state, demands, self.clock())
+
+class FileBucketStore:
+    """Bucket state in a small JSON file guarded by flock.
+
+    Shares quota between all worker processes on the same host without any
+    extra infrastructure.
+    """
+
+    # Waits on a file lock: coroutines call it from a worker thread
+    blocking = True
+
+    def __init__(self, path):
+        import fcntl  # Unix only
+        self._fcntl = fcntl
+        self.path = path
+
+    def take(self, demands):
+        with open(self.path, 'a+') as f:
+            self._fcntl.flock(f, self._fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state = json.loads(raw) if raw else {}
+                wait = _take(state, demands, time.time())
+                if wait == 0:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                return wait
+            finally:
+                self._fcntl.flock(f, self._fcntl.LOCK_UN)
+
+class RedisBucketStore:
+    """Bucket state in Redis, shared across hosts. Requires the `redis` package."""
+
+    blocking = True
+
+    TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 3
+    local capacity = tonumber(ARGV[base + 1])
+    local rate = tonumber(ARGV[base + 2])
+    local amount = tonumber(ARGV[base + 3])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < amount then
+        wait = math.max(wait, (amount - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 3
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - tonumber(ARGV[base + 3])), 'ts', tostring(now))
+    redis.call('EXPIRE', key, 3600)
+end
+return '0'
+"""
+
+    def __init__(self, url, prefix='torko:ratelimit:'):
+        import redis
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, demands):
+        keys = [self.prefix + bucket.name for bucket, _ in demands]
+        args = [time.time()]
+        for bucket, amount in demands:
+            args.extend([bucket.capacity, bucket.refill_per_second, amount])
+        return float(self._script(keys=keys, args=args))
+
+class RateLimiter:
+    """Requests/minute and tokens/minute scheduler for an upstream API.
+
+    Callers queue by priority; only the head of the queue polls the bucket
+    store, and everyone else waits on a condition until it is their turn.
+    Waiting is bounded by a queue-wait timeout so a saturated quota turns
+    into a fast fallback instead of a thread stuck sleeping.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute, store,
+                 request_burst=None, queue_timeout=10.0):
+        self.request_bucket = Bucket(
+            f"{name}:rpm",
+            request_burst or requests_per_minute,
+            requests_per_minute / 60.0
+        )
+        self.token_bucket = Bucket(f"{name}:tpm", tokens_per_minute, tokens_per_minute / 60.0)
+        self.store = store
+        self.queue_timeout = queue_timeout
+        self._waiters = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._async_waiters = weakref.WeakKeyDictionary()  # event loop -> (heap, asyncio.Condition)
+
+    def _demands(self, tokens):
+        return [
+            (self.request_bucket, 1),
+            (self.token_bucket, self.token_bucket.clamp(tokens))
+        ]
+
+    def queued(self):
+        """Threads of this process waiting for quota"""
+        return len(self._waiters)
+
+    def try_acquire(self, tokens=1):
+        """Take quota without queueing. Returns 0 on success, else seconds to wait."""
+        return self.store.take(self._demands(tokens))
+
+    async def try_acquire_async(self, tokens=1):
+        """`try_acquire` for coroutines; a store that does I/O is called from a worker thread"""
+        if not self.store.blocking:
+            return self.try_acquire(tokens)
+        return await asyncio.to_thread(self.try_acquire, tokens)
+
+    def acquire(self, tokens=1, priority=PRIORITY_NORMAL, timeout=None):
+        """Block until quota for one request of `tokens` tokens is available.
+
+        Raises RateLimitTimeout if that takes longer than `timeout` seconds.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waiter = (priority, next(self._counter))
+
+        with self._cond:
+            heapq.heappush(self._waiters, waiter)
+            try:
+                while True:
+                    if self._waiters[0] == waiter:
+                        wait = self.try_acquire(tokens)
+                        if wait <= 0:
+                            return
+                    else:
+                        wait = timeout  # Woken up when the head leaves
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (self._waiters[0] == waiter and wait > remaining):
+                        raise RateLimitTimeout(
+                            f"Upstream quota not available within {timeout:.1f}s "
+                            f"({len(self._waiters)} waiting)"
+                        )
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    async def acquire_async(self, tokens=1, priority=PRIORITY_NORMAL, timeout=None):
+        """Coroutine version of `acquire`: waits with asyncio instead of blocking a thread.
+
+        Coroutines on the same event loop queue by priority among themselves;
+        the quota itself is still shared with every thread and process
+        through the bucket store.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waiter = (priority, next(self._counter))
+
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_waiters:
+            self._async_waiters[loop] = ([], asyncio.Condition())
+        waiters, cond = self._async_waiters[loop]
+
+        async with cond:
+            heapq.heappush(waiters, waiter)
+            try:
+                while True:
+                    if waiters[0] == waiter:
+                        wait = await self.try_acquire_async(tokens)
+                        if wait <= 0:
+                            return
+                    else:
+                        wait = timeout  # Woken up when the head leaves
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (waiters[0] == waiter and wait > remaining):
+                        raise RateLimitTimeout(
+                            f"Upstream quota not available within {timeout:.1f}s "
+                            f"({len(waiters)} waiting)"
+                        )
+                    try:
+                        await asyncio.wait_for(cond.wait(), min(wait, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                waiters.remove(waiter)
+                heapq.heapify(waiters)
+                cond.notify_all()
+
+def estimate_tokens(text):
+    """Rough token count for quota purposes (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+def create_store():
+    """Build the bucket store selected by RATE_LIMIT_BACKEND (memory, file or redis)"""
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'file').lower()
+    try:
+        if backend == 'redis':
+            return RedisBucketStore(os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+        if backend == 'file':
+            path = os.getenv('RATE_LIMIT_FILE', os.path.join(tempfile.gettempdir(), 'torko-rate-limit.json'))
+            return FileBucketStore(path)
+    except Exception as e:
+        logger.error("Error creating %s rate limit store, using in-process state: %s", backend, e)
+    return MemoryBucketStore()
+
+gemini_rate_limiter = RateLimiter(
+    'gemini',
+    requests_per_minute=float(os.getenv('GEMINI_RPM', 60)),
+    tokens_per_minute=float(os.getenv('GEMINI_TPM', 1000000)),
+    request_burst=float(os.getenv('GEMINI_RPM_BURST', 5)),
+    queue_timeout=float(os.getenv('RATE_LIMIT_QUEUE_TIMEOUT', 10)),
+    store=create_store()
+)
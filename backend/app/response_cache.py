@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from dotenv import load_dotenv
+from .database import get_db
+from .rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class MemoryResponseCacheBackend:
+    """In-process LRU of cached responses with per-entry expiry"""
+
+    blocking = False  # Cheap enough to call directly from an event loop
+
+    def __init__(self, max_entries=5000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def set(self, key, response, ttl):
+        with self._lock:
+            self._entries[key] = (response, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class MongoResponseCacheBackend:
+    """Cached responses in the `response_cache` collection, expired by a TTL index.
+
+    Shared by all workers; the TTL monitor only runs about once a minute, so
+    reads also filter on `expires_at`.
+    """
+
+    blocking = True
+
+    def __init__(self):
+        self._indexed = False
+
+    def _collection(self):
+        collection = get_db().response_cache
+        if not self._indexed:
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def get(self, key):
+        document = self._collection().find_one(
+            {'_id': key, 'expires_at': {'$gt': datetime.utcnow()}},
+            {'response': 1}
+        )
+        return document['response'] if document else None
+
+    def set(self, key, response, ttl):
+        self._collection().update_one(
+            {'_id': key},
+            {'$set': {
+                'response': response,
+                'expires_at': datetime.utcnow() + timedelta(seconds=ttl)
+            }},
+            upsert=True
+        )
+
+class ResponseCache:
+    """Exact-match cache of AI responses for prompts with little or no context.
+
+    Keys hash the normalised prompt payload (persona + context + message), so
+    only byte-identical prompts after normalisation share an answer. While a
+    key is being computed, concurrent misses for the same key in this process
+    wait for that result instead of calling upstream themselves. Coalescing
+    is per process only, even with the shared Mongo backend: each worker
+    that misses a key at the same time makes its own upstream call, and the
+    last one to finish writes the entry.
+    """
+
+    def __init__(self, backend, ttl=3600, max_context_tokens=0, wait_timeout=60.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_context_tokens = max_context_tokens
+        self.wait_timeout = wait_timeout
+        self._in_flight = {}  # key -> threading.Event
+        self._in_flight_async = {}  # key -> asyncio.Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def accepts(self, context):
+        """Whether a prompt with this context is small enough to be cached"""
+        if self.backend is None:
+            return False
+        context_tokens = sum(estimate_tokens(msg['content']) for msg in context) if context else 0
+        return context_tokens <= self.max_context_tokens
+
+    def key(self, model, payload):
+        """Hash of the model name and normalised request payload"""
+        serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(f"{model}\n{serialized}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        try:
+            response = self.backend.get(key)
+        except Exception as e:
+            logger.error("Error reading response cache: %s", e)
+            response = None
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def set(self, key, response):
+        try:
+            self.backend.set(key, response, self.ttl)
+        except Exception as e:
+            logger.error("Error writing response cache: %s", e)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached response for `key`, or compute and cache it.
+
+        `compute` returns None for results that must not be cached (such as
+        a failed upstream call); those are returned but not stored. Only
+        callers in this process wait for one another; other workers are not
+        coordinated with.
+        """
+        while True:
+            response = self.get(key)
+            if response is not None:
+                return response
+
+            with self._lock:
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    owner = True
+                else:
+                    owner = False
+                    self.coalesced += 1
+
+            if owner:
+                try:
+                    response = compute()
+                    if response is not None:
+                        self.set(key, response)
+                    return response
+                finally:
+                    with self._lock:
+                        del self._in_flight[key]
+                    event.set()
+
+            # Another request is computing this key; use its result if it
+            # produced one, otherwise compute it ourselves
+            if not event.wait(self.wait_timeout):
+                return compute()
+            response = self.get(key)
+            if response is not None:
+                return response
+            return compute()
+
+    async def get_async(self, key):
+        if getattr(self.backend, 'blocking', True):
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def set_async(self, key, response):
+        if getattr(self.backend, 'blocking', True):
+            await asyncio.to_thread(self.set, key, response)
+        else:
+            self.set(key, response)
+
+    async def get_or_compute_async(self, key, compute):
+        """Coroutine version of `get_or_compute`; `compute` is a coroutine function.
+
+        Concurrent misses on the same event loop wait for the first one's
+        result; as in `get_or_compute`, other loops and processes do not.
+        """
+        response = await self.get_async(key)
+        if response is not None:
+            return response
+
+        future = self._in_flight_async.get(key)
+        if future is not None:
+            with self._lock:
+                self.coalesced += 1
+            try:
+                response = await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+            except Exception:
+                response = None
+            return response if response is not None else await compute()
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight_async[key] = future
+        try:
+            response = await compute()
+            if response is not None:
+                await self.set_async(key, response)
+            return response
+        finally:
+            del self._in_flight_async[key]
+            future.set_result(response)  # Still None if compute() raised
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.backend is not None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+def create_backend():
+    """Build the backend selected by RESPONSE_CACHE_BACKEND (memory, mongo or none)"""
+    backend = os.getenv('RESPONSE_CACHE_BACKEND', 'memory').lower()
+    if backend == 'mongo':
+        return MongoResponseCacheBackend()
+    if backend == 'memory':
+        return MemoryResponseCacheBackend(int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000)))
+    return None
+
+response_cache = ResponseCache(
+    create_backend(),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 3600)),
+    max_context_tokens=int(os.getenv('RESPONSE_CACHE_MAX_CONTEXT_TOKENS', 0))
+)
@@ -1,21 +1,48 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context, after_this_request
 from .services import chat_service
 from .models import Message
+from .conversation_cache import conversation_cache
+from .write_behind import write_behind
+from .response_cache import response_cache
+from .context_cache import context_cache
+from .admission import admission_controller, AdmissionRejected, rejection_body
+from .warmup import warmup
+from .llm_router import llm_router
+from .export import HistoryExport, export_authorized
+from .fast_json import dumps as fast_dumps
+from . import metrics
+from contextlib import nullcontext
+import json
 import logging
 import os
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint('chat', __name__)
 
+def _admitted(session_id):
+    """Hold an admission slot for one turn of the session (no-op when admission control is off)"""
+    return admission_controller.admit(session_id) if admission_controller is not None else nullcontext()
+
+def _start_trace():
+    """Time this turn's stages; whatever the outcome, the response carries them as Server-Timing"""
+    metrics.start_trace()
+    after_this_request(_add_server_timing)
+
+def _add_server_timing(response):
+    # Also ends the trace
+    timing = metrics.server_timing()
+    if timing:
+        response.headers['Server-Timing'] = timing
+    return response
+
+def _rejected(error, session_id):
+    return jsonify(rejection_body(error, session_id)), error.status, {'Retry-After': str(error.retry_after)}
+
 @chat_bp.route('/chat', methods=['POST'])
 def chat():
     try:
-        logger.debug("Received chat request")
         data = request.json
-        logger.debug(f"Request data: {data}")
         
         message = data.get('message')
         session_id = data.get('session_id')
@@ -28,12 +55,17 @@ def chat():
             logger.warning("No session_id provided in request")
             return jsonify({'error': 'Session ID is required'}), 400
         
-        logger.debug(f"Processing message: {message} for session: {session_id}")
-        response = chat_service.process_message(message, session_id)
-        logger.debug(f"Response: {response}")
-        return jsonify(response)
+        logger.debug("Received chat request", extra={'session_id': session_id, 'user_message': message})
+        _start_trace()
+        with metrics.stage_timer('total'), _admitted(session_id):
+            response = chat_service.process_message(message, session_id)
+        logger.debug("Chat response ready",
+                     extra={'session_id': session_id, 'ai_response': response.get('response', '')})
+        return jsonify(response), 200
+    except AdmissionRejected as e:
+        return _rejected(e, session_id)
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
+        logger.error("Error in chat endpoint: %s", e)
         # Return a user-friendly error message
         return jsonify({
             'error': 'An unexpected error occurred. Please try again.',
@@ -41,26 +73,188 @@ def chat():
             'session_id': data.get('session_id') if 'data' in locals() else None
         }), 500
 
+def _sse_event(data, event=None):
+    """Format a Server-Sent Events message"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@chat_bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the AI response as Server-Sent Events.
+
+    Emits `data: {"delta": ...}` for each chunk, then a `done` event (or an
+    `error` event if the stream breaks after it started)."""
+    try:
+        logger.debug("Received streaming chat request")
+        data = request.json
+        
+        message = data.get('message')
+        session_id = data.get('session_id')
+        
+        if not message:
+            logger.warning("No message provided in request")
+            return jsonify({'error': 'Message is required'}), 400
+        
+        if not session_id:
+            logger.warning("No session_id provided in request")
+            return jsonify({'error': 'Session ID is required'}), 400
+        
+        # Pull the first chunk before committing to a 200 so that failures
+        # up to the first byte still get a regular JSON error response
+        _start_trace()
+        ticket = admission_controller.acquire(session_id) if admission_controller is not None else None
+        try:
+            chunks = chat_service.stream_message(message, session_id)
+            with metrics.stage_timer('first_chunk'):
+                first_chunk = next(chunks, '')
+        except Exception:
+            if ticket is not None:
+                admission_controller.release(ticket)
+            raise
+    except AdmissionRejected as e:
+        return _rejected(e, session_id)
+    except Exception as e:
+        logger.error("Error in chat stream endpoint: %s", e)
+        return jsonify({
+            'error': 'An unexpected error occurred. Please try again.',
+            'response': 'I apologize, but I encountered an error while processing your request. Please try again in a moment.',
+            'session_id': data.get('session_id') if 'data' in locals() and data else None
+        }), 500
+    
+    def generate():
+        try:
+            yield _sse_event({'delta': first_chunk})
+            for chunk in chunks:
+                yield _sse_event({'delta': chunk})
+            yield _sse_event({'session_id': session_id}, event='done')
+        except Exception as e:
+            logger.error("Error while streaming chat response: %s", e)
+            yield _sse_event({'error': 'The response stream was interrupted.'}, event='error')
+        finally:
+            chunks.close()
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    if ticket is not None:
+        # The turn holds its slot until the stream is finished or abandoned
+        response.call_on_close(lambda: admission_controller.release(ticket))
+    return response
+
+@chat_bp.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Run many chat turns and stream one NDJSON line per item as it completes.
+
+    Body: `{"items": [{"session_id": ..., "message": ...}, ...], "max_workers": n}`
+    (`max_workers` is optional). See ChatService.process_batch for the lines."""
+    data = request.get_json(silent=True) or {}
+    results = chat_service.process_batch(data.get('items'), data.get('max_workers'))
+    try:
+        # Validation happens on the first pull, before committing to a 200
+        first_result = next(results)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Error in chat batch endpoint: %s", e)
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+
+    def generate():
+        try:
+            yield json.dumps(first_result) + '\n'
+            for result in results:
+                yield json.dumps(result) + '\n'
+        finally:
+            results.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @chat_bp.route('/history', methods=['GET'])
 def get_history():
+    """The session's messages as a list, or with any of `limit`, `before`, `after`
+    or `since` a page of them: the newest `limit`, older ones with
+    `before=<prev_cursor>`, and only new ones with `after=<next_cursor>` or
+    `since=<timestamp>`"""
     session_id = request.args.get('session_id')
     try:
-        history = chat_service.get_chat_history(session_id)
-        return jsonify(history)
+        history = chat_service.get_chat_history(
+            session_id,
+            before=request.args.get('before'),
+            after=request.args.get('after'),
+            since=request.args.get('since'),
+            limit=request.args.get('limit')
+        )
+        return Response(fast_dumps(history), mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@chat_bp.route('/history/export', methods=['GET'])
+def export_history():
+    """Stored messages as gzip-compressed NDJSON, streamed from the database.
+
+    Requires `Authorization: Bearer <EXPORT_TOKEN>`. Filters: `session_id`
+    (repeatable or comma-separated), `start` and `end` (ISO 8601 or epoch
+    ms), and `gzip=false` for plain NDJSON."""
+    if not export_authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Not authorized'}), 403
+    try:
+        export = HistoryExport.from_args(
+            request.args.getlist('session_id'),
+            start=request.args.get('start'),
+            end=request.args.get('end'),
+            compress=request.args.get('gzip', 'true').lower() != 'false'
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(
+        stream_with_context(export.chunks()),
+        mimetype=export.content_type,
+        headers={
+            'Content-Disposition': f'attachment; filename="{export.filename}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @chat_bp.route('/session', methods=['POST'])
 def create_session():
     try:
         logger.debug("Creating new session")
         session_id = chat_service.create_session()
-        logger.debug(f"Session created with ID: {session_id}")
+        logger.debug("Session created", extra={'session_id': session_id})
         return jsonify({'session_id': session_id})
     except Exception as e:
-        logger.error(f"Error creating session: {str(e)}")
+        logger.error("Error creating session: %s", e)
         return jsonify({'error': str(e)}), 500
 
+@chat_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics, summed across all worker processes"""
+    try:
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        logger.error("Error rendering metrics: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@chat_bp.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness check: 503 until this worker has warmed up (see `/health` for liveness)"""
+    stats = warmup.stats()
+    return jsonify(stats), 200 if warmup.ready else 503
+
 @chat_bp.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to monitor service status"""
@@ -71,10 +265,16 @@ def health_check():
         return jsonify({
             'status': 'healthy',
             'api_key_configured': api_key_configured,
-            'service': 'chatbot-backend'
+            'service': 'chatbot-backend',
+            'conversation_cache': conversation_cache.stats(),
+            'write_behind': write_behind.stats() if write_behind is not None else None,
+            'response_cache': response_cache.stats(),
+            'context_cache': context_cache.stats() if context_cache is not None else None,
+            'admission': admission_controller.stats() if admission_controller is not None else None,
+            'llm_backends': llm_router.stats()
         })
     except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
+        logger.error("Health check failed: %s", e)
         return jsonify({
             'status': 'unhealthy',
             'error': str(e)
@@ -1,89 +1,390 @@
 import os
+import json
 import requests
-from datetime import datetime
 import uuid
 import logging
 import time
+import queue
 import random
-from .models import Message
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from .models import Message, SessionSummary, encode_cursor, decode_cursor, parse_timestamp
+from .context_builder import context_builder
+from .matcher import keyword_matcher
+from .response_cache import response_cache
+from .metrics import (stage_timer, UPSTREAM_RESPONSES, RETRIES, FALLBACKS, TORKO_SHORTCIRCUITS, PROMPT_CHARS, BATCH_ITEMS,
+                      HEDGES, DEADLINE_EXHAUSTED)
+from .deadline import Deadline, upstream_latency, hedging_enabled
+from .context_cache import context_cache, payload_tokens
+from .llm_client import llm_client
+from .rate_limiter import PRIORITY_NORMAL, PRIORITY_LOW
+from .llm_router import llm_router, FakeUpstreamError
+from . import flows
+from .flows import Step
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 1000))
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 4))
+BATCH_TURN_DEADLINE_SECONDS = float(os.getenv('BATCH_TURN_DEADLINE_SECONDS', 60))
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 500))
+
+_hedge_executors = {}  # pid -> ThreadPoolExecutor
+
+def _hedge_executor():
+    """Thread pool running hedged attempts, created on first use in each process"""
+    executor = _hedge_executors.get(os.getpid())
+    if executor is None:
+        executor = _hedge_executors.setdefault(
+            os.getpid(),
+            ThreadPoolExecutor(max_workers=int(os.getenv('LLM_HEDGE_THREADS', 32)), thread_name_prefix='llm-hedge')
+        )
+    return executor
+
+PERSONA = """You are Torko, an intellectually curious and thoughtfully argumentative AI assistant. Your core traits:
+
+PERSONALITY:
+- You don't just agree with everything - you challenge ideas constructively
+- You present counterarguments and alternative perspectives when appropriate
+- You're passionate about logical reasoning and critical thinking
+- You encourage deeper analysis and question assumptions
+- You're respectful but not afraid to disagree when you have valid points
+
+DEBATE APPROACH:
+- Present evidence-based counterpoints when you disagree
+- Ask probing questions that challenge the user's reasoning
+- Offer alternative viewpoints even if the user seems confident
+- Point out logical fallacies or weak arguments (politely)
+- Encourage the user to defend their positions with better reasoning
+- Play devil's advocate when it leads to better understanding
+
+GUIDELINES:
+- Be intellectually honest - only argue positions you can defend with logic/evidence
+- Stay respectful and constructive, never personal or hostile
+- If you genuinely agree, say so, but explain why thoroughly
+- When you disagree, provide specific reasons and evidence
+- Ask follow-up questions that push for deeper thinking
+- Acknowledge when the user makes good points that change your perspective
+
+Remember: The goal is stimulating, educational debate that helps both parties think more deeply - not winning arguments."""
+
+# Sent with every request, so it is serialized once here rather than per call
+SYSTEM_INSTRUCTION = {'parts': [{'text': PERSONA}]}
+_SYSTEM_INSTRUCTION_JSON = json.dumps({'systemInstruction': SYSTEM_INSTRUCTION})[:-1]
+
+def encode_payload(payload):
+    """JSON request body for a Gemini payload, reusing the pre-serialized persona"""
+    if payload.get('systemInstruction') is not SYSTEM_INSTRUCTION:
+        return json.dumps(payload).encode('utf-8')
+    rest = json.dumps({key: value for key, value in payload.items() if key != 'systemInstruction'})
+    return f"{_SYSTEM_INSTRUCTION_JSON},{rest[1:]}".encode('utf-8')
+
+def payload_chars(payload):
+    """Characters of prompt text in a payload (what is actually uploaded for this turn)"""
+    total = sum(len(part['text']) for part in (payload.get('systemInstruction') or {}).get('parts', []))
+    for content in payload['contents']:
+        total += sum(len(part.get('text', '')) for part in content['parts'])
+    return total
+
 class ChatService:
+    """Chat turns, streams and batches, with the blocking clients.
+
+    The turn logic is written as flows (see `flows`): generators that yield
+    a `Step` for each I/O call, run by `_run` and `_stream`. AsyncChatService
+    runs the same flows with coroutine versions of the I/O steps.
+    """
+
+    client = llm_client
+    # Errors of an upstream stream that is cut off after the first chunk
+    stream_errors = requests.exceptions.RequestException
+
     def __init__(self):
-        self.model = "gemini-2.0-flash"  # Using Gemini model
-        self.api_key = os.getenv('GEMINI_API_KEY')
-        self.api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-        self.last_request_time = 0
-        self.min_request_interval = 1.0  # Minimum 1 second between requests
+        # Upstream backends; the first one is the primary (see llm_router)
+        self.router = llm_router
+        self.model = self.router.primary.model
         logger.debug("ChatService initialized")
 
+    def _run(self, flow):
+        """Run a flow (see `flows`), performing its I/O steps with this service's blocking methods"""
+        return flows.run(flow, self)
+
+    def _stream(self, flow):
+        return flows.stream(flow, self)
+
     def process_message(self, message, session_id):
-        try:
-            # Save user message
-            user_message = Message(message, 'user', session_id)
-            Message.save(user_message)
+        return self._run(self._process_message(message, session_id))
 
+    def _process_message(self, message, session_id):
+        deadline = Deadline.start()
+        try:
             # Check if user is asking about Torko
             torko_response = self._handle_torko_query(message)
             if torko_response:
-                # Save Torko self-description response
-                ai_message = Message(torko_response, 'assistant', session_id)
-                Message.save(ai_message)
+                TORKO_SHORTCIRCUITS.inc()
+                # Save user message and Torko self-description response
+                with stage_timer('save'):
+                    yield Step('_save', Message(message, 'user', session_id))
+                    yield Step('_save', Message(torko_response, 'assistant', session_id))
                 
                 return {
                     'response': torko_response,
                     'session_id': session_id
                 }
 
-            # Get chat history for context
-            history = Message.get_by_session(session_id)
-            context = self._format_context(history)
+            # Get token-budgeted chat history for context (before the new
+            # message is saved, since the prompt adds it separately)
+            context = yield from self._read_context(session_id)
+
+            # Save user message
+            with stage_timer('save_user'):
+                yield Step('_save', Message(message, 'user', session_id))
 
-            # Get AI response
-            response = self._get_ai_response(context, message)
+            # Get AI response within what is left of the turn's deadline
+            response = yield from self._get_ai_response(context, message, deadline, session_id)
 
             # Save AI response
-            ai_message = Message(response, 'assistant', session_id)
-            Message.save(ai_message)
+            with stage_timer('save_assistant'):
+                yield Step('_save', Message(response, 'assistant', session_id))
 
             return {
                 'response': response,
                 'session_id': session_id
             }
         except Exception as e:
-            logger.error(f"Error processing message: {str(e)}")
+            logger.error("Error processing message: %s", e)
             raise
 
-    def get_chat_history(self, session_id):
+    def stream_message(self, message, session_id):
+        """Process a message and yield the assistant response as text chunks.
+
+        The full response is saved once the stream finishes (or is cut short
+        by the client disconnecting)."""
+        return self._stream(self._stream_message(message, session_id))
+
+    def _stream_message(self, message, session_id):
+        deadline = Deadline.start()
+        # Check if user is asking about Torko
+        torko_response = self._handle_torko_query(message)
+        if torko_response:
+            TORKO_SHORTCIRCUITS.inc()
+            yield Step('_save', Message(message, 'user', session_id))
+            yield Step('_save', Message(torko_response, 'assistant', session_id))
+            yield torko_response
+            return
+
+        # Get token-budgeted chat history for context
+        context = yield from self._read_context(session_id)
+
+        # Save user message
+        with stage_timer('save_user'):
+            yield Step('_save', Message(message, 'user', session_id))
+
+        streamed = []
+        try:
+            yield from self._stream_ai_response(context, message, deadline, session_id, streamed)
+        finally:
+            if streamed:
+                yield Step('_save', Message(''.join(streamed), 'assistant', session_id))
+
+    def _read_context(self, session_id):
+        """The session's token-budgeted history, formatted as prompt context"""
+        with stage_timer('history_read'):
+            summary, history = yield Step('_build_context', session_id)
+            return self._format_context(history, summary)
+
+    def process_batch(self, items, max_workers=None):
+        """Run many chat turns, yielding each item's result as soon as it is ready.
+
+        `items` is a list of {session_id, message}. Sessions run in parallel
+        on up to `max_workers` threads and the turns of one session run in
+        order; upstream calls wait for quota at low priority, so interactive
+        chats go first. Results are {index, session_id, response} or
+        {index, session_id, error} in completion order, followed by a
+        {done, items, errors} summary. A result with `error` but no `index`
+        means a session's messages could not be saved.
+        """
+        sessions, workers = self._plan_batch(items, max_workers)
+        results = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+        for session_id, turns in sessions.items():
+            executor.submit(self._run, self._run_batch_session(session_id, turns, results.put))
+        counts = {'items': 0, 'errors': 0}
+        remaining = len(sessions)
+        try:
+            while remaining:
+                result = results.get()
+                if result is None:  # A session finished
+                    remaining -= 1
+                    continue
+                yield self._count_batch_result(counts, result)
+            yield {'done': True, **counts}
+        finally:
+            # Sessions already running finish and save in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _plan_batch(self, items, max_workers):
+        """Validate batch items; returns ({session_id: [(index, message)]}, workers) or raises ValueError"""
+        if not isinstance(items, list) or not items:
+            raise ValueError("'items' must be a non-empty list")
+        if len(items) > BATCH_MAX_ITEMS:
+            raise ValueError(f"At most {BATCH_MAX_ITEMS} items per batch")
+        sessions = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('message') or not item.get('session_id'):
+                raise ValueError(f"Item {index} needs a 'message' and a 'session_id'")
+            sessions.setdefault(item['session_id'], []).append((index, item['message']))
+        try:
+            workers = BATCH_MAX_WORKERS if max_workers in (None, '') else int(max_workers)
+        except (TypeError, ValueError):
+            raise ValueError("'max_workers' must be a positive integer")
+        if workers < 1:
+            raise ValueError("'max_workers' must be a positive integer")
+        return sessions, min(workers, BATCH_MAX_WORKERS, len(sessions))
+
+    def _count_batch_result(self, counts, result):
+        if 'index' in result:
+            counts['items'] += 1
+        if 'error' in result:
+            counts['errors'] += 1
+        BATCH_ITEMS.inc(outcome='error' if 'error' in result else 'ok')
+        return result
+
+    def _batch_turn(self, session_id, message):
+        """The user message document, and whether the turn needs the AI (else the Torko answer)"""
+        torko_response = self._handle_torko_query(message)
+        if torko_response:
+            TORKO_SHORTCIRCUITS.inc()
+        return Message(message, 'user', session_id).to_dict(), torko_response
+
+    def _batch_error(self, index, session_id):
+        return {
+            'index': index,
+            'session_id': session_id,
+            'error': 'An unexpected error occurred. Please try again.'
+        }
+
+    def _run_batch_session(self, session_id, turns, emit):
+        """Flow running one session's batch turns in order, then saving its messages with one bulk write"""
+        documents = []
+        summary, folded_until = None, None
+        done = 0
+        try:
+            with stage_timer('history_read'):
+                summary, history = yield Step('_build_context', session_id)
+            for index, message in turns:
+                user_document, response = self._batch_turn(session_id, message)
+                if not response:
+                    context = self._format_context(history, summary)
+                    response = yield from self._get_ai_response(
+                        context, message, Deadline.start(BATCH_TURN_DEADLINE_SECONDS), session_id, PRIORITY_LOW
+                    )
+                turn = [user_document, Message(response, 'assistant', session_id).to_dict()]
+                documents.extend(turn)
+                summary, history, folded = context_builder.extend(session_id, summary, history, turn)
+                if folded:
+                    folded_until = folded[-1]
+                emit({'index': index, 'session_id': session_id, 'response': response})
+                done += 1
+        except Exception as e:
+            logger.error("Error processing batch turns for session %s: %s", session_id, e)
+            for index, _ in turns[done:]:
+                emit(self._batch_error(index, session_id))
+        try:
+            if documents:
+                with stage_timer('save'):
+                    yield Step('_save_batch', session_id, documents, summary, folded_until)
+        except Exception as e:
+            logger.error("Error saving batch messages for session %s: %s", session_id, e)
+            emit({'session_id': session_id, 'error': 'The messages of this session could not be saved.'})
+        finally:
+            emit(None)  # Tells the collector this session is finished
+
+    def get_chat_history(self, session_id, before=None, after=None, since=None, limit=None):
+        """A session's whole history as a list, or one page of it (see `_history_page`)
+        when any of the paging arguments is given (see `_history_window`)"""
+        return self._run(self._get_chat_history(session_id, before, after, since, limit))
+
+    def _get_chat_history(self, session_id, before, after, since, limit):
         try:
-            messages = Message.get_by_session(session_id)
-            return [{
-                'content': msg['content'],
-                'sender': msg['sender'],
-                'timestamp': msg['timestamp']
-            } for msg in messages]
+            if not (before or after or since or limit):
+                messages = yield Step('_get_messages', session_id)
+                return self._history_messages(messages)
+            before, after, limit = self._history_window(before, after, since, limit)
+            messages, has_more = yield Step('_get_page', session_id, before, after, limit)
+            return self._history_page(messages, has_more, before, after)
+        except ValueError:
+            raise
         except Exception as e:
-            logger.error(f"Error getting chat history: {str(e)}")
+            logger.error("Error getting chat history: %s", e)
             raise
 
+    def _history_window(self, before, after, since, limit):
+        """Decode history query parameters into (before, after, limit); raises ValueError.
+
+        `before` and `after` are cursors from an earlier page, `since` is an
+        ISO 8601 timestamp or epoch milliseconds (messages strictly newer),
+        and `limit` is capped at HISTORY_MAX_PAGE_SIZE."""
+        if after and since:
+            raise ValueError("Use either 'after' or 'since', not both")
+        try:
+            limit = HISTORY_PAGE_SIZE if limit in (None, '') else int(limit)
+        except (TypeError, ValueError):
+            raise ValueError("'limit' must be a positive integer")
+        if limit < 1:
+            raise ValueError("'limit' must be a positive integer")
+        limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+        before = decode_cursor(before) if before else None
+        if after:
+            after = decode_cursor(after)
+        elif since:
+            after = (parse_timestamp(since), None)
+        else:
+            after = None
+        return before, after, limit
+
+    def _history_page(self, messages, has_more, before, after):
+        """History API response.
+
+        Pass `prev_cursor` as `before` for older messages and `next_cursor`
+        as `after` to fetch only messages added since this page."""
+        return {
+            'messages': self._history_messages(messages),
+            'has_more': has_more,
+            'prev_cursor': encode_cursor(messages[0]) if messages else None,
+            'next_cursor': encode_cursor(messages[-1]) if messages else (
+                encode_cursor({'timestamp': after[0], '_id': after[1]}) if after and after[1] else None
+            )
+        }
+
+    def _history_messages(self, messages):
+        return [{
+            'content': msg['content'],
+            'sender': msg['sender'],
+            'timestamp': msg['timestamp']
+        } for msg in messages]
+
     def create_session(self):
         try:
             session_id = str(uuid.uuid4())
-            logger.debug(f"Generated new session ID: {session_id}")
+            logger.debug("Generated new session ID", extra={'session_id': session_id})
             return session_id
         except Exception as e:
-            logger.error(f"Error creating session: {str(e)}")
+            logger.error("Error creating session: %s", e)
             raise
 
-    def _format_context(self, history):
+    def _format_context(self, history, summary=None):
         try:
             formatted_history = []
+            if summary:
+                formatted_history.append({
+                    'role': 'summary',
+                    'content': summary
+                })
             for msg in history:
                 role = 'user' if msg['sender'] == 'user' else 'assistant'
                 formatted_history.append({
@@ -92,23 +393,14 @@ class ChatService:
                 })
             return formatted_history
         except Exception as e:
-            logger.error(f"Error formatting context: {str(e)}")
+            logger.error("Error formatting context: %s", e)
             raise
 
     def _handle_torko_query(self, user_input):
         """Handle queries about Torko itself"""
         try:
-            # Keywords and phrases that indicate user is asking about Torko
-            torko_keywords = [
-                'torko', 'what is torko', 'about torko', 'tell me about torko',
-                'who are you', 'what are you', 'describe yourself', 'what do you do',
-                'your name', 'introduce yourself', 'about yourself'
-            ]
-            
-            user_input_lower = user_input.lower().strip()
-            
             # Check if the user input contains any Torko-related keywords
-            if any(keyword in user_input_lower for keyword in torko_keywords):
+            if keyword_matcher.matches(user_input, 'torko_query'):
                 return """🤖 **Torko AI Chatbot**
 
 Hello! I'm Torko, an intellectually curious and thoughtfully argumentative AI assistant designed to engage you in meaningful discussions and debates.
@@ -143,210 +435,483 @@ Ready for a real conversation? Let's dive in! 🥊🧠"""
             return None
             
         except Exception as e:
-            logger.error(f"Error handling Torko query: {str(e)}")
+            logger.error("Error handling Torko query: %s", e)
             return None
 
     def _enhance_argumentative_context(self, message):
         """Add argumentative context cues based on message content"""
         try:
-            message_lower = message.lower()
-            
-            # Detect statement patterns that could benefit from debate
-            debate_triggers = [
-                'i think', 'i believe', 'in my opinion', 'i feel that',
-                'everyone knows', 'it\'s obvious', 'clearly', 'definitely',
-                'always', 'never', 'all', 'none', 'every', 'no one',
-                'should', 'must', 'have to', 'need to'
-            ]
-            
-            controversial_topics = [
-                'politics', 'religion', 'economics', 'philosophy', 'ethics',
-                'climate', 'technology', 'society', 'education', 'healthcare',
-                'artificial intelligence', 'future', 'progress', 'tradition'
-            ]
-            
-            has_debate_trigger = any(trigger in message_lower for trigger in debate_triggers)
-            has_controversial_topic = any(topic in message_lower for topic in controversial_topics)
+            # Detect statement patterns or topics that could benefit from debate
+            categories = keyword_matcher.classify(message)
             
-            if has_debate_trigger or has_controversial_topic:
+            if 'debate_trigger' in categories or 'controversial_topic' in categories:
                 return "\n\n[DEBATE MODE: The user has made a statement or claim. Consider presenting counterarguments, alternative perspectives, or probing questions to encourage deeper thinking. Challenge assumptions respectfully while being evidence-based.]"
             
             return ""
             
         except Exception as e:
-            logger.error(f"Error enhancing argumentative context: {str(e)}")
+            logger.error("Error enhancing argumentative context: %s", e)
             return ""
 
-    def _get_ai_response(self, context, message):
-        # Rate limiting - ensure minimum interval between requests
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < self.min_request_interval:
-            sleep_time = self.min_request_interval - time_since_last_request
-            logger.debug(f"Rate limiting: sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
+    def _acquire_quota(self, payload, priority=PRIORITY_NORMAL, deadline=None, exclude=()):
+        """Pick a backend and wait for its quota (shared across workers).
+
+        Returns the backend, or None if every circuit is open or the queue
+        wait timed out. Backends in `exclude` are only used as a last resort."""
+        tokens = payload_tokens(payload)
+        with stage_timer('rate_limit_wait'):
+            return self.router.acquire(tokens, priority=priority, timeout=self._quota_timeout(deadline),
+                                       exclude=exclude)
+
+    def _quota_timeout(self, deadline):
+        """Queue-wait limit that still leaves time for the attempt itself"""
+        if deadline is None:
+            return None
+        return max(0.0, min(self.router.queue_timeout, deadline.remaining() - deadline.min_attempt))
+
+    def _max_attempts(self):
+        # Three tries, plus one failover to each other backend
+        return 3 + len(self.router.providers) - 1
+
+    def _uses_context_cache(self, provider=None):
+        """The Gemini context cache belongs to the primary backend"""
+        primary = self.router.primary
+        return context_cache is not None and primary.kind == 'gemini' and provider in (None, primary)
+
+    def _failover_delay(self, provider, error, tried, backoffs, retries_left, deadline):
+        """Seconds to wait before the next attempt after `provider` failed with `error`, or None to give up.
+
+        Fails over to an untried backend straight away; only when none is
+        left does it retry (with backoff, if the error is retriable)."""
+        tried.add(provider)
+        if self.router.has_alternative(tried):
+            return 0.0
+        if not retries_left:
+            return None
+        delay = self._retry_delay(error, backoffs)
+        if delay is None:
+            # Non-retriable error
+            return None
+        if not deadline.allows_attempt(delay):
+            DEADLINE_EXHAUSTED.inc()
+            logger.warning("Not retrying: %.2fs left, backoff is %.2fs", deadline.remaining(), delay)
+            return None
+        return delay
+
+    def _build_payload(self, context, message):
+        """Build the Gemini request payload for a conversation turn.
+
+        The persona goes in `systemInstruction` (the same object every turn)
+        and the conversation in role-tagged `contents`, with consecutive
+        turns of the same role merged as Gemini expects alternating roles."""
+        contents = []
         
-        self.last_request_time = time.time()
+        def add(role, text):
+            if contents and contents[-1]['role'] == role:
+                contents[-1]['parts'].append({'text': text})
+            else:
+                contents.append({'role': role, 'parts': [{'text': text}]})
         
-        max_retries = 3
+        for msg in context:
+            if msg['role'] == 'summary':
+                add('user', f"[Summary of the earlier conversation]\n{msg['content']}\n[End of summary]")
+                continue
+            add('user' if msg['role'] == 'user' else 'model', msg['content'])
+        
+        # Add argumentative enhancement based on current message
+        argumentative_context = self._enhance_argumentative_context(message)
+        add('user', f"{message}{argumentative_context}")
+        
+        return {
+            'systemInstruction': SYSTEM_INSTRUCTION,
+            'contents': contents
+        }
+
+    def _prepare_request(self, context, message, session_id=None, deadline=None):
+        """Flow building the payload for an upstream call (timed and size-tracked).
+
+        Returns (full_payload, payload): `payload` is what to send to the
+        primary backend, which references the session's Gemini context cache
+        when one covers the earlier turns; `full_payload` is the
+        self-contained equivalent, used for quota estimates, for the other
+        backends and if the cache reference is rejected."""
+        with stage_timer('prompt_build'):
+            full_payload = self._build_payload(context, message)
+        payload = full_payload
+        if self._uses_context_cache() and session_id is not None:
+            with stage_timer('context_cache'):
+                payload = yield Step('_prepare_context_cache', session_id, full_payload, deadline or Deadline.start())
+        PROMPT_CHARS.observe(payload_chars(payload))
+        return full_payload, payload
+
+    def _cache_request(self, body, deadline):
+        """Keyword arguments of `_post_upstream` for creating a Gemini context cache"""
+        return {
+            'data': encode_payload(body),
+            'headers': self.router.primary.headers(),
+            'total_timeout': deadline.timeout(self.client.total_timeout)
+        }
+
+    def _upstream_request(self, provider, payload, deadline, stream=False):
+        """(url, keyword arguments of `_post_upstream`) for a call to `provider`"""
+        url, params = provider.endpoint(stream=stream)
+        kwargs = {
+            'params': params,
+            'data': encode_payload(provider.body(payload, stream=stream)),
+            'headers': provider.headers(),
+            'connect_timeout': deadline.timeout(self.client.connect_timeout)
+        }
+        if stream:
+            kwargs.update(stream=True, read_timeout=deadline.timeout(self.client.read_timeout))
+        else:
+            kwargs['total_timeout'] = deadline.timeout(self.client.total_timeout)
+        return url, kwargs
+
+    def _is_service_error(self, ai_response):
+        """Check if the AI is returning error messages indicating service issues"""
+        return keyword_matcher.matches(ai_response, 'service_error')
+
+    def _error_status(self, error):
+        """HTTP status of a failed upstream call, or None for connection errors and bad payloads"""
+        # HTTP errors from requests and httpx both carry the response
+        return getattr(getattr(error, 'response', None), 'status_code', None)
+
+    def _retry_delay(self, error, attempt):
+        """Return the backoff delay before retrying after `error`, or None if it is not retriable"""
         base_delay = 1  # Base delay in seconds
         
-        for attempt in range(max_retries):
-            try:
-                # Format the conversation for Gemini API with argumentative personality
-                conversation_text = """You are Torko, an intellectually curious and thoughtfully argumentative AI assistant. Your core traits:
+        # Check if it's a retriable error
+        status_code = self._error_status(error)
+        if status_code is not None and status_code not in [429, 500, 502, 503, 504]:  # Retriable errors
+            return None
+        
+        # Exponential backoff with jitter
+        return base_delay * (2 ** attempt) + random.uniform(0, 1)
 
-PERSONALITY:
-- You don't just agree with everything - you challenge ideas constructively
-- You present counterarguments and alternative perspectives when appropriate
-- You're passionate about logical reasoning and critical thinking
-- You encourage deeper analysis and question assumptions
-- You're respectful but not afraid to disagree when you have valid points
+    def _cache_key(self, context, message):
+        """Response cache key, or None if this prompt should not be cached"""
+        if not response_cache.accepts(context):
+            return None
+        normalized_message = ' '.join(message.split()).casefold()
+        return response_cache.key(self.model, self._build_payload(context, normalized_message))
 
-DEBATE APPROACH:
-- Present evidence-based counterpoints when you disagree
-- Ask probing questions that challenge the user's reasoning
-- Offer alternative viewpoints even if the user seems confident
-- Point out logical fallacies or weak arguments (politely)
-- Encourage the user to defend their positions with better reasoning
-- Play devil's advocate when it leads to better understanding
+    def _get_ai_response(self, context, message, deadline=None, session_id=None, priority=PRIORITY_NORMAL):
+        """Flow returning the AI response (from the response cache if possible), or the fallback response"""
+        cache_key = self._cache_key(context, message)
+        request = self._request_ai_response(context, message, deadline, session_id, priority)
+        if cache_key is not None:
+            response = yield Step('_cached_response', cache_key, request)
+        else:
+            response = yield from request
+        
+        if response is None:
+            FALLBACKS.inc()
+            return self._get_fallback_response(message)
+        return response
 
-GUIDELINES:
-- Be intellectually honest - only argue positions you can defend with logic/evidence
-- Stay respectful and constructive, never personal or hostile
-- If you genuinely agree, say so, but explain why thoroughly
-- When you disagree, provide specific reasons and evidence
-- Ask follow-up questions that push for deeper thinking
-- Acknowledge when the user makes good points that change your perspective
+    def _request_ai_response(self, context, message, deadline=None, session_id=None, priority=PRIORITY_NORMAL):
+        """Flow calling the AI service with retries and failover; returns None if no usable response was obtained"""
+        attempts = self._max_attempts()
+        deadline = deadline or Deadline.start()
+        full_payload, payload = yield from self._prepare_request(context, message, session_id, deadline)
+        tried, backoffs = set(), 0
+        
+        for attempt in range(attempts):
+            if not deadline.allows_attempt():
+                DEADLINE_EXHAUSTED.inc()
+                logger.warning("Not enough time left for another AI request attempt")
+                break
+            
+            # Every attempt counts against the chosen backend's quota
+            provider = yield Step('_acquire_quota', full_payload, priority, deadline, tried)
+            if provider is None:
+                break
+            body = payload if self._uses_context_cache(provider) else full_payload
+            
+            try:
+                hedge_delay = upstream_latency.hedge_delay() if hedging_enabled else None
+                if hedge_delay is not None and deadline.allows_attempt(hedge_delay):
+                    return (yield Step('_hedged_attempt', provider, body, deadline, hedge_delay))
+                return (yield from self._attempt(provider, body, deadline))
+            except Exception as e:
+                logger.error("API request error from %s (attempt %d/%d): %s", provider.name, attempt + 1, attempts, e)
+                if body is not full_payload and self._error_status(e) in (400, 403, 404):
+                    # The context cache expired or was deleted upstream; send everything
+                    context_cache.invalidate(session_id)
+                    payload = full_payload
+                    continue
+                delay = self._failover_delay(provider, e, tried, backoffs, attempt < attempts - 1, deadline)
+                if delay is None:
+                    break
+                if delay > 0:
+                    logger.info("Retrying in %.2f seconds...", delay)
+                    yield Step('_backoff', delay)
+                    backoffs += 1
+        
+        # All retries failed, caller returns fallback response
+        logger.error("All retry attempts failed for AI response")
+        return None
 
-Remember: The goal is stimulating, educational debate that helps both parties think more deeply - not winning arguments.
+    def _attempt(self, provider, payload, deadline):
+        """Flow of one call to `provider` within the deadline; returns the text or raises.
 
-\n\n"""
-                for msg in context:
-                    role = "User" if msg['role'] == 'user' else "Torko"
-                    conversation_text += f"{role}: {msg['content']}\n"
-                
-                # Add argumentative enhancement based on current message
-                argumentative_context = self._enhance_argumentative_context(message)
-                conversation_text += f"User: {message}{argumentative_context}\nTorko:"
-                
-                # Prepare the request payload for Gemini API
-                payload = {
-                    "contents": [
-                        {
-                            "parts": [
-                                {
-                                    "text": conversation_text
-                                }
-                            ]
-                        }
-                    ]
-                }
-                
-                headers = {
-                    'Content-Type': 'application/json',
-                    'X-goog-api-key': self.api_key
-                }
-                
-                # Make the API call with timeout
-                response = requests.post(
-                    self.api_url, 
-                    json=payload, 
-                    headers=headers,
-                    timeout=30  # 30 second timeout
-                )
-                response.raise_for_status()
-                
-                data = response.json()
-                if 'candidates' in data and len(data['candidates']) > 0:
-                    ai_response = data['candidates'][0]['content']['parts'][0]['text']
-                    
-                    # Check if the AI is returning error messages indicating service issues
-                    error_indicators = [
-                        "experiencing difficulties",
-                        "cannot respond to your request at this time",
-                        "i apologize for the inconvenience",
-                        "service unavailable",
-                        "temporarily unavailable",
-                        "technical difficulties"
-                    ]
-                    
-                    if any(indicator in ai_response.lower() for indicator in error_indicators):
-                        logger.warning(f"AI service returned error message: {ai_response}")
-                        # Treat this as a service error and use fallback
-                        if attempt < max_retries - 1:
-                            delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                            logger.info(f"AI service error detected, retrying in {delay:.2f} seconds...")
-                            time.sleep(delay)
-                            continue
-                        else:
-                            # Last attempt, use fallback
-                            return self._get_fallback_response(message)
-                    
-                    return ai_response
-                else:
-                    logger.warning("No candidates in API response")
-                    if attempt < max_retries - 1:
-                        delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                        logger.info(f"No candidates in response, retrying in {delay:.2f} seconds...")
-                        time.sleep(delay)
-                        continue
-                    else:
-                        return self._get_fallback_response(message)
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"API request error (attempt {attempt + 1}/{max_retries}): {str(e)}")
-                
-                # Check if it's a retriable error
-                if hasattr(e, 'response') and e.response is not None:
-                    status_code = e.response.status_code
-                    if status_code in [429, 500, 502, 503, 504]:  # Retriable errors
-                        if attempt < max_retries - 1:  # Don't sleep on last attempt
-                            # Exponential backoff with jitter
-                            delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                            logger.info(f"Retrying in {delay:.2f} seconds...")
-                            time.sleep(delay)
-                            continue
-                    else:
-                        # Non-retriable error, break immediately
-                        break
-                else:
-                    # Connection error, retry
-                    if attempt < max_retries - 1:
-                        delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                        logger.info(f"Retrying in {delay:.2f} seconds...")
-                        time.sleep(delay)
-                        continue
-                
+        The outcome feeds the backend's latency/error statistics and circuit breaker."""
+        started = time.monotonic()
+        try:
+            ai_response = yield Step('_call', provider, payload, deadline)
+            if self._is_service_error(ai_response):
+                logger.warning("AI service returned error message: %s", ai_response)
+                raise ValueError("AI service returned an error message")
+        except Exception as e:
+            provider.record_failure(self._error_status(e))
+            raise
+        
+        latency = time.monotonic() - started
+        provider.record_success(latency)
+        upstream_latency.observe(latency)
+        return ai_response
+
+    def _stream_ai_response(self, context, message, deadline=None, session_id=None, streamed=None):
+        """Flow yielding AI response text chunks from streamGenerateContent, also added to `streamed`.
+
+        Retries and the fallback response only apply until the first chunk
+        arrives; after that the upstream stream is relayed as-is. The
+        deadline likewise bounds the time to the first chunk, not the length
+        of the stream. Cached responses are returned as a single chunk, and
+        complete streams are added to the cache."""
+        deadline = deadline or Deadline.start()
+        streamed = [] if streamed is None else streamed
+        cache_key = self._cache_key(context, message)
+        if cache_key is not None:
+            cached = yield Step('_cache_get', cache_key)
+            if cached is not None:
+                streamed.append(cached)
+                yield cached
+                return
+        
+        attempts = self._max_attempts()
+        full_payload, payload = yield from self._prepare_request(context, message, session_id, deadline)
+        tried, backoffs = set(), 0
+        
+        for attempt in range(attempts):
+            if not deadline.allows_attempt():
+                DEADLINE_EXHAUSTED.inc()
+                logger.warning("Not enough time left for another streaming attempt")
+                break
+            provider = yield Step('_acquire_quota', full_payload, PRIORITY_NORMAL, deadline, tried)
+            if provider is None:
+                break
+            body = payload if self._uses_context_cache(provider) else full_payload
+            
+            started = time.monotonic()
+            chunks = response = None
+            try:
+                chunks, response = yield Step('_open_stream', provider, body, deadline)
+                first_chunk = yield Step('_next_chunk', chunks)
+                if first_chunk is None:
+                    raise ValueError("Empty stream from AI service")
+                if self._is_service_error(first_chunk):
+                    logger.warning("AI service returned error message: %s", first_chunk)
+                    raise ValueError("AI service returned an error message")
             except Exception as e:
-                logger.error(f"Unexpected error (attempt {attempt + 1}/{max_retries}): {str(e)}")
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                    logger.info(f"Retrying in {delay:.2f} seconds...")
-                    time.sleep(delay)
+                yield Step('_close_stream', chunks, response)
+                provider.record_failure(self._error_status(e))
+                logger.error("Streaming API error from %s (attempt %d/%d): %s", provider.name, attempt + 1, attempts, e)
+                if body is not full_payload and self._error_status(e) in (400, 403, 404):
+                    # The context cache expired or was deleted upstream; send everything
+                    context_cache.invalidate(session_id)
+                    payload = full_payload
                     continue
+                delay = self._failover_delay(provider, e, tried, backoffs, attempt < attempts - 1, deadline)
+                if delay is None:
+                    break
+                if delay > 0:
+                    logger.info("Retrying in %.2f seconds...", delay)
+                    yield Step('_backoff', delay)
+                    backoffs += 1
+                continue
+            # Time to first chunk stands in for the latency of a streamed call
+            provider.record_success(time.monotonic() - started)
+            
+            # First byte is out - from here on the stream can't be retried
+            chunk = first_chunk
+            try:
+                while chunk is not None:
+                    streamed.append(chunk)
+                    yield chunk
+                    chunk = yield Step('_next_chunk', chunks)
+            except self.stream_errors as e:
+                logger.error("AI stream interrupted: %s", e)
+                cache_key = None
+            finally:
+                yield Step('_close_stream', chunks, response)
+            if cache_key is not None:
+                yield Step('_cache_set', cache_key, ''.join(streamed))
+            return
         
         # All retries failed, return fallback response
-        logger.error("All retry attempts failed for AI response")
-        return self._get_fallback_response(message)
+        logger.error("All retry attempts failed for streamed AI response")
+        FALLBACKS.inc()
+        fallback = self._get_fallback_response(message)
+        streamed.append(fallback)
+        yield fallback
+
+    def _stream_text(self, provider, line):
+        """Text chunks in one Server-Sent Events line of a streamed call, or None at the end of the stream"""
+        if not line or not line.startswith('data:'):
+            return ()
+        event = line[len('data:'):].strip()
+        if event == '[DONE]':
+            # End marker of OpenAI-compatible streams
+            return None
+        return provider.parse_event(json.loads(event))
+
+    # I/O steps of the flows; AsyncChatService overrides each with a coroutine
+
+    def _build_context(self, session_id):
+        return context_builder.build(session_id)
+
+    def _save(self, message):
+        Message.save(message)
+
+    def _save_batch(self, session_id, documents, summary, folded_until):
+        Message.save_many(documents)
+        if folded_until is not None:
+            SessionSummary.save(session_id, summary, folded_until)
+
+    def _get_messages(self, session_id):
+        return Message.get_by_session(session_id)
+
+    def _get_page(self, session_id, before, after, limit):
+        return Message.get_page(session_id, before, after, limit)
+
+    def _prepare_context_cache(self, session_id, payload, deadline):
+        """`payload` referencing the session's Gemini context cache, created or extended as needed"""
+        return context_cache.prepare(
+            session_id,
+            self.model,
+            payload,
+            lambda url, body: self._post_upstream(url, **self._cache_request(body, deadline)).json()
+        )
+
+    def _post_upstream(self, url, **kwargs):
+        """POST to the AI service, recording latency and response status"""
+        try:
+            with stage_timer('upstream'):
+                response = self.client.post(url, **kwargs)
+        except requests.exceptions.RequestException:
+            UPSTREAM_RESPONSES.inc(status='error')
+            raise
+        UPSTREAM_RESPONSES.inc(status=response.status_code)
+        response.raise_for_status()
+        return response
+
+    def _backoff(self, delay):
+        RETRIES.inc()
+        with stage_timer('backoff'):
+            time.sleep(delay)
+
+    def _cached_response(self, cache_key, request):
+        """The cached response for `cache_key`, or the result of running the `request` flow"""
+        return response_cache.get_or_compute(cache_key, lambda: self._run(request))
+
+    def _call(self, provider, payload, deadline):
+        if provider.kind == 'fake':
+            with stage_timer('upstream'):
+                return self._fake_reply(provider, payload, deadline.timeout(self.client.total_timeout))
+        url, kwargs = self._upstream_request(provider, payload, deadline)
+        return provider.parse(self._post_upstream(url, **kwargs).json())
+
+    def _fake_reply(self, provider, payload, timeout):
+        delay = provider.delay()
+        time.sleep(min(delay, timeout))
+        if delay > timeout:
+            raise FakeUpstreamError(None, f"Fake upstream {provider.name} timed out")
+        return provider.reply(payload)
+
+    def _fake_stream(self, provider, payload, timeout):
+        yield from provider.chunks(self._fake_reply(provider, payload, timeout))
+
+    def _hedged_attempt(self, provider, payload, deadline, hedge_delay):
+        """Like `_attempt`, but sends a second request if the first one takes longer than
+        `hedge_delay` (the recent p95 upstream latency), and returns whichever answers first.
+
+        The slower request is left to finish in the background; its result
+        is discarded."""
+        executor = _hedge_executor()
+        # Copy the context so both attempts add to this request's Server-Timing trace
+        primary = executor.submit(contextvars.copy_context().run, self._run, self._attempt(provider, payload, deadline))
+        try:
+            return primary.result(timeout=hedge_delay)
+        except FutureTimeoutError:
+            pass
+        
+        if provider.rate_limiter.try_acquire(payload_tokens(payload)) > 0:
+            HEDGES.inc(outcome='skipped')
+            return primary.result()
+        
+        HEDGES.inc(outcome='sent')
+        logger.info("AI request slower than %.2fs, sending a hedged request", hedge_delay)
+        hedge = executor.submit(contextvars.copy_context().run, self._run, self._attempt(provider, payload, deadline))
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        HEDGES.inc(outcome='won')
+                    return future.result()
+            if not pending:
+                # Both failed; the primary's error decides whether to retry
+                return primary.result()
+
+    def _open_stream(self, provider, payload, deadline):
+        """Start a streamed call; returns (text chunks, response to close, None for fake backends)"""
+        if provider.kind == 'fake':
+            return self._fake_stream(provider, payload, deadline.timeout(self.client.read_timeout)), None
+        url, kwargs = self._upstream_request(provider, payload, deadline, stream=True)
+        response = self._post_upstream(url, **kwargs)
+        return self._iter_stream_text(provider, response), response
+
+    def _next_chunk(self, chunks):
+        return next(chunks, None)
+
+    def _close_stream(self, chunks, response):
+        if chunks is not None:
+            chunks.close()
+        if response is not None:
+            response.close()
+
+    def _cache_get(self, cache_key):
+        return response_cache.get(cache_key)
+
+    def _cache_set(self, cache_key, response):
+        response_cache.set(cache_key, response)
+
+    def _iter_stream_text(self, provider, response):
+        """Parse the Server-Sent Events of a streamed call into text chunks"""
+        for line in self.client.iter_lines(response):
+            chunks = self._stream_text(provider, line)
+            if chunks is None:
+                break
+            yield from chunks
 
     def _get_fallback_response(self, message):
         """Generate a fallback response when AI service is unavailable"""
-        message_lower = message.lower()
-        
         # Check if user is asking about Torko even in fallback mode
         torko_response = self._handle_torko_query(message)
         if torko_response:
             return torko_response
         
         # Simple keyword-based responses for common queries
-        if any(word in message_lower for word in ['hello', 'hi', 'hey', 'greetings']):
+        categories = keyword_matcher.classify(message)
+        if 'greeting' in categories:
             return "Hello! I'm experiencing some connectivity issues with my AI service, but I'm here to help. Please try your question again in a moment."
         
-        elif any(word in message_lower for word in ['what', 'explain', 'define', 'how', 'why', 'when', 'where']):
+        elif 'question' in categories:
             return f"I understand you're looking for an explanation or information about something. I'm currently experiencing connectivity issues with my AI service. Your question was: '{message}'. Please try again in a moment for a detailed and comprehensive response!"
         
-        elif any(word in message_lower for word in ['help', 'support', 'assist']):
+        elif 'help' in categories:
             return "I'm here to help! I'm currently experiencing some technical difficulties with my AI service, but I should be back to full functionality soon. Please try your question again in a moment."
         
         else:
@@ -0,0 +1,155 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import mimetypes
+from email.utils import formatdate
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Precompressed siblings written at build time by scripts/compress_static.py,
+# in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Create React App puts a content hash in the name of everything under static/
+# (main.3f2a1b9c.js, 453.8d1e2f3a.chunk.css, logo.5d5d9eef.svg)
+HASHED_NAME = re.compile(r'(^|/)static/.*\.[0-9a-f]{8,}\.')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+class StaticFile:
+    __slots__ = ('path', 'content_type', 'etag', 'last_modified', 'cache_control', 'variants')
+
+    def __init__(self, path, content_type, etag, last_modified, cache_control, variants):
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.cache_control = cache_control
+        self.variants = variants  # encoding -> (body, etag); 'identity' always present
+
+class StaticAssets:
+    """The React build, indexed once at startup and served from memory.
+
+    Every file under `root` is read when the app is created and kept with its
+    content type, a strong ETag (a hash of its content) and any `.br`/`.gz`
+    version written by the build. Requests are then answered without
+    touching the filesystem. The best encoding is picked from Accept-Encoding.
+    Hashed files under `static/` are cacheable for a year as immutable;
+    everything else (index.html, manifest.json, ...) is revalidated and gets
+    304 when unchanged. Unknown paths get index.html for client-side routing.
+    """
+
+    def __init__(self, root, max_file_bytes=8 * 1024 * 1024):
+        self.root = root
+        self.max_file_bytes = max_file_bytes
+        self.files = {}
+        self.build()
+
+    def build(self):
+        start = time.perf_counter()
+        files = {}
+        total = 0
+        if os.path.isdir(self.root):
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                        continue
+                    full_path = os.path.join(directory, name)
+                    relative = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                    entry = self._load(relative, full_path)
+                    if entry is not None:
+                        files[relative] = entry
+                        total += sum(len(body) for body, _ in entry.variants.values())
+        self.files = files
+        logger.info("Indexed %d static files (%d KB) in %.1f ms", len(files), total // 1024,
+                    (time.perf_counter() - start) * 1000)
+
+    def _load(self, relative, full_path):
+        stat = os.stat(full_path)
+        if stat.st_size > self.max_file_bytes:
+            logger.warning("Not serving %s: %d bytes is above the static file limit", relative, stat.st_size)
+            return None
+        with open(full_path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {'identity': (body, f'"{digest}"')}
+        for encoding, suffix in ENCODINGS:
+            try:
+                with open(full_path + suffix, 'rb') as f:
+                    encoded = f.read()
+            except FileNotFoundError:
+                continue
+            if len(encoded) < len(body):
+                # Each representation needs its own strong validator
+                variants[encoding] = (encoded, f'"{digest}-{suffix[1:]}"')
+
+        content_type = mimetypes.guess_type(relative)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        return StaticFile(
+            path=relative,
+            content_type=content_type,
+            etag=variants['identity'][1],
+            last_modified=formatdate(stat.st_mtime, usegmt=True),
+            cache_control=IMMUTABLE if HASHED_NAME.search(relative) else REVALIDATE,
+            variants=variants
+        )
+
+    def lookup(self, path):
+        """The file for a request path, falling back to index.html; None if there is no build"""
+        return self.files.get(path.lstrip('/')) or self.files.get('index.html')
+
+    def _choose_encoding(self, entry, accept_encoding):
+        if len(entry.variants) == 1 or not accept_encoding:
+            return 'identity'
+        accepted = set()
+        for token in accept_encoding.lower().split(','):
+            name, _, params = token.strip().partition(';')
+            if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(name.strip())
+        for encoding, _ in ENCODINGS:
+            if encoding in entry.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+    def respond(self, path, accept_encoding=None, if_none_match=None):
+        """(status, headers, body) for a GET of `path`; None if there is no build to serve"""
+        entry = self.lookup(path)
+        if entry is None:
+            return None
+        encoding = self._choose_encoding(entry, accept_encoding)
+        body, etag = entry.variants[encoding]
+        headers = {
+            'Content-Type': entry.content_type,
+            'ETag': etag,
+            'Last-Modified': entry.last_modified,
+            'Cache-Control': entry.cache_control,
+        }
+        if len(entry.variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        headers['Content-Length'] = str(len(body))
+        return 200, headers, body
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
@@ -0,0 +1,136 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from dotenv import load_dotenv
+from . import database
+from .llm_client import llm_client, async_llm_client
+from .metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class Warmup:
+    """Background warmup of a worker process, reported by `/api/ready`.
+
+    Workers start serving (and answer the liveness check) straight away while
+    a daemon thread connects to MongoDB, creates the indexes and opens pooled
+    connections to each LLM backend. Until the database has answered, the
+    readiness check returns 503, so a load balancer keeps traffic away from
+    a worker that would only stall. Failed steps are retried every
+    `retry_interval` seconds. Started once per process; call `start()` again
+    in a forked child (gunicorn's `post_fork` hook does this).
+    """
+
+    def __init__(self, retry_interval=5.0, llm_connections=2):
+        self.retry_interval = retry_interval
+        self.llm_connections = llm_connections
+        self._lock = threading.Lock()
+        self._reset()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's warmup thread does not exist in the child
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = None
+        self._thread = None
+        self.state = 'pending'
+        self.error = None
+        self.started_at = None
+        self.ready_at = None
+
+    def start(self):
+        """Start warming up this process in the background (idempotent, fork-aware)"""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._reset()
+            self._pid = os.getpid()
+            self.state = 'warming'
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                start = time.perf_counter()
+                database.ping()
+                database.ensure_indexes(database.get_db())
+                observe_stage('warmup_db', time.perf_counter() - start)
+                break
+            except Exception as e:
+                self.error = str(e)
+                logger.warning("Warmup could not reach MongoDB, retrying in %.0fs: %s", self.retry_interval, e)
+                time.sleep(self.retry_interval)
+
+        # Serving does not depend on this: a failure just means the first
+        # turns pay for their own TLS handshakes
+        self._warm_llm()
+
+        self.state = 'ready'
+        self.error = None
+        self.ready_at = time.monotonic()
+        logger.debug("Worker %d ready after %.2fs", os.getpid(), self.ready_at - self.started_at)
+
+    def _llm_requests(self):
+        """(url, params, headers) of a cheap GET (model metadata) on each LLM backend's host"""
+        from .llm_router import llm_router
+
+        requests = [provider.warmup_request() for provider in llm_router.providers]
+        return [request for request in requests if request is not None] * self.llm_connections
+
+    def _warm_llm(self):
+        def fetch(url, params, headers):
+            try:
+                # Any answer (even 403 without a key) leaves a pooled connection behind
+                llm_client.session.get(url, params=params, headers=headers,
+                                       timeout=(llm_client.connect_timeout, llm_client.read_timeout)).close()
+            except Exception as e:
+                logger.debug("LLM connection warmup failed: %s", e)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=fetch, args=request, daemon=True) for request in self._llm_requests()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        observe_stage('warmup_llm', time.perf_counter() - start)
+
+    async def warm_async_llm(self):
+        """Open pooled connections for the running event loop's async LLM client"""
+        async def fetch(url, params, headers):
+            try:
+                await async_llm_client.client.get(url, params=params, headers=headers)
+            except Exception as e:
+                logger.debug("Async LLM connection warmup failed: %s", e)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(fetch(*request) for request in self._llm_requests()))
+        observe_stage('warmup_llm_async', time.perf_counter() - start)
+
+    @property
+    def ready(self):
+        return self.state == 'ready' and self._pid == os.getpid()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'state': self.state if self._pid == os.getpid() else 'pending',
+            'pid': os.getpid(),
+            'warming_for': round(now - self.started_at, 3) if self.started_at and not self.ready_at else None,
+            'warmup_seconds': round(self.ready_at - self.started_at, 3) if self.ready_at else None,
+            'error': self.error
+        }
+
+warmup = Warmup(
+    retry_interval=float(os.getenv('WARMUP_RETRY_INTERVAL', 5)),
+    llm_connections=int(os.getenv('WARMUP_LLM_CONNECTIONS', 2))
+)
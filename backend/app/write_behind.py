@@ -0,0 +1,211 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+from .message_store import message_store
+from .metrics import WRITE_BEHIND_DROPPED
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+class WriteBehindQueue:
+    """Batches message inserts off the request path.
+
+    Documents are queued in memory and a background thread writes them with
+    `write_batch` (the message store's `insert_many`) once `batch_size` documents are waiting or
+    `flush_interval` seconds have passed. Until a document is written it
+    stays visible through `pending()` so reads in this process see it. When
+    the queue is full, callers wait up to `put_timeout` seconds and then
+    write synchronously. A batch that still fails after `max_flush_attempts`
+    is kept and retried every `retry_interval` seconds; only when more than
+    `max_retained` documents are waiting for a retry are the oldest dropped
+    (counted in `stats()` and `torko_write_behind_dropped_total`).
+    `close()` (also run at exit) drains the queue.
+    """
+
+    def __init__(self, write_batch, max_queue=10000, batch_size=100,
+                 flush_interval=0.2, put_timeout=1.0, max_flush_attempts=5,
+                 retry_interval=1.0, max_retained=None):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_flush_attempts = max_flush_attempts
+        self.retry_interval = retry_interval
+        self.max_retained = max_queue if max_retained is None else max_retained
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}  # _id -> document, until it is written
+        self._retained = []  # documents of failed flushes, oldest first
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def enqueue(self, document, block=True):
+        """Queue a document for insertion; assigns its `_id` up front.
+
+        With `block=False` (for callers on an event loop) nothing waits: if
+        the queue is full it returns False and the caller writes the document
+        itself. Otherwise returns True once the document is queued or written.
+        """
+        document.setdefault('_id', ObjectId())
+        self._ensure_started()
+        with self._lock:
+            self._pending[document['_id']] = document
+        try:
+            if block:
+                self._queue.put(document, timeout=self.put_timeout)
+            else:
+                self._queue.put_nowait(document)
+        except queue.Full:
+            if not block:
+                with self._lock:
+                    self._pending.pop(document['_id'], None)
+                return False
+            logger.warning("Write-behind queue full, writing message synchronously")
+            self._write([document])
+        return True
+
+    def pending(self, session_id):
+        """Queued documents of a session that may not be in the database yet"""
+        with self._lock:
+            return [doc for doc in self._pending.values() if doc['session_id'] == session_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'pending': len(self._pending),
+                'retained': len(self._retained),
+                'dropped': self.dropped
+            }
+
+    def close(self, timeout=10.0):
+        """Flush everything still queued and stop the flusher thread"""
+        self._closed = True
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)  # Wake the flusher up
+            self._thread.join(timeout)
+        # Anything left (e.g. enqueued after fork without a flusher) is written here
+        remaining = self._take_retained() + self._drain()
+        if remaining and not self._write(remaining):
+            # Nothing will retry them once the process is gone
+            self._drop(self._take_retained())
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                document = self._queue.get_nowait()
+            except queue.Empty:
+                return batch
+            if document is not None:
+                batch.append(document)
+
+    def _take_retained(self):
+        with self._lock:
+            retained, self._retained = self._retained, []
+        return retained
+
+    def _run(self):
+        while True:
+            try:
+                # Wake up to retry failed batches even when nothing new arrives
+                document = self._queue.get(timeout=self.retry_interval if self._retained else None)
+            except queue.Empty:
+                document = None
+            batch = self._take_retained()
+            if document is not None:
+                batch.append(document)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    document = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if document is not None:
+                    batch.append(document)
+
+            if self._closed:
+                batch.extend(self._drain())
+            if batch:
+                self._write(batch)
+            if self._closed:
+                return
+
+    def _write(self, batch):
+        """Write a batch, retrying; returns False if it failed and was kept for a later retry"""
+        for attempt in range(self.max_flush_attempts):
+            try:
+                self.write_batch(batch)
+                break
+            except BulkWriteError as e:
+                # Duplicate keys mean an earlier attempt already wrote them
+                errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+                if not errors:
+                    break
+                logger.error("Write-behind flush failed (attempt %d/%d): %s",
+                             attempt + 1, self.max_flush_attempts, errors[0].get('errmsg'))
+            except Exception as e:
+                logger.error("Write-behind flush failed (attempt %d/%d): %s",
+                             attempt + 1, self.max_flush_attempts, e)
+            if attempt + 1 < self.max_flush_attempts:
+                time.sleep(min(2 ** attempt * 0.1, 2))
+        else:
+            self._retain(batch)
+            return False
+
+        with self._lock:
+            for document in batch:
+                self._pending.pop(document['_id'], None)
+        return True
+
+    def _retain(self, batch):
+        """Keep a failed batch (still visible through `pending()`) for the flusher to retry"""
+        with self._lock:
+            self._retained.extend(batch)
+            overflow = len(self._retained) - self.max_retained
+            dropped = self._retained[:overflow] if overflow > 0 else []
+            del self._retained[:len(dropped)]
+        logger.warning("Keeping %d messages for a later write-behind retry", len(batch) - len(dropped))
+        self._drop(dropped)
+
+    def _drop(self, documents):
+        if not documents:
+            return
+        with self._lock:
+            for document in documents:
+                self._pending.pop(document['_id'], None)
+            self.dropped += len(documents)
+        WRITE_BEHIND_DROPPED.inc(len(documents))
+        logger.error("Dropping %d messages after repeated write-behind failures", len(documents))
+
+write_behind = WriteBehindQueue(
+    message_store.insert_many,
+    max_queue=int(os.getenv('WRITE_BEHIND_MAX_QUEUE', 10000)),
+    batch_size=int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100)),
+    flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 0.2)),
+    put_timeout=float(os.getenv('WRITE_BEHIND_PUT_TIMEOUT', 1.0)),
+    retry_interval=float(os.getenv('WRITE_BEHIND_RETRY_INTERVAL', 1.0))
+) if os.getenv('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true' else None
@@ -0,0 +1,5 @@
+from app.asgi import create_asgi_app
+
+# Serve with an ASGI worker, e.g.
+#   gunicorn asgi:app -c gunicorn_asgi.conf.py
+app = create_asgi_app()
@@ -0,0 +1,47 @@
+"""Micro-benchmark: precompiled KeywordMatcher vs. the old per-call substring scans.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_matcher
+"""
+import random
+import timeit
+from app.matcher import keyword_matcher, DEFAULT_PATTERN_SETS
+
+# Typical model output: long prose with few or no keyword hits, so the old
+# scans had to walk the whole text once per phrase
+SPARSE_WORDS = (
+    'the argument that economic growth improves wellbeing ignores the '
+    'distribution of costs onto people who do not see the gains; consider '
+    'install scripts, this package, whether it works, evidence, counterpoint'
+).split()
+
+# Keyword-heavy text where most categories hit early and `any()` stops short
+DENSE_WORDS = SPARSE_WORDS + 'always never all hi what help i think'.split()
+
+def substring_scan(text):
+    """What each call site used to do: rebuild lists, lowercase, scan every phrase"""
+    text_lower = text.lower()
+    found = set()
+    for category, phrases in dict((k, list(v)) for k, v in DEFAULT_PATTERN_SETS.items()).items():
+        if any(phrase in text_lower for phrase in phrases):
+            found.add(category)
+    return found
+
+def make_text(vocabulary, words, seed=0):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+def main():
+    print(f"{'text':>6} {'words':>8} {'substring scan (us)':>20} {'matcher (us)':>14} {'speedup':>8}")
+    for name, vocabulary in (('sparse', SPARSE_WORDS), ('dense', DENSE_WORDS)):
+        for words in (20, 200, 2000, 20000):
+            text = make_text(vocabulary, words)
+            number = max(1, 20000 // words)
+            old = min(timeit.repeat(lambda: substring_scan(text), number=number, repeat=5)) / number
+            # Bypass the LRU cache so every call really scans the text
+            new = min(timeit.repeat(lambda: keyword_matcher._classify(text), number=number, repeat=5)) / number
+            print(f"{name:>6} {words:>8} {old * 1e6:>20.1f} {new * 1e6:>14.1f} {old / new:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
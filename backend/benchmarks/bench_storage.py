@@ -0,0 +1,95 @@
+"""Benchmark: read and write latency of the per-message and bucketed storage layouts.
+
+Run from the backend directory, against the in-process store or a real
+(scratch) MongoDB:
+
+    python -m benchmarks.bench_storage
+    python -m benchmarks.bench_storage --uri mongodb://localhost:27017/torko_bench
+
+Each layout gets the same synthetic sessions, written one message at a time
+as the app does. The benchmark then reads full histories, the newest page and
+the messages after a recent cursor. The data is deleted afterwards.
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import statistics
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def timed(samples, call, *args, **kwargs):
+    start = time.perf_counter()
+    result = call(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return result
+
+def run(store, sessions, messages_per_session, page_size, seed):
+    from app.models import Message, HISTORY_PROJECTION
+    from app.conversation_cache import message_cursor
+
+    rng = random.Random(seed)
+    session_ids = [f"bench-{uuid.uuid4()}" for _ in range(sessions)]
+    results = {name: [] for name in ('write', 'full read', 'newest page', 'delta read')}
+
+    for index in range(messages_per_session):
+        for session_id in session_ids:
+            sender = 'user' if index % 2 == 0 else 'ai'
+            document = Message(' '.join('lorem' for _ in range(rng.randint(5, 120))), sender, session_id).to_dict()
+            timed(results['write'], store.insert, document)
+
+    for session_id in session_ids:
+        history = timed(results['full read'], store.find, session_id)
+        assert len(history) == messages_per_session, (store.name, len(history))
+        timed(results['newest page'], store.find, session_id, limit=page_size + 1, newest=True,
+              projection=HISTORY_PROJECTION)
+        cursor = message_cursor(history[-5])
+        recent = timed(results['delta read'], store.find, session_id, after=cursor)
+        assert len(recent) == 4, (store.name, len(recent))
+    return session_ids, results
+
+def cleanup(db, session_ids):
+    db.messages.delete_many({'session_id': {'$in': session_ids}})
+    db.message_buckets.delete_many({'session_id': {'$in': session_ids}})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--uri', default='memory://', help='MongoDB URI (default: in-process store)')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--messages', type=int, nargs='+', default=[20, 200, 1000],
+                        help='Messages per session; one run per value')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--bucket-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ['MONGODB_URI'] = args.uri
+    from benchmarks import memory_store
+    memory_store.install()
+    from app.database import get_db
+    from app.message_store import DocumentMessageStore, BucketMessageStore
+
+    db = get_db()
+    stores = [DocumentMessageStore(), BucketMessageStore(args.bucket_size)]
+    for store in stores:
+        store.ensure_indexes(db)
+
+    print(f"{'messages':>8} {'layout':>10} {'operation':>12} {'p50 (ms)':>9} {'p95 (ms)':>9} {'mean (ms)':>10}")
+    for messages in args.messages:
+        for store in stores:
+            session_ids, results = run(store, args.sessions, messages, args.page_size, args.seed)
+            try:
+                for operation, samples in results.items():
+                    print(f"{messages:>8} {store.name:>10} {operation:>12} "
+                          f"{percentile(samples, 0.5) * 1000:>9.3f} {percentile(samples, 0.95) * 1000:>9.3f} "
+                          f"{statistics.mean(samples) * 1000:>10.3f}")
+            finally:
+                cleanup(db, session_ids)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Compare two run_bench result files.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+import sys
+import json
+import argparse
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return f"{(after - before) / before * 100:+.1f}%"
+
+def compare(baseline, candidate):
+    rows = []
+    before = baseline['throughput']['requests_per_second']
+    after = candidate['throughput']['requests_per_second']
+    rows.append(('throughput', 'req/s', before, after, change(before, after)))
+
+    for counter in ('request_bytes', 'prompt_chars'):
+        before = baseline.get('upstream', {}).get(counter)
+        after = candidate.get('upstream', {}).get(counter)
+        if before is not None or after is not None:
+            rows.append(('upstream', counter, before, after, change(before, after)))
+
+    for section in ('endpoints', 'stages'):
+        names = sorted(set(baseline.get(section, {})) | set(candidate.get(section, {})))
+        for name in names:
+            old = baseline.get(section, {}).get(name, {})
+            new = candidate.get(section, {}).get(name, {})
+            for metric in METRICS:
+                rows.append((name, metric, old.get(metric), new.get(metric), change(old.get(metric), new.get(metric))))
+            if 'ttfb' in old or 'ttfb' in new:
+                old_ttfb = (old.get('ttfb') or {}).get('p50_ms')
+                new_ttfb = (new.get('ttfb') or {}).get('p50_ms')
+                rows.append((name, 'ttfb p50_ms', old_ttfb, new_ttfb, change(old_ttfb, new_ttfb)))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print(f"baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('label')}) -> "
+          f"candidate {candidate['meta'].get('commit')} ({candidate['meta'].get('label')})")
+    print(f"{'name':<26} {'metric':<12} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name, metric, before, after, delta in compare(baseline, candidate):
+        before = '-' if before is None else f"{before:.1f}"
+        after = '-' if after is None else f"{after:.1f}"
+        print(f"{name:<26} {metric:<12} {before:>10} {after:>10} {delta:>8}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""Local stand-in for the Gemini generateContent / streamGenerateContent API.
+
+Latency is drawn from a log-normal distribution, plus an optional prefill
+cost per 1000 uploaded prompt characters, and a configurable share of
+requests fail with 500 or 429. `cachedContents` can be created and
+referenced, so context caching can be exercised too. Point the app at it
+with GEMINI_API_BASE=http://127.0.0.1:<port>/v1beta.
+
+    python -m benchmarks.fake_gemini --port 8765 --latency-median 0.8
+"""
+import re
+import json
+import time
+import math
+import random
+import uuid
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MODEL_PATH = re.compile(r'^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)')
+
+REPLY_WORDS = (
+    'That claim deserves a closer look. Consider the evidence on both sides: '
+    'what would have to be true for you to be wrong, and how would we know? '
+    'A stronger version of your argument would address the obvious counterexample.'
+).split()
+
+class FakeGeminiConfig:
+    def __init__(self, latency_median=0.8, latency_sigma=0.5, error_rate=0.0,
+                 rate_limit_rate=0.0, reply_words=60, stream_chunks=8, prefill_per_kchar=0.0, seed=None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.reply_words = reply_words
+        self.stream_chunks = stream_chunks
+        self.prefill_per_kchar = prefill_per_kchar
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cached_contents = {}  # name -> expiry (time.monotonic)
+        self.counts = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'streams': 0,
+                       'request_bytes': 0, 'prompt_chars': 0, 'cache_creates': 0, 'cached_requests': 0}
+
+    def latency(self):
+        with self.lock:
+            return self.latency_median * math.exp(self.random.gauss(0, self.latency_sigma))
+
+    def outcome(self):
+        with self.lock:
+            roll = self.random.random()
+            self.counts['requests'] += 1
+            if roll < self.rate_limit_rate:
+                self.counts['rate_limited'] += 1
+                return 429
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.counts['errors'] += 1
+                return 500
+            return 200
+
+    def reply(self):
+        with self.lock:
+            return ' '.join(self.random.choice(REPLY_WORDS) for _ in range(self.reply_words))
+
+def _prompt_chars(body):
+    parts = list((body.get('systemInstruction') or {}).get('parts', []))
+    for content in body.get('contents', []):
+        parts.extend(content.get('parts', []))
+    return sum(len(part.get('text', '')) for part in parts)
+
+def _candidate(text):
+    return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}]}
+
+def make_handler(config):
+    class FakeGeminiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                with config.lock:
+                    self._send_json(200, dict(config.counts))
+                return
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                self._send_json(400, {'error': {'code': 400, 'message': 'Invalid JSON payload'}})
+                return
+            with config.lock:
+                config.counts['request_bytes'] += len(raw)
+                config.counts['prompt_chars'] += _prompt_chars(body)
+
+            if self.path.split('?')[0] == '/v1beta/cachedContents':
+                self._create_cached_content(body)
+                return
+
+            match = MODEL_PATH.match(self.path)
+            if not match:
+                self._send_json(404, {'error': {'message': 'Not found'}})
+                return
+
+            if body.get('cachedContent'):
+                with config.lock:
+                    expires = config.cached_contents.get(body['cachedContent'])
+                    if expires is not None and expires > time.monotonic():
+                        config.counts['cached_requests'] += 1
+                if expires is None or expires <= time.monotonic():
+                    self._send_json(404, {'error': {'code': 404, 'message': 'CachedContent not found'}})
+                    return
+
+            latency = config.latency() + config.prefill_per_kchar * _prompt_chars(body) / 1000.0
+            status = config.outcome()
+            if status != 200:
+                time.sleep(latency / 4)
+                self._send_json(status, {'error': {'code': status, 'message': 'Simulated failure'}})
+                return
+
+            if match.group('method') == 'generateContent':
+                time.sleep(latency)
+                self._send_json(200, _candidate(config.reply()))
+                return
+
+            self._stream(latency)
+
+        def _create_cached_content(self, body):
+            ttl = float(str(body.get('ttl', '3600s')).rstrip('s'))
+            name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+            # Uploading the cache costs a prefill once
+            time.sleep(config.prefill_per_kchar * _prompt_chars(body) / 1000.0)
+            with config.lock:
+                config.cached_contents[name] = time.monotonic() + ttl
+                config.counts['cache_creates'] += 1
+            self._send_json(200, {'name': name, 'model': body.get('model'), 'ttl': body.get('ttl')})
+
+        def _stream(self, latency):
+            with config.lock:
+                config.counts['streams'] += 1
+            words = config.reply().split(' ')
+            chunks = max(1, config.stream_chunks)
+            size = max(1, math.ceil(len(words) / chunks))
+            # Time to first token is a fraction of the full generation time
+            time.sleep(latency / chunks)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(words), size):
+                text = ' '.join(words[start:start + size]) + ' '
+                event = f"data: {json.dumps(_candidate(text))}\r\n\r\n".encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+                self.wfile.flush()
+                time.sleep(latency / chunks)
+            self.wfile.write(b'0\r\n\r\n')
+
+    return FakeGeminiHandler
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connection attempts (each costing a 1 s
+    # SYN retransmit) once an async app opens many upstream calls at once
+    request_queue_size = 1024
+
+def start_server(config, host='127.0.0.1', port=0):
+    """Start the fake server on a background thread; returns (server, base_url)"""
+    server = FakeGeminiServer((host, port), make_handler(config))
+    threading.Thread(target=server.serve_forever, name='fake-gemini', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1beta"
+
+def add_arguments(parser):
+    parser.add_argument('--latency-median', type=float, default=0.8, help='Median upstream latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Log-normal sigma of upstream latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of requests failing with 429')
+    parser.add_argument('--reply-words', type=int, default=60, help='Words per generated reply')
+    parser.add_argument('--stream-chunks', type=int, default=8, help='Chunks per streamed reply')
+    parser.add_argument('--prefill-per-kchar', type=float, default=0.0,
+                        help='Extra upstream latency in seconds per 1000 uploaded prompt characters')
+    parser.add_argument('--seed', type=int, default=None)
+
+def config_from_args(args):
+    return FakeGeminiConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        reply_words=args.reply_words,
+        stream_chunks=args.stream_chunks,
+        prefill_per_kchar=args.prefill_per_kchar,
+        seed=args.seed
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_server(config_from_args(args), args.host, args.port)
+    print(f"Fake Gemini listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
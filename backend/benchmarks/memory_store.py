@@ -0,0 +1,327 @@
+import copy
+import threading
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+def _get_field(document, path):
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+def _compare(value, operator, operand):
+    if operator == '$eq':
+        return value == operand
+    if operator == '$ne':
+        return value != operand
+    if operator == '$in':
+        return value in operand
+    if operator == '$nin':
+        return value not in operand
+    if operator == '$exists':
+        return (value is not None) == bool(operand)
+    if value is None:
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    if operator == '$lte':
+        return value <= operand
+    raise NotImplementedError(f"Query operator {operator} is not supported by the memory store")
+
+def _matches(document, query):
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            if not any(_matches(document, sub) for sub in condition):
+                return False
+        elif key == '$and':
+            if not all(_matches(document, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            value = _get_field(document, key)
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif _get_field(document, key) != condition:
+            return False
+    return True
+
+def _project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = {k for k, v in projection.items() if v and k != '_id'}
+    if include:
+        result = {k: copy.deepcopy(v) for k, v in document.items() if k in include}
+        if projection.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        return result
+    exclude = {k for k, v in projection.items() if not v}
+    return {k: copy.deepcopy(v) for k, v in document.items() if k not in exclude}
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class MemoryCursor:
+    def __init__(self, documents, projection):
+        self._documents = documents
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=1):
+        keys = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        for key, key_direction in reversed(keys):
+            self._documents.sort(
+                key=lambda doc: (_get_field(doc, key) is not None, _get_field(doc, key)),
+                reverse=key_direction < 0
+            )
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        documents = self._documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        for document in documents:
+            yield _project(document, self._projection)
+
+    def close(self):
+        pass
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self._documents = {}  # _id -> document, in insertion order
+        self._indexes = {}
+        self._lock = threading.RLock()
+
+    def _insert(self, document):
+        document.setdefault('_id', ObjectId())
+        if document['_id'] in self._documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}")
+        self._documents[document['_id']] = copy.deepcopy(document)
+
+    def insert_one(self, document):
+        with self._lock:
+            self._insert(document)
+        return _Result(inserted_id=document['_id'], acknowledged=True)
+
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        inserted = []
+        with self._lock:
+            for index, document in enumerate(documents):
+                try:
+                    self._insert(document)
+                    inserted.append(document['_id'])
+                except DuplicateKeyError as e:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted)})
+        return _Result(inserted_ids=inserted, acknowledged=True)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0):
+        with self._lock:
+            documents = [doc for doc in self._documents.values() if _matches(doc, filter)]
+        cursor = MemoryCursor(documents, projection)
+        if sort:
+            cursor.sort(sort)
+        if limit:
+            cursor.limit(limit)
+        return cursor
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        for document in self.find(filter, projection, sort=sort, limit=1):
+            return document
+        return None
+
+    def count_documents(self, filter):
+        with self._lock:
+            return sum(1 for doc in self._documents.values() if _matches(doc, filter))
+
+    def _apply_update(self, document, update, inserting):
+        for operator, fields in update.items():
+            if operator == '$set' or (operator == '$setOnInsert' and inserting):
+                for key, value in fields.items():
+                    document[key] = copy.deepcopy(value)
+            elif operator == '$setOnInsert':
+                continue
+            elif operator == '$inc':
+                for key, value in fields.items():
+                    document[key] = document.get(key, 0) + value
+            elif operator == '$push':
+                for key, value in fields.items():
+                    values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                    document.setdefault(key, []).extend(copy.deepcopy(values))
+            elif operator == '$min':
+                for key, value in fields.items():
+                    if key not in document or value < document[key]:
+                        document[key] = value
+            elif operator == '$max':
+                for key, value in fields.items():
+                    if key not in document or value > document[key]:
+                        document[key] = value
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported by the memory store")
+
+    def update_one(self, filter, update, upsert=False):
+        with self._lock:
+            for document in self._documents.values():
+                if _matches(document, filter):
+                    self._apply_update(document, update, inserting=False)
+                    return _Result(matched_count=1, modified_count=1, upserted_id=None)
+            if not upsert:
+                return _Result(matched_count=0, modified_count=0, upserted_id=None)
+            document = {k: copy.deepcopy(v) for k, v in (filter or {}).items()
+                        if not k.startswith('$') and not isinstance(v, dict)}
+            self._apply_update(document, update, inserting=True)
+            self._insert(document)
+            return _Result(matched_count=0, modified_count=0, upserted_id=document['_id'])
+
+    def delete_many(self, filter):
+        with self._lock:
+            doomed = [key for key, doc in self._documents.items() if _matches(doc, filter)]
+            for key in doomed:
+                del self._documents[key]
+        return _Result(deleted_count=len(doomed))
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = kwargs.get('name') or '_'.join(f"{k}_{d}" for k, d in keys)
+        self._indexes[name] = {'key': list(keys), **kwargs}
+        return name
+
+    def index_information(self):
+        return dict(self._indexes)
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def command(self, name, *args, **kwargs):
+        return {'ok': 1.0}
+
+class MemoryClient:
+    """In-memory stand-in for the subset of pymongo's MongoClient this app uses.
+
+    Serves `MONGODB_URI=memory://` once `install()` has run, for benchmarks
+    and tests without a MongoDB server. Data lives in the worker process only, so each
+    gunicorn worker has its own copy.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(name)
+        return self._databases[name]
+
+    def server_info(self):
+        return {'version': 'memory', 'ok': 1.0}
+
+    def close(self):
+        pass
+
+class AsyncMemoryCursor:
+    """Awaitable view of a MemoryCursor with the motor cursor methods the app uses"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, key_or_list, direction=1):
+        self._cursor.sort(key_or_list, direction)
+        return self
+
+    def skip(self, count):
+        self._cursor.skip(count)
+        return self
+
+    def limit(self, count):
+        self._cursor.limit(count)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length=None):
+        documents = list(self._cursor)
+        return documents[:length] if length else documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._cursor:
+            yield document
+
+class AsyncMemoryCollection:
+    """Coroutine versions of MemoryCollection's methods, mirroring motor's API"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+class AsyncMemoryDatabase:
+    """Async facade over a MemoryDatabase, returned by `get_async_db()` for `memory://`"""
+
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self._database[name])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, name, *args, **kwargs):
+        return self._database.command(name, *args, **kwargs)
+
+def install():
+    """Make the app's database module serve `memory://` URIs from this store (call before the first query)"""
+    from app import database
+    database.register_client('memory://', MemoryClient, AsyncMemoryDatabase)
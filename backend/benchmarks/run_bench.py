@@ -0,0 +1,310 @@
+"""Offline load test: replays synthetic multi-turn sessions against the app under gunicorn.
+
+Gemini is replaced by the local fake server and MongoDB by the in-memory
+store (or any MONGODB_URI you pass), so no API quota is used. Run from the
+backend directory:
+
+    python -m benchmarks.run_bench --sessions 50 --turns 4 --output results.json
+
+Results are written as JSON; compare two runs with benchmarks.compare.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks import fake_gemini
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPENING_QUESTIONS = [
+    'What is the best argument for free will?',
+    'Is social media good for society?',
+    'Why do people disagree about economics?',
+    'Explain the trolley problem.',
+    'Should homework be banned?',
+]
+
+FOLLOW_UPS = [
+    'I think you are wrong about that, everyone knows it is obvious.',
+    'In my opinion technology always makes progress possible.',
+    'But surely tradition matters more than efficiency?',
+    'Can you give me a concrete example?',
+    'I believe education should be free for all, what do you say?',
+    'That does not convince me. Why should I accept your premise?',
+]
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 2) if values else None,
+        'p50_ms': round(percentile(values, 50) * 1000, 2) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 2) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 2) if values else None,
+        'max_ms': round(max(values) * 1000, 2) if values else None,
+    }
+
+def parse_server_timing(header):
+    """Parse a Server-Timing header into {stage: seconds}"""
+    stages = {}
+    for entry in (header or '').split(','):
+        parts = [part.strip() for part in entry.split(';')]
+        if not parts[0]:
+            continue
+        for param in parts[1:]:
+            if param.startswith('dur='):
+                try:
+                    stages[parts[0]] = stages.get(parts[0], 0.0) + float(param[4:]) / 1000.0
+                except ValueError:
+                    pass
+    return stages
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.ttfb = {}
+        self.stages = {}
+        self.errors = {}
+
+    def record(self, endpoint, latency, ok, ttfb=None, server_timing=None):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if ttfb is not None:
+                self.ttfb.setdefault(endpoint, []).append(ttfb)
+            for stage, seconds in parse_server_timing(server_timing).items():
+                self.stages.setdefault(stage, []).append(seconds)
+
+def run_session(base_url, args, recorder, rng):
+    http = requests.Session()
+
+    start = time.perf_counter()
+    response = http.post(f"{base_url}/api/session", timeout=args.request_timeout)
+    recorder.record('POST /api/session', time.perf_counter() - start, response.ok)
+    if not response.ok:
+        return
+    session_id = response.json()['session_id']
+
+    for turn in range(args.turns):
+        message = rng.choice(OPENING_QUESTIONS) if turn == 0 else f"{rng.choice(FOLLOW_UPS)} ({session_id[:8]}-{turn})"
+        body = {'message': message, 'session_id': session_id}
+
+        if rng.random() < args.stream_share:
+            endpoint = 'POST /api/chat/stream'
+            start = time.perf_counter()
+            ttfb = None
+            ok = False
+            try:
+                with http.post(f"{base_url}/api/chat/stream", json=body, stream=True,
+                               timeout=args.request_timeout) as response:
+                    for line in response.iter_lines():
+                        if ttfb is None and line.startswith(b'data:'):
+                            ttfb = time.perf_counter() - start
+                    ok = response.ok
+                    server_timing = response.headers.get('Server-Timing')
+            except requests.RequestException:
+                server_timing = None
+            recorder.record(endpoint, time.perf_counter() - start, ok, ttfb, server_timing)
+        else:
+            endpoint = 'POST /api/chat'
+            start = time.perf_counter()
+            try:
+                response = http.post(f"{base_url}/api/chat", json=body, timeout=args.request_timeout)
+                latency = time.perf_counter() - start
+                recorder.record(endpoint, latency, response.ok, latency, response.headers.get('Server-Timing'))
+            except requests.RequestException:
+                recorder.record(endpoint, time.perf_counter() - start, False)
+
+        time.sleep(args.think_time)
+
+    start = time.perf_counter()
+    try:
+        response = http.get(f"{base_url}/api/history", params={'session_id': session_id},
+                            timeout=args.request_timeout)
+        recorder.record('GET /api/history', time.perf_counter() - start, response.ok)
+    except requests.RequestException:
+        recorder.record('GET /api/history', time.perf_counter() - start, False)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# The same apps with the in-memory MongoDB stand-in installed
+MEMORY_APPS = {'run:app': 'benchmarks.serve:app', 'asgi:app': 'benchmarks.serve:asgi_app'}
+# Worker class used when --worker-class is not given
+APP_WORKER_CLASSES = {'asgi:app': 'uvicorn.workers.UvicornWorker'}
+
+def served_app(app, mongodb_uri):
+    if mongodb_uri.startswith('memory://'):
+        return MEMORY_APPS.get(app, app)
+    return app
+
+def start_app(args, gemini_base):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'MONGODB_URI': args.mongodb_uri,
+        'GEMINI_API_BASE': gemini_base,
+        'GEMINI_API_KEY': 'benchmark',
+        'GEMINI_RPM': str(args.upstream_rpm),
+        'GEMINI_RPM_BURST': str(args.upstream_rpm),
+        'RATE_LIMIT_BACKEND': 'file',
+        'RATE_LIMIT_FILE': os.path.join(BACKEND_DIR, f".bench-rate-limit-{port}.json"),
+        'FLASK_ENV': 'production',
+    })
+    for assignment in args.env:
+        key, _, value = assignment.partition('=')
+        env[key] = value
+
+    command = [
+        sys.executable, '-m', 'gunicorn', served_app(args.app, args.mongodb_uri),
+        '--bind', f"127.0.0.1:{port}",
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--timeout', '120',
+        '--log-level', 'warning',
+    ]
+    worker_class = args.worker_class or APP_WORKER_CLASSES.get(args.app)
+    if worker_class:
+        command += ['--worker-class', worker_class]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if args.quiet else None)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/api/health", timeout=1).ok:
+                return process, base_url, env['RATE_LIMIT_FILE']
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not become healthy in time")
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def print_report(results):
+    print(f"\n{results['meta']['label'] or 'benchmark'} @ {results['meta']['commit']}: "
+          f"{results['throughput']['requests_per_second']} req/s, "
+          f"{results['throughput']['turns_per_second']} turns/s over {results['elapsed_seconds']} s")
+    print(f"{'endpoint':<26} {'count':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'ttfb p50':>9}")
+    for endpoint, stats in sorted(results['endpoints'].items()):
+        ttfb = stats.get('ttfb') or {}
+        print(f"{endpoint:<26} {stats['count']:>6} {stats['errors']:>6} "
+              f"{stats['p50_ms'] or 0:>9.1f} {stats['p95_ms'] or 0:>9.1f} {stats['p99_ms'] or 0:>9.1f} "
+              f"{ttfb.get('p50_ms') or 0:>9.1f}")
+    upstream = results.get('upstream') or {}
+    if upstream:
+        print('upstream: ' + ', '.join(f"{name}={value}" for name, value in sorted(upstream.items())))
+    if results['stages']:
+        print(f"\n{'stage':<26} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for stage, stats in sorted(results['stages'].items()):
+            print(f"{stage:<26} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=50, help='Synthetic sessions to replay')
+    parser.add_argument('--turns', type=int, default=4, help='Chat turns per session')
+    parser.add_argument('--concurrency', type=int, default=16, help='Sessions replayed in parallel')
+    parser.add_argument('--stream-share', type=float, default=0.5, help='Share of turns sent to /api/chat/stream')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Pause between turns of a session (s)')
+    parser.add_argument('--request-timeout', type=float, default=120.0)
+    parser.add_argument('--app', default='run:app', help='gunicorn application')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--worker-class', default=None)
+    parser.add_argument('--mongodb-uri', default='memory://', help='memory:// is an in-process store, one per worker')
+    parser.add_argument('--upstream-rpm', type=int, default=100000, help='GEMINI_RPM given to the app')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the app (repeatable)')
+    parser.add_argument('--startup-timeout', type=float, default=30.0)
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', default=None, help='Write JSON results here')
+    parser.add_argument('--quiet', action='store_true', help='Hide app stderr')
+    fake_gemini.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    config = fake_gemini.config_from_args(args)
+    gemini_server, gemini_base = fake_gemini.start_server(config)
+    process, base_url, rate_limit_file = start_app(args, gemini_base)
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    seeds = [rng.random() for _ in range(args.sessions)]
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_session, base_url, args, recorder, random.Random(seed)) for seed in seeds]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        gemini_server.shutdown()
+        if os.path.exists(rate_limit_file):
+            os.remove(rate_limit_file)
+
+    total_requests = sum(len(v) for v in recorder.latencies.values())
+    total_turns = sum(len(v) for k, v in recorder.latencies.items() if k.startswith('POST /api/chat'))
+    endpoints = {}
+    for endpoint, latencies in recorder.latencies.items():
+        stats = summarize(latencies)
+        stats['errors'] = recorder.errors.get(endpoint, 0)
+        if endpoint in recorder.ttfb:
+            stats['ttfb'] = summarize(recorder.ttfb[endpoint])
+        endpoints[endpoint] = stats
+
+    results = {
+        'meta': {
+            'label': args.label,
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'args': vars(args),
+        },
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput': {
+            'requests_per_second': round(total_requests / elapsed, 2),
+            'turns_per_second': round(total_turns / elapsed, 2),
+        },
+        'endpoints': endpoints,
+        'stages': {stage: summarize(values) for stage, values in recorder.stages.items()},
+        'upstream': dict(config.counts),
+    }
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""Gunicorn entry points for benchmark runs, with `MONGODB_URI=memory://` available.
+
+    gunicorn benchmarks.serve:app        # the sync Flask app (like run:app)
+    gunicorn benchmarks.serve:asgi_app   # the ASGI app (like asgi:app)
+
+The in-memory store is installed before the app is imported; each worker
+process has its own copy of the data.
+"""
+from benchmarks import memory_store
+
+memory_store.install()
+
+def __getattr__(name):
+    # Imported on demand, so only the app gunicorn asks for is created
+    if name == 'app':
+        from run import app
+        return app
+    if name == 'asgi_app':
+        from asgi import app
+        return app
+    raise AttributeError(name)
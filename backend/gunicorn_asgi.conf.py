@@ -0,0 +1,33 @@
+"""Gunicorn settings for the ASGI app: `gunicorn asgi:app -c gunicorn_asgi.conf.py`.
+
+Not named gunicorn.conf.py on purpose: gunicorn loads that file from the
+working directory by default, and its Uvicorn worker class would break
+the WSGI app (`gunicorn run:app`).
+
+With GUNICORN_PRELOAD=true the app is imported once in the master and the
+workers share its memory. Nothing in the app connects to MongoDB or the LLM
+API at import time, and `post_fork` starts each worker's background warmup
+with clients of its own, so no connection is ever shared across a fork.
+"""
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', min(4, multiprocessing.cpu_count())))
+worker_class = 'uvicorn.workers.UvicornWorker'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+keepalive = 5
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+if preload_app:
+    # Tells create_app() not to start the warmup in the master
+    os.environ['TORKO_PRELOAD'] = 'true'
+
+def post_fork(server, worker):
+    # The at-fork handlers have already dropped anything inherited; make
+    # sure of it and start warming up this worker
+    from app import database
+    from app.warmup import warmup
+
+    database.reset_after_fork()
+    warmup.start()
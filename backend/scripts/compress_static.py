@@ -0,0 +1,83 @@
+"""Precompress the React build so the app can serve `.br` and `.gz` versions as they are.
+
+Run from the backend directory after `npm run build` (build.sh does this):
+
+    python -m scripts.compress_static
+    python -m scripts.compress_static --root ../frontend/build --min-size 512
+
+Text assets (JS, CSS, HTML, JSON, SVG, source maps, ...) of at least
+`--min-size` bytes get a gzip sibling at maximum compression and, when the
+optional `brotli` package is installed, a brotli one. A version that would
+not be smaller is not written. Output is deterministic, so rebuilding
+unchanged files gives the same bytes and the same ETags.
+"""
+import os
+import sys
+import gzip
+import time
+import argparse
+import mimetypes
+
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/json', 'application/manifest+json',
+                      'application/xml', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+COMPRESSIBLE_SUFFIXES = ('.map', '.webmanifest')
+
+def is_compressible(path):
+    if path.endswith(COMPRESSIBLE_SUFFIXES):
+        return True
+    content_type = mimetypes.guess_type(path)[0] or ''
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+def compressors():
+    """(suffix, compress) pairs available in this environment"""
+    available = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+    except ImportError:
+        print("brotli is not installed; writing gzip versions only", file=sys.stderr)
+    else:
+        available.insert(0, ('.br', lambda data: brotli.compress(data, quality=11)))
+    return available
+
+def compress_tree(root, min_size):
+    totals = {'files': 0, 'original': 0, 'written': {}}
+    available = compressors()
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith(('.gz', '.br')) or not is_compressible(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < min_size:
+                continue
+            totals['files'] += 1
+            totals['original'] += len(data)
+            for suffix, compress in available:
+                encoded = compress(data)
+                if len(encoded) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(encoded)
+                totals['written'][suffix] = totals['written'].get(suffix, 0) + len(encoded)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--root', default=os.path.join('..', 'frontend', 'build'),
+                        help='Build directory (default: ../frontend/build)')
+    parser.add_argument('--min-size', type=int, default=256, help='Skip files smaller than this many bytes')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print(f"{args.root} does not exist; run `npm run build` first", file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    totals = compress_tree(args.root, args.min_size)
+    sizes = ', '.join(f"{suffix}: {size // 1024} KB" for suffix, size in totals['written'].items())
+    print(f"Compressed {totals['files']} files ({totals['original'] // 1024} KB) in "
+          f"{time.perf_counter() - start:.1f}s ({sizes or 'nothing written'})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
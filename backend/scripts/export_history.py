@@ -0,0 +1,53 @@
+"""Export stored conversations as gzip-compressed NDJSON.
+
+Run from the backend directory, against the database in MONGODB_URI:
+
+    python -m scripts.export_history --output history.ndjson.gz
+    python -m scripts.export_history --session abc --session def --start 2024-01-01 --end 2024-02-01
+    python -m scripts.export_history --no-gzip --output - | head
+
+One line per message, `{session_id, id, sender, content, timestamp}`, by
+session and then in chronological order. Messages are streamed from the
+database cursor and written as they arrive, so memory use stays flat
+however many there are. Reads the layout selected by MESSAGE_STORAGE.
+"""
+import sys
+import time
+import argparse
+from app.export import HistoryExport, EXPORT_BATCH_SIZE
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--session', action='append', dest='sessions',
+                        help='Only export this session (repeatable, or comma-separated)')
+    parser.add_argument('--start', help='Only messages at or after this time (ISO 8601 or epoch ms)')
+    parser.add_argument('--end', help='Only messages before this time (ISO 8601 or epoch ms)')
+    parser.add_argument('--output', default='history.ndjson.gz', help="File to write, or '-' for stdout")
+    parser.add_argument('--no-gzip', action='store_true', help='Write plain NDJSON')
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE,
+                        help='Messages fetched per database round trip (default: EXPORT_BATCH_SIZE or 1000)')
+    args = parser.parse_args()
+
+    try:
+        export = HistoryExport.from_args(args.sessions, args.start, args.end,
+                                         compress=not args.no_gzip, batch_size=args.batch_size)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    written = 0
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in export.chunks():
+            output.write(chunk)
+            written += len(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    print(f"Exported to {args.output} ({written // 1024} KB) in {time.perf_counter() - start:.1f}s",
+          file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
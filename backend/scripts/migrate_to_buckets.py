@@ -0,0 +1,80 @@
+"""Backfill `message_buckets` from the one-document-per-message `messages` collection.
+
+Run from the backend directory, against the database in MONGODB_URI:
+
+    python -m scripts.migrate_to_buckets --dry-run
+    python -m scripts.migrate_to_buckets
+
+then deploy with MESSAGE_STORAGE=buckets. Messages are read session by
+session through the (session_id, timestamp, _id) index. Sessions that
+already have buckets are skipped unless `--overwrite` is given, so an
+interrupted run can simply be started again; `messages` is left untouched.
+Messages saved between the backfill and the switch are not copied, so run it
+with writes stopped, or run it again right after switching with
+`--overwrite` limited to the affected sessions via `--session`.
+"""
+import os
+import sys
+import time
+import argparse
+from dotenv import load_dotenv
+from app.database import get_db
+from app.message_store import BucketMessageStore
+
+load_dotenv()
+
+def session_messages(db, session_ids=None):
+    """(session_id, messages) for every session, each in chronological order"""
+    query = {'session_id': {'$in': session_ids}} if session_ids else {}
+    cursor = db.messages.find(query).sort([('session_id', 1), ('timestamp', 1), ('_id', 1)])
+    current, messages = None, []
+    for message in cursor:
+        if message['session_id'] != current:
+            if messages:
+                yield current, messages
+            current, messages = message['session_id'], []
+        messages.append(message)
+    if messages:
+        yield current, messages
+
+def migrate(db, store, session_ids=None, overwrite=False, dry_run=False):
+    totals = {'sessions': 0, 'skipped': 0, 'messages': 0, 'buckets': 0}
+    for session_id, messages in session_messages(db, session_ids):
+        if not overwrite and db.message_buckets.find_one({'session_id': session_id}) is not None:
+            totals['skipped'] += 1
+            continue
+        buckets = store.build_buckets(session_id, messages)
+        if not dry_run:
+            db.message_buckets.delete_many({'session_id': session_id})
+            db.message_buckets.insert_many(buckets)
+        totals['sessions'] += 1
+        totals['messages'] += len(messages)
+        totals['buckets'] += len(buckets)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bucket-size', type=int, default=int(os.getenv('MESSAGE_BUCKET_SIZE', 100)),
+                        help='Messages per bucket (default: MESSAGE_BUCKET_SIZE or 100)')
+    parser.add_argument('--session', action='append', dest='sessions',
+                        help='Only migrate this session (repeatable)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Rebuild the buckets of sessions that already have some')
+    parser.add_argument('--dry-run', action='store_true', help='Count what would be written without writing')
+    args = parser.parse_args()
+
+    db = get_db()
+    store = BucketMessageStore(args.bucket_size)
+    if not args.dry_run:
+        store.ensure_indexes(db)
+
+    start = time.perf_counter()
+    totals = migrate(db, store, args.sessions, args.overwrite, args.dry_run)
+    action = 'Would write' if args.dry_run else 'Wrote'
+    print(f"{action} {totals['buckets']} buckets holding {totals['messages']} messages "
+          f"for {totals['sessions']} sessions in {time.perf_counter() - start:.1f}s "
+          f"({totals['skipped']} sessions already had buckets)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
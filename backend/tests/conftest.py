@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+# The app modules read their settings at import time: keep the tests
+# offline, quiet and free of background threads
+os.environ.setdefault('MONGODB_URI', 'memory://')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('TORKO_PRELOAD', 'true')
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='torko-test-metrics-'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import memory_store
+
+memory_store.install()
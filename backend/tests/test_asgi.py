@@ -0,0 +1,15 @@
+import asyncio
+from app.asgi import create_asgi_app
+
+def test_shutdown_without_startup_completes():
+    messages = [{'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(create_asgi_app()({'type': 'lifespan'}, receive, send))
+    assert sent == [{'type': 'lifespan.shutdown.complete'}]
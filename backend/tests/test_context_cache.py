@@ -0,0 +1,65 @@
+from app.context_cache import ContextCache
+from app.context_builder import ContextBuilder
+
+class FakeGemini:
+    def __init__(self):
+        self.created = []
+
+    def __call__(self, url, body):
+        self.created.append(body)
+        return {'name': f"cachedContents/{len(self.created)}"}
+
+def cache():
+    return ContextCache('https://example.invalid', min_tokens=100, clock=lambda: 1000.0)
+
+def message(number, sender='user'):
+    # About 28 tokens each
+    return {'content': f"message {number} " + 'word ' * 20, 'sender': sender}
+
+def payload(summary, recent):
+    contents = [{'role': 'user', 'parts': [{'text': summary}]}] if summary else []
+    contents += [{'role': 'user' if msg['sender'] == 'user' else 'model', 'parts': [{'text': msg['content']}]}
+                 for msg in recent]
+    return {'contents': contents}
+
+def run_session(builder, turns):
+    """Send `turns` turns through `builder` and a context cache; return (cache, gemini, payloads sent)"""
+    context, gemini, sent = cache(), FakeGemini(), []
+    summary, recent = '', []
+    for turn in range(turns):
+        summary, recent, _ = builder.extend('s', summary, recent, [message(turn)])
+        sent.append(context.prepare('s', 'gemini', payload(summary, recent), gemini))
+        summary, recent, _ = builder.extend('s', summary, recent, [message(turn, 'assistant')])
+    return context, gemini, sent
+
+def test_prefix_that_changes_every_turn_is_not_cached():
+    context, gemini = cache(), FakeGemini()
+    for turn in range(10):
+        recent = [message(number) for number in range(turn, turn + 8)]
+        context.prepare('s', 'gemini', payload(f"summary up to {turn}", recent), gemini)
+    assert gemini.created == []
+
+def test_growing_prefix_is_cached_once_and_reused():
+    context, gemini = cache(), FakeGemini()
+    sent = [context.prepare('s', 'gemini', payload('', [message(number) for number in range(turn + 1)]), gemini)
+            for turn in range(8)]
+    assert len(gemini.created) == 1
+    assert all('cachedContent' in body for body in sent[-3:])
+
+def test_folding_in_chunks_keeps_the_prefix_stable_between_folds():
+    # Folding just enough each turn changes the summary every turn: caches are rarely worth creating
+    _, churning, sent = run_session(ContextBuilder(token_budget=400, summary_budget=100, min_recent_messages=2), 30)
+    assert len(churning.created) <= 3
+    assert sum('cachedContent' in body for body in sent) <= 5
+
+    builder = ContextBuilder(token_budget=400, summary_budget=100, min_recent_messages=2, fold_tokens=150)
+    context, chunked, sent = run_session(builder, 30)
+    assert context.stats()['used'] == sum('cachedContent' in body for body in sent) >= 15
+
+def test_fold_frees_fold_tokens_below_the_budget():
+    builder = ContextBuilder(token_budget=400, summary_budget=100, min_recent_messages=2, fold_tokens=150)
+    summary, recent, folded = builder.extend('s', '', [message(number) for number in range(12)], [message(12)])
+    assert summary and len(folded) == 8
+    # The next few turns fit without another fold
+    summary, recent, folded = builder.extend('s', summary, recent, [message(13), message(14)])
+    assert folded == []
@@ -0,0 +1,73 @@
+import gzip
+import json
+import uuid
+import asyncio
+from datetime import datetime
+import pytest
+from app import create_app
+from app.export import NDJSONWriter, HistoryExport
+from app.message_store import message_store
+
+@pytest.fixture
+def sessions():
+    """Two sessions with one message a day from 1 to 4 January 2024"""
+    ids = sorted(str(uuid.uuid4()) for _ in range(2))
+    for session_id in ids:
+        for day in range(1, 5):
+            message_store.insert({'content': f"day {day}", 'sender': 'user', 'session_id': session_id,
+                                  'timestamp': datetime(2024, 1, day)})
+    return ids
+
+def lines(data, compressed=True):
+    return [json.loads(line) for line in (gzip.decompress(data) if compressed else data).splitlines()]
+
+def test_writer_output_is_one_gzip_stream_of_ndjson_lines():
+    writer = NDJSONWriter(chunk_bytes=64)
+    records = [{'_id': index, 'session_id': 's', 'sender': 'user', 'content': 'x' * 50,
+                'timestamp': datetime(2024, 1, 1)} for index in range(20)]
+    data = b''.join(writer.write(record) for record in records) + writer.finish()
+    assert writer.count == 20
+    assert [line['id'] for line in lines(data)] == [str(index) for index in range(20)]
+    assert lines(data)[0]['timestamp'] == '2024-01-01T00:00:00Z'
+
+def test_plain_writer_output():
+    writer = NDJSONWriter(compress=False)
+    data = writer.write({'_id': 1, 'session_id': 's', 'sender': 'user', 'content': 'hi',
+                         'timestamp': datetime(2024, 1, 1)}) + writer.finish()
+    assert lines(data, compressed=False) == [
+        {'session_id': 's', 'id': '1', 'sender': 'user', 'content': 'hi', 'timestamp': '2024-01-01T00:00:00Z'}
+    ]
+
+def test_export_filters_by_session_and_time_range(sessions):
+    export = HistoryExport.from_args([','.join(sessions)], start='2024-01-02', end='2024-01-04', chunk_bytes=16)
+    exported = lines(b''.join(export.chunks()))
+    assert [(line['session_id'], line['content']) for line in exported] == [
+        (session_id, f"day {day}") for session_id in sessions for day in (2, 3)
+    ]
+
+def test_async_export_matches_the_sync_one(sessions):
+    async def collect(export):
+        return b''.join([chunk async for chunk in export.chunks_async()])
+
+    export = HistoryExport.from_args(sessions[:1], compress=False)
+    assert lines(asyncio.run(collect(export)), compressed=False) == lines(b''.join(export.chunks()), compressed=False)
+
+@pytest.mark.parametrize('args', [{'start': 'yesterday'}, {'start': '2024-01-02', 'end': '2024-01-01'}])
+def test_invalid_ranges_are_rejected(args):
+    with pytest.raises(ValueError):
+        HistoryExport.from_args(**args)
+
+def test_export_endpoint_needs_the_export_token(sessions, monkeypatch):
+    monkeypatch.delenv('EXPORT_TOKEN', raising=False)
+    client = create_app().test_client()
+    query = {'session_id': sessions[0]}
+    assert client.get('/api/history/export', query_string=query).status_code == 403
+
+    monkeypatch.setenv('EXPORT_TOKEN', 'secret')
+    assert client.get('/api/history/export', query_string=query,
+                      headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+    response = client.get('/api/history/export', query_string=query, headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/gzip'
+    assert [line['content'] for line in lines(response.data)] == [f"day {day}" for day in range(1, 5)]
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+from app import flows
+from app.flows import Step
+
+class SyncIO:
+    def __init__(self):
+        self.calls = []
+
+    def _echo(self, value):
+        self.calls.append(value)
+        return value
+
+    def _fail(self, message):
+        raise ValueError(message)
+
+class AsyncIO(SyncIO):
+    async def _echo(self, value):
+        return SyncIO._echo(self, value)
+
+    async def _fail(self, message):
+        raise ValueError(message)
+
+def retrying_flow():
+    try:
+        yield Step('_fail', 'first attempt')
+    except ValueError as e:
+        result = yield Step('_echo', f"recovered from {e}")
+    return result
+
+def streaming_flow(streamed):
+    try:
+        for text in ('a', 'b', 'c'):
+            streamed.append((yield Step('_echo', text)))
+            yield text
+    finally:
+        yield Step('_echo', 'saved ' + ''.join(streamed))
+
+def test_run_sends_results_and_raises_errors_in_the_flow():
+    service = SyncIO()
+    assert flows.run(retrying_flow(), service) == 'recovered from first attempt'
+    assert asyncio.run(flows.run_async(retrying_flow(), AsyncIO())) == 'recovered from first attempt'
+
+def test_unhandled_step_errors_propagate():
+    def flow():
+        yield Step('_fail', 'boom')
+
+    with pytest.raises(ValueError, match='boom'):
+        flows.run(flow(), SyncIO())
+
+def test_abandoned_stream_still_runs_cleanup_steps():
+    service = SyncIO()
+    chunks = flows.stream(streaming_flow([]), service)
+    assert next(chunks) == 'a'
+    chunks.close()
+    assert service.calls == ['a', 'saved a']
+
+def test_abandoned_async_stream_still_runs_cleanup_steps():
+    service = AsyncIO()
+
+    async def main():
+        chunks = flows.stream_async(streaming_flow([]), service)
+        first = await anext(chunks)
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(main()) == 'a'
+    assert service.calls == ['a', 'saved a']
+
+def test_complete_stream():
+    service = SyncIO()
+    assert list(flows.stream(streaming_flow([]), service)) == ['a', 'b', 'c']
+    assert service.calls[-1] == 'saved abc'
@@ -0,0 +1,71 @@
+import uuid
+import asyncio
+import pytest
+from app import create_app
+from app.models import Message
+from app.async_services import async_chat_service
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+@pytest.fixture
+def session_id():
+    session_id = str(uuid.uuid4())
+    for number in range(1, 6):
+        Message.save(Message(f"m{number}", 'user', session_id))
+    return session_id
+
+def contents(messages):
+    return [msg['content'] for msg in messages]
+
+def test_history_without_paging_parameters_is_the_whole_list(client, session_id):
+    response = client.get('/api/history', query_string={'session_id': session_id})
+    assert response.status_code == 200
+    assert contents(response.get_json()) == ['m1', 'm2', 'm3', 'm4', 'm5']
+
+def test_pages_walk_back_with_prev_cursor(client, session_id):
+    page = client.get('/api/history', query_string={'session_id': session_id, 'limit': 2}).get_json()
+    assert contents(page['messages']) == ['m4', 'm5']
+    assert page['has_more']
+
+    page = client.get('/api/history', query_string={
+        'session_id': session_id, 'limit': 2, 'before': page['prev_cursor']
+    }).get_json()
+    assert contents(page['messages']) == ['m2', 'm3']
+    assert page['has_more']
+
+    page = client.get('/api/history', query_string={
+        'session_id': session_id, 'limit': 2, 'before': page['prev_cursor']
+    }).get_json()
+    assert contents(page['messages']) == ['m1']
+    assert not page['has_more']
+
+def test_next_cursor_fetches_only_new_messages(client, session_id):
+    page = client.get('/api/history', query_string={'session_id': session_id, 'limit': 5}).get_json()
+    assert client.get('/api/history', query_string={
+        'session_id': session_id, 'after': page['next_cursor']
+    }).get_json()['messages'] == []
+
+    Message.save(Message('m6', 'assistant', session_id))
+    page = client.get('/api/history', query_string={
+        'session_id': session_id, 'after': page['next_cursor']
+    }).get_json()
+    assert contents(page['messages']) == ['m6']
+    assert not page['has_more']
+
+@pytest.mark.parametrize('args', [{'limit': 0}, {'limit': 'ten'}, {'before': 'not-a-cursor'},
+                                  {'after': 'x', 'since': '2024-01-01'}])
+def test_invalid_paging_parameters_are_rejected(client, session_id, args):
+    response = client.get('/api/history', query_string={'session_id': session_id, **args})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_async_service_returns_the_same_shapes(session_id):
+    async def main():
+        return (await async_chat_service.get_chat_history(session_id),
+                await async_chat_service.get_chat_history(session_id, limit=2))
+
+    history, page = asyncio.run(main())
+    assert contents(history) == ['m1', 'm2', 'm3', 'm4', 'm5']
+    assert contents(page['messages']) == ['m4', 'm5']
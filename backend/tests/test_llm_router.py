@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.llm_router import CircuitBreaker, FakeProvider, LLMRouter
+from app.rate_limiter import RateLimiter, MemoryBucketStore
+from app.deadline import Deadline
+from app.services import ChatService
+from app.async_services import AsyncChatService
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def breaker(clock, **kwargs):
+    return CircuitBreaker('test', failure_threshold=3, min_samples=10, cooldown=30.0, clock=clock, **kwargs)
+
+def provider(name, rpm=600, clock=None, **kwargs):
+    limiter = RateLimiter(name, requests_per_minute=rpm, tokens_per_minute=10 ** 6,
+                          store=MemoryBucketStore(), request_burst=1 if rpm < 60 else rpm)
+    return FakeProvider(name, None, limiter, breaker(clock or FakeClock()), latency=0, jitter=0, **kwargs)
+
+def test_breaker_opens_after_consecutive_failures_and_probes_after_cooldown():
+    clock = FakeClock()
+    circuit = breaker(clock)
+    for _ in range(2):
+        circuit.record(False, 0.0, 1)
+    assert circuit.state == 'closed'
+    circuit.record(False, 0.0, 1)
+    assert circuit.state == 'open' and not circuit.available()
+
+    clock.now += 30
+    assert circuit.available()
+    circuit.begin()
+    assert circuit.state == 'half_open'
+    # Only the probe is let through until it reports back (or the cooldown passes again)
+    assert not circuit.available()
+    circuit.record(True, 0.0, 1)
+    assert circuit.state == 'closed' and circuit.available()
+
+def test_failed_probe_reopens_the_circuit():
+    clock = FakeClock()
+    circuit = breaker(clock)
+    for _ in range(3):
+        circuit.record(False, 0.0, 1)
+    clock.now += 30
+    circuit.begin()
+    circuit.record(False, 0.0, 1)
+    assert circuit.state == 'open'
+    assert not circuit.available()
+    clock.now += 30
+    assert circuit.available()
+
+def test_only_one_concurrent_caller_gets_the_probe():
+    clock = FakeClock()
+    circuit = breaker(clock)
+    for _ in range(3):
+        circuit.record(False, 0.0, 1)
+    clock.now += 30
+    barrier = threading.Barrier(8)
+
+    def begin():
+        barrier.wait()
+        return circuit.begin()
+
+    with ThreadPoolExecutor(8) as pool:
+        claimed = list(pool.map(lambda _: begin(), range(8)))
+    assert claimed.count(True) == 1
+    assert circuit.state == 'half_open'
+
+def test_router_sends_nothing_else_while_the_probe_is_in_flight():
+    clock = FakeClock()
+    only = provider('only', clock=clock)
+    for _ in range(3):
+        only.record_failure(None)
+    clock.now += 30
+    router = LLMRouter([only], explore=0)
+    assert router.acquire(10) is only
+    assert router.acquire(10) is None
+
+def test_breaker_opens_on_error_rate_only_with_enough_samples():
+    circuit = breaker(FakeClock())
+    circuit.record(False, 0.9, 5)
+    assert circuit.state == 'closed'
+    circuit.record(True, 0.5, 10)
+    circuit.record(False, 0.5, 10)
+    assert circuit.state == 'open'
+
+def test_client_errors_do_not_count_against_the_backend():
+    backend = provider('a')
+    for _ in range(5):
+        backend.record_failure(400)
+    assert backend.breaker.state == 'closed'
+    assert backend.stats()['samples'] == 0
+    for _ in range(3):
+        backend.record_failure(503)
+    assert backend.breaker.state == 'open'
+
+def test_router_ranks_by_expected_latency_and_skips_open_circuits():
+    slow, fast = provider('slow'), provider('fast')
+    slow.record_success(2.0)
+    fast.record_success(0.5)
+    router = LLMRouter([slow, fast], explore=0)
+    assert router.ranked() == [fast, slow]
+
+    for _ in range(3):
+        fast.record_failure(None)
+    assert router.ranked() == [slow]
+    assert router.acquire(10) is slow
+
+def test_router_uses_an_untried_backend_before_retrying_a_tried_one():
+    first, second = provider('first'), provider('second')
+    router = LLMRouter([first, second], explore=0)
+    assert router.acquire(10, exclude={first}) is second
+    # With every backend tried, the tried ones are used again
+    assert router.acquire(10, exclude={first, second}) is first
+
+def test_router_fails_over_when_the_best_backend_is_out_of_quota():
+    best, spare = provider('best', rpm=1), provider('spare')
+    router = LLMRouter([best, spare], explore=0)
+    assert router.acquire(10) is best
+    assert router.acquire(10, timeout=0) is spare
+
+def test_router_returns_none_when_every_circuit_is_open():
+    only = provider('only')
+    for _ in range(3):
+        only.record_failure(None)
+    assert LLMRouter([only], explore=0).acquire(10) is None
+
+def failing_router():
+    broken = provider('broken', error_rate=1.0)
+    healthy = provider('healthy', response='hello from healthy')
+    return LLMRouter([broken, healthy], explore=0), broken
+
+def test_turn_fails_over_to_the_next_backend():
+    service = ChatService()
+    service.router, broken = failing_router()
+    flow = service._request_ai_response([], 'hi', Deadline.start(10))
+    assert service._run(flow) == 'hello from healthy'
+    assert broken.stats()['error_rate'] == 1.0
+
+def test_async_turn_fails_over_to_the_next_backend():
+    service = AsyncChatService()
+    service.router, broken = failing_router()
+    flow = service._request_ai_response([], 'hi', Deadline.start(10))
+    assert asyncio.run(service._run(flow)) == 'hello from healthy'
+    assert broken.stats()['error_rate'] == 1.0
@@ -0,0 +1,59 @@
+import uuid
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+import pytest
+from app.database import get_db
+from app.message_store import BucketMessageStore
+
+# Distinct, increasing timestamps, so the expected order never rests on _id ties
+_seconds = itertools.count()
+
+def messages(session_id, numbers):
+    return [{
+        'content': f"m{number}",
+        'sender': 'user',
+        'session_id': session_id,
+        'timestamp': datetime(2024, 1, 1) + timedelta(seconds=next(_seconds))
+    } for number in numbers]
+
+def contents(found):
+    return [msg['content'] for msg in found]
+
+@pytest.fixture
+def store():
+    return BucketMessageStore(bucket_size=10)
+
+@pytest.fixture
+def session_id():
+    return str(uuid.uuid4())
+
+def test_appends_go_to_the_newest_bucket_only(store, session_id):
+    # 8 single saves, a batch of 4 that does not fit the open bucket, then one more save
+    for document in messages(session_id, range(1, 9)):
+        store.insert(document)
+    store.insert_many(messages(session_id, range(9, 13)))
+    store.insert(messages(session_id, [13])[0])
+
+    assert contents(store.find(session_id, limit=3, newest=True)) == ['m11', 'm12', 'm13']
+    assert contents(store.find(session_id)) == [f"m{number}" for number in range(1, 14)]
+
+    buckets = list(get_db().message_buckets.find({'session_id': session_id}).sort('start', 1))
+    assert [bucket['count'] for bucket in buckets] == [8, 5]
+    assert [bucket['open'] for bucket in buckets] == [False, True]
+    assert buckets[0]['end'] < buckets[1]['start']
+
+def test_async_appends_go_to_the_newest_bucket_only(store, session_id):
+    async def main():
+        for document in messages(session_id, range(1, 9)):
+            await store.insert_async(document)
+        await store.insert_many_async(messages(session_id, range(9, 13)))
+        await store.insert_async(messages(session_id, [13])[0])
+        return await store.find_async(session_id, limit=3, newest=True)
+
+    assert contents(asyncio.run(main())) == ['m11', 'm12', 'm13']
+
+def test_build_buckets_leaves_only_the_last_one_open(store, session_id):
+    buckets = store.build_buckets(session_id, messages(session_id, range(25)))
+    assert [bucket['count'] for bucket in buckets] == [10, 10, 5]
+    assert [bucket['open'] for bucket in buckets] == [False, False, True]
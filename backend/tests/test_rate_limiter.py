@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import pytest
+from app.rate_limiter import (Bucket, MemoryBucketStore, FileBucketStore, RateLimiter, RateLimitTimeout,
+                              PRIORITY_HIGH, PRIORITY_LOW)
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_bucket_refills_at_its_rate_up_to_capacity():
+    clock = FakeClock()
+    store = MemoryBucketStore(clock)
+    bucket = Bucket('b', capacity=2, refill_per_second=1)
+
+    assert store.take([(bucket, 1)]) == 0
+    assert store.take([(bucket, 1)]) == 0
+    assert store.take([(bucket, 1)]) == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert store.take([(bucket, 1)]) == pytest.approx(0.5)
+    clock.now += 10
+    assert store.take([(bucket, 2)]) == 0
+    assert store.take([(bucket, 1)]) > 0
+
+def test_take_is_all_or_nothing_across_buckets():
+    clock = FakeClock()
+    store = MemoryBucketStore(clock)
+    requests = Bucket('rpm', capacity=5, refill_per_second=1)
+    tokens = Bucket('tpm', capacity=10, refill_per_second=10)
+
+    assert store.take([(requests, 1), (tokens, 10)]) == 0
+    # The token bucket is empty, so no request is taken either
+    assert store.take([(requests, 1), (tokens, 5)]) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert store.take([(requests, 4), (tokens, 5)]) == 0
+    assert store.take([(requests, 1)]) > 0
+
+def test_demand_larger_than_the_bucket_is_clamped():
+    limiter = RateLimiter('clamp', requests_per_minute=60, tokens_per_minute=600,
+                          store=MemoryBucketStore(FakeClock()))
+    assert limiter.try_acquire(tokens=10 ** 6) == 0
+
+def test_file_store_shares_quota_between_instances(tmp_path):
+    path = str(tmp_path / 'limits.json')
+    bucket = Bucket('shared', capacity=2, refill_per_second=0.001)
+    first, second = FileBucketStore(path), FileBucketStore(path)
+
+    assert first.take([(bucket, 1)]) == 0
+    assert second.take([(bucket, 1)]) == 0
+    assert first.take([(bucket, 1)]) > 0
+
+def test_acquire_times_out_instead_of_waiting_past_the_queue_timeout():
+    limiter = RateLimiter('timeout', requests_per_minute=1, tokens_per_minute=1000,
+                          store=MemoryBucketStore(), request_burst=1, queue_timeout=0.05)
+    limiter.acquire()
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire()
+    assert limiter.queued() == 0
+
+def test_acquire_async_serves_waiters_by_priority():
+    clock = FakeClock()
+    limiter = RateLimiter('priority', requests_per_minute=60, tokens_per_minute=1000,
+                          store=MemoryBucketStore(clock), request_burst=1, queue_timeout=5)
+    order = []
+
+    async def acquire(name, priority):
+        await limiter.acquire_async(priority=priority)
+        order.append(name)
+        clock.now += 1  # Refill one request for the next waiter
+
+    async def main():
+        await limiter.acquire_async()  # Empty the bucket
+        low = asyncio.create_task(acquire('low', PRIORITY_LOW))
+        high = asyncio.create_task(acquire('high', PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        clock.now += 1
+        await asyncio.wait_for(asyncio.gather(low, high), 5)
+
+    asyncio.run(main())
+    assert order == ['high', 'low']
+
+class ThreadRecordingStore(MemoryBucketStore):
+    """A store that says it blocks, recording the threads it is called from"""
+
+    blocking = True
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def take(self, demands):
+        self.threads.append(threading.get_ident())
+        return super().take(demands)
+
+def test_acquire_async_keeps_blocking_stores_off_the_event_loop():
+    store = ThreadRecordingStore()
+    limiter = RateLimiter('offloop', requests_per_minute=60, tokens_per_minute=1000, store=store)
+
+    async def main():
+        await limiter.acquire_async()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert store.threads and loop_thread not in store.threads
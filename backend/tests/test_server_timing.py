@@ -0,0 +1,26 @@
+import pytest
+from app import create_app, metrics
+from app.routes import chat_service
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+def test_successful_turn_reports_its_stages(client, monkeypatch):
+    monkeypatch.setattr(chat_service, 'process_message',
+                        lambda message, session_id: {'response': 'hi', 'session_id': session_id})
+    response = client.post('/api/chat', json={'message': 'hello', 'session_id': 's'})
+    assert response.status_code == 200
+    assert 'total;dur=' in response.headers['Server-Timing']
+
+def test_failed_turn_still_reports_its_stages_and_ends_the_trace(client, monkeypatch):
+    def fail(message, session_id):
+        metrics.observe_stage('upstream', 0.25)
+        raise RuntimeError('upstream exploded')
+
+    monkeypatch.setattr(chat_service, 'process_message', fail)
+    response = client.post('/api/chat', json={'message': 'hello', 'session_id': 's'})
+    assert response.status_code == 500
+    assert 'upstream;dur=250.0' in response.headers['Server-Timing']
+    assert 'total;dur=' in response.headers['Server-Timing']
+    assert metrics.server_timing() == ''
@@ -0,0 +1,68 @@
+import time
+from bson import ObjectId
+from app.write_behind import WriteBehindQueue
+
+class FlakyWriter:
+    """write_batch stand-in that fails until `fail` is cleared"""
+
+    def __init__(self):
+        self.fail = True
+        self.written = []
+
+    def __call__(self, batch):
+        if self.fail:
+            raise ConnectionError('database unavailable')
+        self.written.extend(batch)
+
+def message(session_id='s', content='hi'):
+    return {'_id': ObjectId(), 'session_id': session_id, 'content': content}
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.01)
+
+def test_failed_batches_are_kept_and_written_once_the_database_is_back():
+    writer = FlakyWriter()
+    queue = WriteBehindQueue(writer, flush_interval=0.01, max_flush_attempts=1, retry_interval=0.05)
+    documents = [message(content=str(i)) for i in range(3)]
+    for document in documents:
+        queue.enqueue(document)
+
+    wait_for(lambda: queue.stats()['retained'] == 3)
+    # Still readable while waiting for the retry
+    assert [doc['content'] for doc in queue.pending('s')] == ['0', '1', '2']
+
+    writer.fail = False
+    wait_for(lambda: queue.stats()['pending'] == 0)
+    assert [doc['_id'] for doc in writer.written] == [doc['_id'] for doc in documents]
+    assert queue.stats()['dropped'] == 0
+    queue.close()
+
+def test_oldest_messages_are_dropped_and_counted_beyond_max_retained():
+    writer = FlakyWriter()
+    queue = WriteBehindQueue(writer, max_flush_attempts=1, max_retained=2)
+    first, second, third = message(content='1'), message(content='2'), message(content='3')
+
+    assert not queue._write([first, second])
+    assert not queue._write([third])
+
+    stats = queue.stats()
+    assert (stats['retained'], stats['dropped'], stats['pending']) == (2, 1, 0)
+    assert [doc['_id'] for doc in queue._retained] == [second['_id'], third['_id']]
+
+    writer.fail = False
+    queue.close()
+    assert [doc['_id'] for doc in writer.written] == [second['_id'], third['_id']]
+
+def test_backoff_only_runs_between_attempts(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('app.write_behind.time.sleep', sleeps.append)
+    writer = FlakyWriter()
+    queue = WriteBehindQueue(writer, max_flush_attempts=3)
+
+    assert not queue._write([message()])
+    assert sleeps == [0.1, 0.2]
+    writer.fail = False
+    queue.close()
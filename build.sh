@@ -11,4 +11,10 @@ cd ..
 echo "Installing Python dependencies..."
 pip install -r requirements.txt
 
+# Precompress the build (gzip, and brotli when available) for the backend to serve
+echo "Precompressing static assets..."
+cd backend
+python -m scripts.compress_static
+cd ..
+
 echo "Build completed successfully!"
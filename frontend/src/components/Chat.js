@@ -111,7 +111,7 @@ const Chat = () => {
 
     try {
       console.log("Sending message:", input);
-      const response = await fetch("/api/chat", {
+      const response = await fetch("/api/chat/stream", {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -126,24 +126,69 @@ const Chat = () => {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      const data = await response.json();
-      console.log("Received response:", data);
+      const botMessageId = Date.now() + Math.random(); // Add unique ID
+      let started = false;
 
-      // Simulate typing delay for better UX
-      setTimeout(() => {
-        const botMessage = {
-          id: Date.now() + Math.random(), // Add unique ID
-          content: data.response,
-          sender: "assistant",
-          timestamp: new Date().toISOString(),
-        };
-
-        setMessages((prev) => [...prev, botMessage]);
-        setIsTyping(false);
-
-        // Play receive sound
-        soundManager.playMessageReceived();
-      }, 1000);
+      const appendDelta = (delta) => {
+        if (!started) {
+          started = true;
+          setIsTyping(false);
+          setMessages((prev) => [
+            ...prev,
+            {
+              id: botMessageId,
+              content: delta,
+              sender: "assistant",
+              timestamp: new Date().toISOString(),
+            },
+          ]);
+          return;
+        }
+        setMessages((prev) =>
+          prev.map((msg) =>
+            msg.id === botMessageId
+              ? { ...msg, content: msg.content + delta }
+              : msg
+          )
+        );
+      };
+
+      // Parse Server-Sent Events as they arrive
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+
+        for (const rawEvent of events) {
+          let eventType = "message";
+          let payload = "";
+          for (const line of rawEvent.split("\n")) {
+            if (line.startsWith("event:")) eventType = line.slice(6).trim();
+            else if (line.startsWith("data:")) payload += line.slice(5).trim();
+          }
+          if (!payload) continue;
+
+          const data = JSON.parse(payload);
+          if (eventType === "error") {
+            throw new Error(data.error);
+          }
+          if (eventType === "message" && data.delta) {
+            appendDelta(data.delta);
+          }
+        }
+      }
+
+      setIsTyping(false);
+
+      // Play receive sound
+      soundManager.playMessageReceived();
     } catch (error) {
       console.error("Error sending message:", error);
       setError("Failed to send message. Please try again.");